@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import socket
+import argparse
+import platform
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from corpus_store import open_corpus
+
+# Hardware autotuner for the NER pipeline and the step6 sentence encoder.
+#
+# 'python autotune.py ner' (or 'encoder') benchmarks a grid of inference
+# settings on a sample of cadec/text posts on this machine:
+#   batch_size      - texts per pipeline/encode call
+#   threads         - torch intra-op threads per worker process
+#   interop_threads - torch inter-op threads per worker process
+#   workers         - worker processes running the model
+#   backend         - 'eager' or 'int8' (dynamic int8 quantization of the Linear layers)
+#   share_weights   - the parent loads the model once into shared memory and the
+#                     workers attach to its weights, instead of each worker
+#                     loading its own copy (eager backend only)
+# Each setting runs in fresh processes (torch thread counts can only be set
+# once per process), and is measured in docs/sec, p95 latency per call and
+# the resident memory (RSS, and PSS which splits shared pages between processes) of the workers.
+# The fastest setting (optionally under a p95 bound) is saved as the profile
+# of (task, model, host) in .autotune/profiles.json. batch_generate_predicted_spans.py
+# and step6.py load that profile automatically when one exists. step6 encodes
+# in a single process, so the encoder grid only tries one worker: a profile won
+# by several single-threaded workers would leave step6 on one thread.
+
+PROFILE_FILE = '.autotune/profiles.json'
+TASKS = ('ner', 'encoder')
+# Settings used when a host has no profile: what the scripts did before autotuning
+DEFAULT_PROFILES = {
+    'ner': {'batch_size': 1, 'threads': None, 'interop_threads': None, 'workers': 1, 'backend': 'eager',
+            'share_weights': False},
+    'encoder': {'batch_size': 64, 'threads': None, 'interop_threads': None, 'workers': 1, 'backend': 'eager',
+                'share_weights': False},
+}
+
+
+def host_id():
+    """Identifies the machine type a profile was measured on: host name, CPU model and core count."""
+    processor = platform.processor() or platform.machine()
+    return f'{socket.gethostname()}|{processor}|{os.cpu_count()}'
+
+
+def load_profiles(profile_file=PROFILE_FILE):
+    if not os.path.exists(profile_file):
+        return {}
+    with open(profile_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_profile(task, model_name, profile, profile_file=PROFILE_FILE):
+    profiles = load_profiles(profile_file)
+    profiles.setdefault(host_id(), {})[f'{task}:{model_name}'] = profile
+    os.makedirs(os.path.dirname(profile_file) or '.', exist_ok=True)
+    tmp_file = profile_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_file, profile_file)
+
+
+def get_profile(task, model_name, profile_file=PROFILE_FILE):
+    """
+    Returns the tuned settings of (task, model) on this host, or the defaults
+    (with 'tuned': False) when the autotuner has not been run here.
+    """
+    profile = load_profiles(profile_file).get(host_id(), {}).get(f'{task}:{model_name}')
+    if profile is None:
+        return dict(DEFAULT_PROFILES[task], tuned=False)
+    return dict(DEFAULT_PROFILES[task], **profile, tuned=True)
+
+
+def apply_threads(profile):
+    """Sets the torch thread counts of a profile for the current process."""
+    import torch
+    if profile.get('threads'):
+        torch.set_num_threads(profile['threads'])
+    if profile.get('interop_threads'):
+        try:
+            torch.set_num_interop_threads(profile['interop_threads'])
+        except RuntimeError:
+            # Inter-op threads can only be set before torch starts parallel work
+            pass
+
+
+def apply_backend(model, backend):
+    """Returns the torch model converted to a backend ('eager' leaves it unchanged)."""
+    if backend == 'int8':
+        import torch
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def load_model(task, model_name, backend='eager'):
+    """
+    Loads the model of a task, from its built artifact when there is one (model_artifact.py).
+    Returns:
+        (torch.nn.Module, tokenizer): The tokenizer is None for the encoder.
+    """
+    from model_artifact import load_ner_model, load_encoder
+    if task == 'ner':
+        model, tokenizer = load_ner_model(model_name)
+        return apply_backend(model, backend), tokenizer
+    return apply_backend(load_encoder(model_name), backend), None
+
+
+def make_runner(task, model, tokenizer, batch_size):
+    """Returns a callable: texts -> list of outputs (NER entity lists, or embeddings)."""
+    if task == 'ner':
+        from transformers import pipeline
+        ner_pipeline = pipeline('ner', model=model, tokenizer=tokenizer, aggregation_strategy="simple")
+        return lambda texts: ner_pipeline(list(texts), batch_size=batch_size)
+    return lambda texts: list(model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True))
+
+
+def build_runner(task, model_name, profile):
+    """Loads the model of a task with a profile's settings and returns its runner (see make_runner)."""
+    apply_threads(profile)
+    model, tokenizer = load_model(task, model_name, profile['backend'])
+    return make_runner(task, model, tokenizer, profile['batch_size'])
+
+
+def share_model(task, model_name):
+    """
+    Loads the model once with its weights in shared memory, for workers to attach to.
+    Passed to a spawned worker, the model is sent as handles to the shared
+    storage, so every worker reads the same physical pages.
+    Returns:
+        (torch.nn.Module, tokenizer)
+    """
+    model, tokenizer = load_model(task, model_name)
+    model.share_memory()
+    return model, tokenizer
+
+
+def process_memory():
+    """
+    Resident memory of the current process in MB: 'rss' counts every page it
+    maps, 'pss' splits shared pages evenly between the processes mapping them
+    (None where /proc/self/smaps_rollup is not available, i.e. outside Linux).
+    """
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    values[key.lower()] = int(rest.split()[0]) / 1024
+    except OSError:
+        import resource
+        # ru_maxrss is the peak, in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        values['rss'] = peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+    return {'pid': os.getpid(), 'rss_mb': values.get('rss'), 'pss_mb': values.get('pss')}
+
+
+# ----- worker processes -----
+
+_runner = None
+_load_seconds = 0.0
+
+
+def _init_worker(task, model_name, profile, shared=None):
+    global _runner, _load_seconds
+    start = time.perf_counter()
+    if shared is None:
+        _runner = build_runner(task, model_name, profile)
+    else:
+        # Attach to the parent's shared weights instead of loading a copy
+        apply_threads(profile)
+        model, tokenizer = shared
+        _runner = make_runner(task, model, tokenizer, profile['batch_size'])
+    _load_seconds = time.perf_counter() - start
+
+
+def _run_shard(texts, batch_size, warmup):
+    """Runs one worker's share of texts; returns (outputs, per-call latencies, start, end, memory, load seconds)."""
+    if warmup:
+        _runner(texts[:batch_size])
+    outputs, latencies = [], []
+    start = time.time()
+    for i in range(0, len(texts), batch_size):
+        call_start = time.perf_counter()
+        outputs.extend(_runner(texts[i:i + batch_size]))
+        latencies.append(time.perf_counter() - call_start)
+    return outputs, latencies, start, time.time(), process_memory(), _load_seconds
+
+
+def run_parallel(task, model_name, profile, texts, warmup=False):
+    """
+    Runs a task over `texts` with `profile['workers']` processes running the
+    model with the profile's settings. Texts are split into contiguous shards.
+    With `profile['share_weights']`, the model is loaded once here and the
+    workers attach to its shared weights.
+    Returns:
+        (list, dict): Outputs in input order, and stats: docs_per_sec, p95_ms,
+        rss_mb and pss_mb summed over the workers and the parent, 'worker_memory'
+        and 'parent_memory', 'load_seconds' (the parent's shared load plus the
+        slowest worker load) and 'inference_seconds' (first shard start to last
+        shard end).
+    """
+    workers = max(1, min(profile['workers'], len(texts)))
+    bounds = np.linspace(0, len(texts), workers + 1).astype(int)
+    shards = [texts[bounds[i]:bounds[i + 1]] for i in range(workers)]
+    shared = None
+    parent_load_seconds = 0.0
+    if profile.get('share_weights'):
+        if profile['backend'] != 'eager':
+            raise ValueError('share_weights needs the eager backend (quantized weights cannot be shared)')
+        import torch.multiprocessing
+        # torch's multiprocessing context sends shared tensors to the workers as handles
+        context = torch.multiprocessing.get_context('spawn')
+        load_start = time.perf_counter()
+        shared = share_model(task, model_name)
+        parent_load_seconds = time.perf_counter() - load_start
+    else:
+        context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(task, model_name, profile, shared)) as pool:
+        results = list(pool.map(_run_shard, shards, [profile['batch_size']] * workers, [warmup] * workers))
+    outputs = [output for shard_outputs, _, _, _, _, _ in results for output in shard_outputs]
+    latencies = np.array([latency for _, shard_latencies, _, _, _, _ in results for latency in shard_latencies])
+    elapsed = max(end for _, _, _, end, _, _ in results) - min(start for _, _, start, _, _, _ in results)
+    # A worker that ran several shards reports its memory once (the last report)
+    worker_memory = list({memory['pid']: memory for _, _, _, _, memory, _ in results}.values())
+    # The totals include the parent: with shared weights it holds its share of the weight pages,
+    # so leaving it out would make shared setups look smaller than they are
+    parent_memory = process_memory()
+    stats = {
+        'docs_per_sec': len(texts) / elapsed if elapsed > 0 else 0.0,
+        'p95_ms': float(np.percentile(latencies, 95) * 1000) if len(latencies) else 0.0,
+        'rss_mb': sum(m['rss_mb'] or 0.0 for m in worker_memory + [parent_memory]),
+        'pss_mb': sum(m['pss_mb'] or 0.0 for m in worker_memory + [parent_memory]),
+        'worker_memory': worker_memory,
+        # Workers load in parallel, so the slowest one bounds the load time
+        'load_seconds': parent_load_seconds + max(load for _, _, _, _, _, load in results),
+        'inference_seconds': elapsed,
+        'parent_memory': parent_memory,
+    }
+    return outputs, stats
+
+
+def print_worker_memory(stats):
+    for name, memory in [('worker', m) for m in stats['worker_memory']] + [('parent', stats['parent_memory'])]:
+        pss = f"{memory['pss_mb']:.0f} MB" if memory['pss_mb'] is not None else 'n/a'
+        print(f"  {name} {memory['pid']}: RSS {memory['rss_mb']:.0f} MB, PSS {pss}")
+    print(f"  total (workers + parent): RSS {stats['rss_mb']:.0f} MB, PSS {stats['pss_mb']:.0f} MB")
+
+
+# ----- benchmark -----
+
+def sample_texts(task, n_docs, seed=0):
+    """
+    Benchmark inputs: random cadec/text posts for NER, and the ADR mention texts
+    of random posts (what step6 encodes) for the encoder.
+    """
+    corpus = open_corpus()
+    rng = np.random.default_rng(seed)
+    doc_ids = [corpus.doc_ids[i] for i in rng.permutation(len(corpus))]
+    if task == 'ner':
+        return [corpus.text(doc_id).strip() for doc_id in doc_ids[:n_docs]]
+    texts = []
+    for doc_id in doc_ids:
+        ann_file = os.path.join('cadec/original', doc_id + '.ann')
+        if not os.path.exists(ann_file):
+            continue
+        with open(ann_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) >= 3 and parts[1].startswith('ADR '):
+                    texts.append(parts[2])
+        if len(texts) >= n_docs:
+            break
+    return texts[:n_docs]
+
+
+def settings_grid(batch_sizes, threads, interop_threads, workers, backends, share_weights=(False,), cpus=None):
+    """
+    All settings whose workers x threads fit on the machine's cores. Shared
+    weights are only tried with the eager backend and more than one worker.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    grid = []
+    for batch_size, n_threads, n_interop, n_workers, backend, shared in itertools.product(
+            batch_sizes, threads, interop_threads, workers, backends, share_weights):
+        if n_threads * n_workers <= cpus and not (shared and (backend != 'eager' or n_workers == 1)):
+            grid.append({'batch_size': batch_size, 'threads': n_threads, 'interop_threads': n_interop,
+                         'workers': n_workers, 'backend': backend, 'share_weights': shared})
+    return grid
+
+
+def autotune(task, model_name, texts, grid, max_p95_ms=None, max_pss_mb=None):
+    """
+    Benchmarks every setting of `grid` on `texts`.
+    Returns:
+        (list, dict): One result per setting (the setting plus docs_per_sec and
+        p95_ms, rss_mb, pss_mb), and the best setting, or None when none meets
+        `max_p95_ms` and `max_pss_mb`.
+    """
+    results = []
+    for i, setting in enumerate(grid):
+        _, stats = run_parallel(task, model_name, setting, texts, warmup=True)
+        results.append(dict(setting, **{key: value for key, value in stats.items() if not key.endswith('_memory')}))
+        print(f"[{i + 1}/{len(grid)}] batch={setting['batch_size']:<3} threads={setting['threads']:<2} "
+              f"interop={setting['interop_threads']:<2} workers={setting['workers']:<2} {setting['backend']:<6} "
+              f"{'shared' if setting['share_weights'] else 'copies':<6} "
+              f"{stats['docs_per_sec']:8.2f} docs/s  p95 {stats['p95_ms']:8.1f} ms  PSS {stats['pss_mb']:7.0f} MB")
+    allowed = [r for r in results if (max_p95_ms is None or r['p95_ms'] <= max_p95_ms)
+               and (max_pss_mb is None or r['pss_mb'] <= max_pss_mb)]
+    best = max(allowed, key=lambda r: r['docs_per_sec']) if allowed else None
+    return results, best
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    default_threads = ','.join(str(n) for n in sorted({1, 2, 4, cpus // 2, cpus} - {0}) if n <= cpus)
+    parser = argparse.ArgumentParser(description='Benchmark inference settings and save the best profile for this host.')
+    parser.add_argument('task', choices=TASKS)
+    parser.add_argument('--model', default=None, help='Defaults to the model of the batch script (ner) or step6 (encoder)')
+    parser.add_argument('--docs', type=int, default=32, help='Sample size (posts for ner, ADR texts for encoder)')
+    parser.add_argument('--batch-sizes', type=_int_list, default=None)
+    parser.add_argument('--threads', type=_int_list, default=_int_list(default_threads))
+    parser.add_argument('--interop-threads', type=_int_list, default=[1])
+    parser.add_argument('--workers', type=_int_list, default=[1, 2, 4], help='Worker counts to try (ner only)')
+    parser.add_argument('--backends', default='eager', help="Comma-separated: eager,int8")
+    parser.add_argument('--share-weights', choices=['no', 'yes', 'both'], default='both',
+                        help='Workers load their own model copy (no), attach to shared weights (yes), or try both')
+    parser.add_argument('--max-p95-ms', type=float, default=None, help='Only pick settings under this p95 latency')
+    parser.add_argument('--max-pss-mb', type=float, default=None, help='Only pick settings whose workers and parent fit in this memory (total PSS)')
+    parser.add_argument('--dry-run', action='store_true', help='Do not save the profile')
+    args = parser.parse_args()
+
+    model_name = args.model or ('d4data/biomedical-ner-all' if args.task == 'ner' else 'all-MiniLM-L6-v2')
+    batch_sizes = args.batch_sizes or ([1, 4, 8, 16] if args.task == 'ner' else [16, 32, 64, 128])
+    share_weights = {'no': (False,), 'yes': (True,), 'both': (False, True)}[args.share_weights]
+    # The encoder users (step6, linking_eval) run in one process and only apply the thread counts
+    workers = args.workers if args.task == 'ner' else [1]
+    grid = settings_grid(batch_sizes, args.threads, args.interop_threads, workers, args.backends.split(','),
+                         share_weights)
+    texts = sample_texts(args.task, args.docs)
+    print(f'Autotuning {args.task} ({model_name}) on {host_id()}: {len(grid)} settings, {len(texts)} texts')
+
+    _, best = autotune(args.task, model_name, texts, grid, args.max_p95_ms, args.max_pss_mb)
+    if best is None:
+        print('No setting met the latency and memory bounds; nothing saved.')
+        return
+    best['measured'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    print(f'\nBest: {json.dumps(best)}')
+    if not args.dry_run:
+        save_profile(args.task, model_name, best)
+        print(f'Saved profile to {PROFILE_FILE}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,28 @@
 import os
 import json
-from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
+import time
+import argparse
+from autotune import get_profile, apply_threads, apply_backend, run_parallel, print_worker_memory
+from corpus_store import DEFAULT_TEXT_DIR, open_corpus, read_post
+from model_artifact import load_ner_model, model_revision
+from pipelined_io import IOStats, BackgroundWriter, prefetch, write_json
+from spans import SpanTable
+from run_registry import snapshot_run
 
 MODEL_NAME = 'd4data/biomedical-ner-all'
 
-print('Loading model and tokenizer...')
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-model = AutoModelForTokenClassification.from_pretrained(MODEL_NAME)
-ner_pipeline = pipeline('ner', model=model, tokenizer=tokenizer, aggregation_strategy="simple")
+def load_ner_pipeline(model_name=MODEL_NAME, profile=None):
+    # transformers is only imported here, so the label map and file helpers of this
+    # module can be used (e.g. by bio_decoding.py decode) without the model libraries
+    from transformers import pipeline
+    # Thread counts and backend come from the autotune profile of this host, if any
+    profile = profile or get_profile('ner', model_name)
+    apply_threads(profile)
+    print('Loading model and tokenizer...')
+    # From the prebuilt artifact when there is one (python model_artifact.py build-artifact ner)
+    model, tokenizer = load_ner_model(model_name)
+    model = apply_backend(model, profile['backend'])
+    return pipeline('ner', model=model, tokenizer=tokenizer, aggregation_strategy="simple")
 
 # Helper: postprocess NER results to merge subword tokens
 
@@ -39,36 +54,146 @@ entity_map = {
     'Sign_symptom': ['Symptom', 'ADR'],
     'Other_event': ['ADR'],
     'Detailed_description': ['ADR'],
+    # Labels predicted directly by the distilled student (distill_student_ner.py)
+    'ADR': ['ADR'],
+    'Disease': ['Disease'],
+    'Symptom': ['Symptom'],
 }
 
 def get_mapped_labels(entity_group):
     return entity_map.get(entity_group, None)
 
-# Main batch loop
-with open('step5_sampled_files.txt', 'r') as f:
-    sampled_txt_files = [line.strip() for line in f if line.strip()]
-
-for txt_file in sampled_txt_files:
-    text_path = os.path.join('cadec/text', txt_file)
-    if not os.path.exists(text_path):
-        print(f"Text file missing: {txt_file}")
-        continue
-    with open(text_path, 'r', encoding='utf-8') as f:
-        text = f.read().strip()
-    print(f"Processing {txt_file} ...")
-    ner_results = ner_pipeline(text)
-    ner_results = postprocess_ner_results(ner_results, text)
-    # Convert to span format: [label, start, end, text]
-    predicted_spans = []
+def entities_to_spans(ner_results, text):
+    # Collect mapped spans in a SpanTable: an entity mapped to several labels
+    # (e.g. Sign_symptom -> Symptom + ADR) is one span with a label bitmask
+    rows = []
     for entity in ner_results:
         mapped_labels = get_mapped_labels(entity['entity_group'])
         if not mapped_labels:
             continue
         for mapped_label in mapped_labels:
-            predicted_spans.append([mapped_label, entity['start'], entity['end'], entity['word']])
-    # Save to JSON
-    base = txt_file.replace('.txt', '')
-    out_json = f"{base}_predicted_spans.json"
+            rows.append((mapped_label, entity['start'], entity['end']))
+    # Convert to span format: [label, start, end, text]
+    return SpanTable.from_rows(rows).to_rows(text=text)
+
+def write_predicted_spans(base, predicted_spans, out_dir='.', compact=False):
+    out_json = os.path.join(out_dir, f"{base}_predicted_spans.json")
+    if compact:
+        write_json(out_json, predicted_spans)
+        return out_json
     with open(out_json, 'w', encoding='utf-8') as f:
         json.dump(predicted_spans, f, ensure_ascii=False, indent=2)
-    print(f"Saved {out_json}") 
\ No newline at end of file
+    return out_json
+
+def read_sampled_files(path='step5_sampled_files.txt'):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Write *_predicted_spans.json for the step5 sample.')
+    parser.add_argument('--model', default=MODEL_NAME, help='Model name or local directory (e.g. student_ner/model)')
+    parser.add_argument('--no-snapshot', action='store_true', help='Do not store this run in the run registry')
+    parser.add_argument('--note', default=None, help='Free-text note saved with the run snapshot')
+    parser.add_argument('--text-source', choices=['corpus', 'files'], default='corpus',
+                        help='Read posts from the packed corpus or from the cadec/text files')
+    parser.add_argument('--prefetch', type=int, default=16, help='Posts read ahead of the model (0: read inline)')
+    parser.add_argument('--read-workers', type=int, default=4)
+    parser.add_argument('--serial', action='store_true', help='Read and write inline, without overlapping I/O')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (overrides the autotune profile)')
+    parser.add_argument('--share-weights', action='store_true',
+                        help='Load the model once into shared memory and let the workers attach to it')
+    args = parser.parse_args()
+
+    profile = get_profile('ner', args.model)
+    if args.workers is not None:
+        profile['workers'] = args.workers
+    if args.share_weights:
+        profile['share_weights'] = True
+    print(f"Settings ({'autotuned' if profile['tuned'] else 'default'}): batch_size={profile['batch_size']}, "
+          f"threads={profile['threads']}, workers={profile['workers']}, backend={profile['backend']}, "
+          f"share_weights={profile['share_weights']}")
+
+    # Main batch loop
+    sampled_txt_files = read_sampled_files()
+
+    # Posts are read from the packed, memory-mapped corpus instead of one file each
+    corpus = open_corpus()
+    text_dir = DEFAULT_TEXT_DIR
+    source = corpus if args.text_source == 'corpus' else None
+
+    bases = []
+    for txt_file in sampled_txt_files:
+        base = txt_file.replace('.txt', '')
+        if base not in corpus and not os.path.exists(os.path.join(text_dir, txt_file)):
+            print(f"Text file missing: {txt_file}")
+            continue
+        bases.append(base)
+
+    # Pipelined I/O: a thread pool reads the next posts while the model runs, and
+    # a background thread writes compact JSON, so the model does not wait on disk
+    io_stats = IOStats()
+    depth = 0 if args.serial else args.prefetch
+    reader = prefetch(bases, lambda base: read_post(base, source, text_dir).strip(), args.read_workers, depth, io_stats)
+    writer = BackgroundWriter(background=not args.serial, stats=io_stats)
+
+    def save(base, text, ner_results):
+        ner_results = postprocess_ner_results(ner_results, text)
+        writer.submit(write_predicted_spans, base, entities_to_spans(ner_results, text), '.', not args.serial)
+
+    processed = []
+    t0 = time.perf_counter()
+    with writer:
+        if profile['workers'] > 1:
+            # Several processes, each with its own copy of the model or attached to shared weights.
+            # The workers take their shards up front, so all posts are read (through the prefetch
+            # threads) before the pool starts: the read time is not overlapped with inference
+            # here and shows up in the read wait.
+            posts = list(reader)
+            all_results, pool_stats = run_parallel('ner', args.model, profile, [text for _, text in posts])
+            print('Worker memory:')
+            print_worker_memory(pool_stats)
+            load_seconds = pool_stats['load_seconds']
+            inference_seconds = pool_stats['inference_seconds']
+            for (base, text), ner_results in zip(posts, all_results):
+                save(base, text, ner_results)
+                processed.append(base)
+        else:
+            ner_pipeline = load_ner_pipeline(args.model, profile)
+            load_seconds = time.perf_counter() - t0
+            start = time.perf_counter()
+            batch_size = profile['batch_size']
+            batch = []
+            for post in reader:
+                batch.append(post)
+                if len(batch) < batch_size and len(processed) + len(batch) < len(bases):
+                    continue
+                print(f"Processing {', '.join(base for base, _ in batch)} ...")
+                for (base, text), ner_results in zip(batch, ner_pipeline([text for _, text in batch], batch_size=batch_size)):
+                    save(base, text, ner_results)
+                    processed.append(base)
+                batch = []
+            inference_seconds = time.perf_counter() - start
+    # Load, inference and the final writes the background writer drains on exit
+    wall_seconds = time.perf_counter() - t0
+    print(f"Wrote {writer.written} prediction files. Model waited {io_stats.read_wait:.2f}s on reads and "
+          f"{io_stats.write_wait:.2f}s on writes; I/O threads spent {io_stats.read_seconds:.2f}s reading "
+          f"and {io_stats.write_seconds:.2f}s writing.")
+
+    # Keep a copy of this run so it can be compared with later runs (python run_registry.py diff)
+    if not args.no_snapshot and processed:
+        run_id = snapshot_run(doc_ids=processed, meta={
+            'model': args.model,
+            'revision': model_revision(args.model),
+            'label_map': entity_map,
+            'thresholds': {'aggregation_strategy': 'simple'},
+            'settings': {key: profile[key] for key in ('batch_size', 'threads', 'interop_threads', 'workers', 'backend',
+                                                       'share_weights')},
+            'timings': {'load_seconds': load_seconds, 'inference_seconds': inference_seconds,
+                        'wall_seconds': wall_seconds, 'seconds_per_post': inference_seconds / len(processed),
+                        'read_wait_seconds': io_stats.read_wait, 'write_wait_seconds': io_stats.write_wait},
+            'note': args.note,
+        })
+        print(f"Saved run {run_id}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from corpus_store import open_corpus
+from spans import SpanTable
+from tokenization_store import open_token_store
+
+# BIO decoding over stored model outputs.
+#
+# 'store' runs a token classifier once over the token store and keeps its
+# per-token log-probabilities (float16, memory-mapped) under cadec/logits/.
+# 'decode' turns them into character spans without touching the model:
+#   1. the model labels are projected onto our target labels through a label map
+#      (entity_map of the batch script by default). Each target label gets its
+#      own O/B/I distribution, so a model label mapped to several target labels
+#      (Sign_symptom -> Symptom, ADR) can produce a span for each of them
+#   2. the windows of long posts are merged into one token sequence, each
+#      overlapping token taken from the window where it is farthest from an edge
+#   3. every (post, label) sequence is decoded at once, either by argmax or by
+#      Viterbi restricted to valid BIO sequences (no I right after O or at the start)
+#   4. consecutive B/I tokens become one span from the first token's start to
+#      the last token's end
+# Decoding is pure NumPy, so decoding variants can be compared in seconds.
+
+TARGET_LABELS = ('ADR', 'Drug', 'Disease', 'Symptom')
+O, B, I = 0, 1, 2
+DEFAULT_LOGITS_DIR = 'cadec/logits'
+DEFAULT_OUT_DIR = 'decoded_predictions'
+_MIN_PROB = 1e-6
+
+
+def label_projection(id2label, label_map):
+    """
+    Returns a (model labels, len(TARGET_LABELS), 3) matrix adding each model
+    label's probability to the B or I column of every target label it maps to
+    in `label_map` ({model group: [target labels]}). The O column is left empty;
+    it is 1 - B - I.
+    """
+    projection = np.zeros((len(id2label), len(TARGET_LABELS), 3), dtype=np.float32)
+    for i, label in id2label.items():
+        prefix, _, group = label.partition('-')
+        if prefix not in ('B', 'I'):
+            continue
+        for mapped_label in label_map.get(group) or []:
+            if mapped_label in TARGET_LABELS:
+                projection[int(i), TARGET_LABELS.index(mapped_label), B if prefix == 'B' else I] = 1.0
+    return projection
+
+
+def project_log_probs(log_probs, projection):
+    """
+    Maps model log-probabilities (..., model labels) to per-target-label O/B/I
+    log-probabilities (..., len(TARGET_LABELS), 3).
+    """
+    probs = np.tensordot(np.exp(np.asarray(log_probs, dtype=np.float32)), projection, axes=([-1], [0]))
+    probs[..., O] = 1.0 - probs[..., B] - probs[..., I]
+    return np.log(np.clip(probs, _MIN_PROB, 1.0))
+
+
+def viterbi_bio(log_probs, mask):
+    """
+    Most likely valid BIO sequence for many sequences at once.
+    Args:
+        log_probs (np.ndarray): (sequences, steps, 3) O/B/I log-probabilities.
+        mask (np.ndarray): (sequences, steps) bool; False steps (special and
+            padding tokens) are skipped and do not break a span.
+    Returns:
+        np.ndarray: int8 (sequences, steps) tag ids; skipped steps repeat the previous tag.
+    """
+    n, steps, _ = log_probs.shape
+    rows = np.arange(n)
+    # Start as if the sequence was preceded by O, so it cannot begin with I
+    score = np.tile(np.array([0.0, -np.inf, -np.inf], dtype=np.float32), (n, 1))
+    back = np.empty((steps, n, 3), dtype=np.int8)
+    keep = np.tile(np.arange(3, dtype=np.int8), (n, 1))
+    for t in range(steps):
+        # O and B may follow anything; I may only follow B or I
+        best_any = score.argmax(axis=1).astype(np.int8)
+        best_inside = np.where(score[:, I] > score[:, B], I, B).astype(np.int8)
+        previous = np.stack([best_any, best_any, best_inside], axis=1)
+        new_score = score[rows[:, None], previous] + log_probs[:, t]
+        active = mask[:, t][:, None]
+        score = np.where(active, new_score, score)
+        back[t] = np.where(active, previous, keep)
+    tags = np.empty((n, steps), dtype=np.int8)
+    state = score.argmax(axis=1)
+    for t in range(steps - 1, -1, -1):
+        tags[:, t] = state
+        state = back[t, rows, state]
+    return tags
+
+
+def decode_tags(label_log_probs, mask, method='viterbi'):
+    """
+    Decodes (rows, steps, len(TARGET_LABELS), 3) log-probabilities into
+    (rows, steps, len(TARGET_LABELS)) O/B/I tag ids, each label on its own.
+    """
+    rows, steps, labels, _ = label_log_probs.shape
+    if method == 'argmax':
+        return label_log_probs.argmax(axis=-1).astype(np.int8)
+    sequences = label_log_probs.transpose(0, 2, 1, 3).reshape(rows * labels, steps, 3)
+    sequence_mask = np.repeat(mask, labels, axis=0)
+    return viterbi_bio(sequences, sequence_mask).reshape(rows, labels, steps).transpose(0, 2, 1)
+
+
+def tags_to_spans(tags, offsets):
+    """
+    Turns (tokens, len(TARGET_LABELS)) O/B/I tag ids of real tokens into
+    (label, start, end) rows. An I that follows O starts a new span.
+    """
+    rows = []
+    for index, label in enumerate(TARGET_LABELS):
+        label_tags = tags[:, index]
+        inside = label_tags != O
+        previous = np.concatenate(([False], inside[:-1]))
+        starts = (label_tags == B) | (inside & ~previous)
+        positions = np.flatnonzero(inside)
+        span_ids = np.cumsum(starts)[positions]
+        last = positions[np.concatenate((span_ids[1:] != span_ids[:-1], [True]))] if len(positions) else positions
+        first = np.flatnonzero(starts)
+        rows.extend((label, int(s), int(e)) for s, e in zip(offsets[first, 0], offsets[last, 1]))
+    return rows
+
+
+def count_invalid(tags, mask):
+    """Number of I tags that follow O (or start a sequence) among the real tokens."""
+    invalid = 0
+    for row_tags, row_mask in zip(tags, mask):
+        real = row_tags[row_mask]
+        previous = np.concatenate((np.full((1, real.shape[1]), O, dtype=real.dtype), real[:-1]))
+        invalid += int(((real == I) & (previous == O)).sum())
+    return invalid
+
+
+def logits_path(model_name, token_store_path, logits_dir=DEFAULT_LOGITS_DIR):
+    return os.path.join(logits_dir, f"{model_name.replace('/', '__')}-{os.path.basename(token_store_path)}")
+
+
+def store_log_probs(model_name, token_store, logits_dir=DEFAULT_LOGITS_DIR, batch_size=16, traced=False):
+    """
+    Runs a token classifier over every row of a token store and saves its
+    log-probabilities as (rows, width, model labels) float16. With `traced`, the
+    TorchScript graph of the model's artifact is run when it has one.
+    Returns:
+        str: Directory holding log_probs.npy and meta.json.
+    """
+    import torch
+    from model_artifact import load_ner_model
+
+    path = logits_path(model_name, token_store.path, logits_dir)
+    os.makedirs(path, exist_ok=True)
+    model, _ = load_ner_model(model_name, traced=traced)
+    id2label = {int(i): label for i, label in model.config.id2label.items()}
+    log_probs = np.lib.format.open_memmap(os.path.join(path, 'log_probs.npy'), mode='w+', dtype=np.float16,
+                                          shape=token_store.input_ids.shape + (len(id2label),))
+    with torch.inference_mode():
+        for rows, input_ids, attention_mask, _ in token_store.batches(batch_size):
+            logits = model(input_ids=torch.from_numpy(np.asarray(input_ids, dtype=np.int64)),
+                           attention_mask=torch.from_numpy(np.asarray(attention_mask, dtype=np.int64))).logits
+            log_probs[rows, :logits.shape[1]] = logits.log_softmax(-1).numpy()
+    log_probs.flush()
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'model': model_name, 'token_store': token_store.path, 'id2label': id2label}, f, indent=2)
+    return path
+
+
+def load_log_probs(path):
+    """Returns (memory-mapped log-probabilities, id2label) saved by `store_log_probs`."""
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    id2label = {int(i): label for i, label in meta['id2label'].items()}
+    return np.load(os.path.join(path, 'log_probs.npy'), mmap_mode='r'), id2label
+
+
+def decode_corpus(log_probs, projection, token_store, doc_ids, method='viterbi', batch_size=256):
+    """
+    Decodes the stored outputs of `doc_ids`, `batch_size` posts at a time. The
+    windows of a long post are first merged into one token sequence
+    (TokenStore.doc_tokens), so tokens in the overlap of two windows are decoded
+    once and do not produce duplicate or conflicting spans.
+    Returns:
+        (dict, int): doc_id -> list of (label, start, end) rows, and the number of
+        invalid I-after-O tags among the decoded tags.
+    """
+    doc_rows = {}
+    invalid = 0
+    for i in range(0, len(doc_ids), batch_size):
+        batch = doc_ids[i:i + batch_size]
+        tokens = [token_store.doc_tokens(doc_id) for doc_id in batch]
+        width = max((len(rows) for rows, _ in tokens), default=0)
+        model_log_probs = np.zeros((len(batch), width, log_probs.shape[-1]), dtype=np.float32)
+        offsets = np.zeros((len(batch), width, 2), dtype=np.int64)
+        # Padding is past each post's length
+        mask = np.zeros((len(batch), width), dtype=bool)
+        for j, (rows, positions) in enumerate(tokens):
+            model_log_probs[j, :len(rows)] = log_probs[rows, positions]
+            offsets[j, :len(rows)] = token_store.offset_mapping[rows, positions]
+            mask[j, :len(rows)] = True
+        tags = decode_tags(project_log_probs(model_log_probs, projection), mask, method)
+        invalid += count_invalid(tags, mask)
+        for doc_id, doc_tags, doc_offsets, doc_mask in zip(batch, tags, offsets, mask):
+            doc_rows[doc_id] = tags_to_spans(doc_tags[doc_mask], doc_offsets[doc_mask])
+    return doc_rows, invalid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store model log-probabilities once and decode them into BIO spans.')
+    parser.add_argument('command', choices=['store', 'decode'])
+    parser.add_argument('--model', default='d4data/biomedical-ner-all')
+    parser.add_argument('--method', choices=['viterbi', 'argmax'], default='viterbi')
+    parser.add_argument('--all', action='store_true', help='Decode the whole corpus instead of the step5 sample')
+    parser.add_argument('--batch-size', type=int, default=256, help='Posts decoded at once')
+    parser.add_argument('--out-dir', default=DEFAULT_OUT_DIR)
+    parser.add_argument('--traced', action='store_true', help="store: run the artifact's TorchScript graph")
+    args = parser.parse_args()
+
+    corpus = open_corpus()
+    token_store = open_token_store(args.model, corpus)
+    if args.command == 'store':
+        print(f'Running {args.model} over {len(token_store.row_doc)} rows...')
+        print(f'Saved {store_log_probs(args.model, token_store, traced=args.traced)}')
+        return
+
+    # Only needed for decoding. batch_generate_predicted_spans imports transformers
+    # inside load_ner_pipeline, so decoding runs without torch or transformers
+    from batch_generate_predicted_spans import entity_map, read_sampled_files, write_predicted_spans
+    from incremental_eval import MODES, score_predictions
+
+    log_probs, id2label = load_log_probs(logits_path(args.model, token_store.path))
+    projection = label_projection(id2label, entity_map)
+    sample = [f.replace('.txt', '') for f in read_sampled_files() if f.replace('.txt', '') in token_store]
+    doc_ids = list(token_store.doc_ids) if args.all else sample
+
+    start = time.perf_counter()
+    doc_rows, invalid = decode_corpus(log_probs, projection, token_store, doc_ids, args.method, args.batch_size)
+    elapsed = time.perf_counter() - start
+    spans = sum(len(rows) for rows in doc_rows.values())
+    print(f'{args.method}: decoded {len(doc_ids)} posts ({spans} spans) in {elapsed:.2f}s; '
+          f'{invalid} invalid I-after-O tags')
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for doc_id in sample:
+        write_predicted_spans(doc_id, SpanTable.from_rows(doc_rows[doc_id]).to_rows(text=corpus.text(doc_id)),
+                              args.out_dir)
+    metrics = score_predictions(sample, args.out_dir)
+    print('Step5 sample macro F1: ' + ', '.join(f"{mode}={metrics[mode]['macro_doc'][2]:.3f}" for mode in MODES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import os
+import hashlib
+import argparse
+
+import numpy as np
+
+from spans import LABELS
+from incremental_eval import MODES, DEFAULT_CACHE_FILE, load_cache, save_cache, update_counts, count_matrix, prf
+
+# Bootstrap confidence intervals and paired significance tests for the step5 metrics.
+#
+# Everything works on per-document count arrays of shape (n_docs, n_labels, 3)
+# holding tp, fp, fn (see incremental_eval.count_matrix). A bootstrap resample
+# of the documents is a row of "multiplicities" (how often each document was
+# drawn), so all resamples at once are a (resamples, n_docs) matrix W and the
+# resampled counts are one matrix product W @ counts. Macro-over-documents
+# scores are averages of per-document scores, so they are W @ doc_scores / n_docs.
+#
+# Metrics (same definitions as incremental_eval.corpus_metrics):
+#   micro       - P/R/F1 of the pooled counts
+#   macro_doc   - average of per-document P/R/F1 (the step5 "Macro" numbers)
+#   macro_label - average of per-label micro P/R/F1 over the labels present
+#   <label>     - micro P/R/F1 of one label
+
+DEFAULT_RESAMPLES = 10000
+CHUNK_SIZE = 2000
+
+
+def resample_weights(n_docs, n_resamples, rng):
+    """
+    Draws bootstrap resamples of `n_docs` documents as a multiplicity matrix.
+    Returns:
+        np.ndarray: float64 array (n_resamples, n_docs); entry [r, d] is how many
+        times document d was drawn in resample r. Each row sums to n_docs.
+    """
+    draws = rng.integers(0, n_docs, size=(n_resamples, n_docs))
+    draws += np.arange(n_resamples)[:, None] * n_docs
+    return np.bincount(draws.ravel(), minlength=n_resamples * n_docs).reshape(n_resamples, n_docs).astype(np.float64)
+
+
+def _metric_names():
+    return ['micro', 'macro_doc', 'macro_label'] + list(LABELS)
+
+
+def _metrics_from_pooled(pooled, macro_doc, present):
+    """Builds the metric dict from (R, n_labels, 3) pooled counts and (R, 3) macro_doc scores."""
+    label_scores = np.stack(prf(pooled[..., 0], pooled[..., 1], pooled[..., 2]), axis=-1)  # (R, L, 3)
+    totals = pooled.sum(axis=1)
+    metrics = {
+        'micro': np.stack(prf(totals[:, 0], totals[:, 1], totals[:, 2]), axis=-1),
+        'macro_doc': macro_doc,
+        'macro_label': label_scores[:, present].mean(axis=1) if present.any() else np.zeros((len(pooled), 3)),
+    }
+    for i, label in enumerate(LABELS[:pooled.shape[1]]):
+        metrics[label] = label_scores[:, i]
+    return metrics
+
+
+def _doc_scores(counts):
+    """(n_docs, 3) precision, recall, f1 of each document (all labels pooled)."""
+    return np.stack(prf(*counts.sum(axis=1).T), axis=-1)
+
+
+def batch_metrics(weights, counts, present=None):
+    """
+    Computes every metric for many reweightings of the documents at once.
+    Args:
+        weights (np.ndarray): (n_resamples, n_docs) document weights, e.g. from `resample_weights`.
+        counts (np.ndarray): (n_docs, n_labels, 3) tp/fp/fn counts.
+        present (np.ndarray): Boolean mask of the labels averaged by macro_label;
+            defaults to the labels with any count in `counts`.
+    Returns:
+        dict: metric name -> (n_resamples, 3) array of precision, recall, f1.
+    """
+    n_docs, n_labels, _ = counts.shape
+    if present is None:
+        present = counts.sum(axis=(0, 2)) > 0
+    # (R, n) @ (n, L*3) -> pooled counts of every resample
+    pooled = (weights @ counts.reshape(n_docs, n_labels * 3).astype(np.float64)).reshape(len(weights), n_labels, 3)
+    return _metrics_from_pooled(pooled, weights @ _doc_scores(counts) / max(n_docs, 1), present)
+
+
+def bootstrap_ci(counts, n_resamples=DEFAULT_RESAMPLES, alpha=0.05, seed=0):
+    """
+    Percentile bootstrap confidence intervals over documents.
+    Args:
+        counts (np.ndarray): (n_docs, n_labels, 3) tp/fp/fn counts.
+        n_resamples (int): Number of bootstrap resamples.
+        alpha (float): 1 - confidence level.
+        seed (int): Random seed.
+    Returns:
+        dict: metric name -> {'precision'|'recall'|'f1': (point, low, high)}.
+            Labels with no gold or predicted spans are left out.
+    """
+    rng = np.random.default_rng(seed)
+    n_docs = len(counts)
+    present = counts.sum(axis=(0, 2)) > 0
+    point = batch_metrics(np.ones((1, n_docs)), counts, present)
+    samples = {name: [] for name in point}
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        weights = resample_weights(n_docs, min(CHUNK_SIZE, n_resamples - start), rng)
+        for name, values in batch_metrics(weights, counts, present).items():
+            samples[name].append(values)
+    results = {}
+    for name in _metric_names():
+        if name in LABELS and not present[LABELS.index(name)]:
+            continue
+        values = np.concatenate(samples[name])
+        low, high = np.quantile(values, [alpha / 2, 1 - alpha / 2], axis=0)
+        results[name] = {part: (float(point[name][0, i]), float(low[i]), float(high[i]))
+                         for i, part in enumerate(('precision', 'recall', 'f1'))}
+    return results
+
+
+def paired_tests(counts_a, counts_b, n_resamples=DEFAULT_RESAMPLES, alpha=0.05, seed=0):
+    """
+    Compares two prediction runs scored on the same documents.
+
+    Paired bootstrap: both runs are scored on the same resamples and the
+    p-value is twice the share of resamples where the F1 difference has the
+    other sign (or is zero). Approximate randomization: for every document the
+    two runs' counts are swapped with probability 1/2, and the p-value is the
+    share of shuffles whose absolute F1 difference is at least the observed one.
+    `alpha` is 1 - the confidence level of the bootstrap interval of the difference.
+    Returns:
+        dict: metric name -> {'delta': F1(b) - F1(a), 'ci': (low, high),
+            'p_bootstrap': float, 'p_randomization': float}.
+    """
+    if counts_a.shape != counts_b.shape:
+        raise ValueError('Both runs must be scored on the same documents')
+    rng = np.random.default_rng(seed)
+    n_docs = len(counts_a)
+    present = (counts_a.sum(axis=(0, 2)) > 0) | (counts_b.sum(axis=(0, 2)) > 0)
+    ones = np.ones((1, n_docs))
+    observed = {name: batch_metrics(ones, counts_b, present)[name][0, 2] - value[0, 2]
+                for name, value in batch_metrics(ones, counts_a, present).items()}
+    deltas = {name: [] for name in observed}
+    extreme = {name: 0 for name in observed}
+    n_labels = counts_a.shape[1]
+    total_a, total_b = counts_a.sum(axis=0).astype(np.float64), counts_b.sum(axis=0).astype(np.float64)
+    diff = (counts_b - counts_a).reshape(n_docs, n_labels * 3).astype(np.float64)
+    macro_a, macro_b = _doc_scores(counts_a).mean(axis=0), _doc_scores(counts_b).mean(axis=0)
+    diff_doc = _doc_scores(counts_b) - _doc_scores(counts_a)
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, n_resamples - start)
+        # Paired bootstrap: same multiplicities for both runs
+        weights = resample_weights(n_docs, size, rng)
+        metrics_a, metrics_b = batch_metrics(weights, counts_a, present), batch_metrics(weights, counts_b, present)
+        for name in observed:
+            deltas[name].append(metrics_b[name][:, 2] - metrics_a[name][:, 2])
+        # Approximate randomization: swap the runs on a random half of the documents.
+        # Swapped run A pools A + S(B - A) and swapped run B pools B - S(B - A),
+        # so one product S @ (B - A) scores all shuffles.
+        swap = (rng.random((size, n_docs)) < 0.5).astype(np.float64)
+        moved = (swap @ diff).reshape(size, n_labels, 3)
+        moved_doc = swap @ diff_doc / max(n_docs, 1)
+        shuffled_a = _metrics_from_pooled(total_a + moved, macro_a + moved_doc, present)
+        shuffled_b = _metrics_from_pooled(total_b - moved, macro_b - moved_doc, present)
+        for name in observed:
+            gap = np.abs(shuffled_b[name][:, 2] - shuffled_a[name][:, 2])
+            extreme[name] += int((gap >= abs(observed[name]) - 1e-12).sum())
+    results = {}
+    for name in _metric_names():
+        if name in LABELS and not present[LABELS.index(name)]:
+            continue
+        values = np.concatenate(deltas[name])
+        p_boot = 2 * min(np.mean(values <= 0), np.mean(values >= 0)) if observed[name] else 1.0
+        results[name] = {
+            'delta': float(observed[name]),
+            'ci': tuple(float(x) for x in np.quantile(values, [alpha / 2, 1 - alpha / 2])),
+            'p_bootstrap': float(min(p_boot, 1.0)),
+            'p_randomization': (extreme[name] + 1) / (n_resamples + 1),
+        }
+    return results
+
+
+def run_counts(doc_ids, pred_dir, mode, gold_dir='cadec/original'):
+    """
+    Per-document counts of the predictions in `pred_dir`, reusing the incremental
+    evaluation cache (one cache file per prediction directory).
+    Returns:
+        (list, np.ndarray): Evaluated doc ids and their (n_docs, n_labels, 3) counts.
+    """
+    if os.path.abspath(pred_dir) == os.path.abspath('.'):
+        cache_file = DEFAULT_CACHE_FILE
+    else:
+        digest = hashlib.sha1(os.path.abspath(pred_dir).encode('utf-8')).hexdigest()[:12]
+        cache_file = os.path.join(os.path.dirname(DEFAULT_CACHE_FILE), f'incremental_eval-{digest}.json')
+    cache = load_cache(cache_file)
+    update_counts(doc_ids, cache, gold_dir=gold_dir, pred_dir=pred_dir)
+    save_cache(cache, cache_file)
+    return count_matrix(cache, mode, doc_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals and paired tests for the step5 metrics.')
+    parser.add_argument('pred_dirs', nargs='*', default=['.'],
+                        help='One prediction directory for CIs, or two (baseline, candidate) for a paired test')
+    parser.add_argument('--files', default='step5_sampled_files.txt', help='List of .txt posts to evaluate')
+    parser.add_argument('--mode', choices=MODES, default='relaxed')
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if len(args.pred_dirs) > 2:
+        parser.error('give at most two prediction directories')
+
+    with open(args.files, 'r') as f:
+        doc_ids = [line.strip().replace('.txt', '') for line in f if line.strip()]
+
+    runs = [run_counts(doc_ids, pred_dir, args.mode) for pred_dir in args.pred_dirs]
+    if len(runs) == 1:
+        evaluated, counts = runs[0]
+        results = bootstrap_ci(counts, args.resamples, args.alpha, args.seed)
+        level = f'{1 - args.alpha:.0%}'
+        print(f"[{args.mode.upper()}] {len(evaluated)} posts, {args.resamples} resamples, {level} intervals")
+        for name, parts in results.items():
+            print(f"{name:<12} " + '  '.join(f"{short}={v:.3f} [{lo:.3f}, {hi:.3f}]"
+                                              for short, (v, lo, hi) in zip(('P', 'R', 'F1'), parts.values())))
+        return
+
+    # Paired comparison on the documents both runs have predictions for
+    rows_a, rows_b = ({d: i for i, d in enumerate(evaluated)} for evaluated, _ in runs)
+    shared = [d for d in runs[0][0] if d in rows_b]
+    counts_a = runs[0][1][[rows_a[d] for d in shared]]
+    counts_b = runs[1][1][[rows_b[d] for d in shared]]
+    results = paired_tests(counts_a, counts_b, args.resamples, args.alpha, args.seed)
+    level = f'{1 - args.alpha:.0%}'
+    print(f"[{args.mode.upper()}] {args.pred_dirs[1]} vs {args.pred_dirs[0]} on {len(shared)} posts, "
+          f"{args.resamples} resamples")
+    print(f"{'metric':<12} {'dF1':>7} {level + ' CI':>17} {'p(boot)':>8} {'p(rand)':>8}")
+    for name, r in results.items():
+        low, high = r['ci']
+        print(f"{name:<12} {r['delta']:>+7.3f} [{low:>+6.3f}, {high:>+6.3f}] {r['p_bootstrap']:>8.4f} {r['p_randomization']:>8.4f}")
+
+
+if __name__ == '__main__':
+    main()
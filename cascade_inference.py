@@ -0,0 +1,217 @@
+import os
+import re
+import time
+import argparse
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from batch_generate_predicted_spans import (load_ner_pipeline, postprocess_ner_results, get_mapped_labels,
+                                            read_sampled_files, write_predicted_spans)
+from bio_decoding import TARGET_LABELS
+from corpus_store import open_corpus
+from incremental_eval import MODES, score_predictions
+from spans import SpanTable
+from tokenization_store import WORD_PATTERN
+
+# Confidence-gated cascade inference.
+#
+# Tier 1 is a lexicon tagger learned from the cadec/original annotations of the
+# training posts: it tags known ADR/Drug/Disease/Symptom phrases by greedy
+# longest match and estimates how sure it is about each sentence. Only the
+# sentences whose confidence is below a threshold are sent to tier 2, the
+# transformer NER pipeline of the batch script.
+#
+# Only the labels step5 scores (TARGET_LABELS) are learned: 'Finding'
+# annotations never become lexicon phrases and their words count as outside any
+# entity, so they only lower the purity and entity rates of what they overlap.
+#
+# Sentence confidence is the lowest of:
+#   - the label purity of each matched phrase (share of its majority label), and
+#   - 1 - entity rate of each unmatched word, i.e. how rarely that word is part
+#     of an annotated entity in the training posts (unseen words use a prior).
+#
+# 'run' routes with one threshold and writes the usual prediction files;
+# 'sweep' also runs the transformer on every sentence once, then reports for
+# each threshold the share of text sent to the transformer and the step5 F1.
+
+SENTENCE_PATTERN = re.compile(r'[^.!?\n]+[.!?]*')
+MAX_PHRASE_WORDS = 6
+DEFAULT_OUT_DIR = 'cascade_predictions'
+
+
+class LexiconTagger:
+    """
+    Lexicon/frequency model over the CADEC vocabulary.
+    Args:
+        unknown_word_rate (float): Entity rate assumed for words never seen in training.
+    """
+
+    def __init__(self, unknown_word_rate=0.2):
+        self.unknown_word_rate = unknown_word_rate
+        self.phrases = {}
+        self.word_rate = {}
+
+    def fit(self, doc_ids, corpus, gold_dir='cadec/original'):
+        phrase_labels = defaultdict(Counter)
+        in_entity = Counter()
+        total = Counter()
+        for doc_id in doc_ids:
+            ann_file = os.path.join(gold_dir, doc_id + '.ann')
+            if doc_id not in corpus or not os.path.exists(ann_file):
+                continue
+            text = corpus.text(doc_id)
+            covered = np.zeros(len(text) + 1, dtype=bool)
+            with open(ann_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.strip().split('\t')
+                    if len(parts) < 3 or not parts[0].startswith('T'):
+                        continue
+                    label, _, ranges = parts[1].partition(' ')
+                    words = tuple(w.lower() for w in WORD_PATTERN.findall(parts[2]))
+                    if words and len(words) <= MAX_PHRASE_WORDS:
+                        phrase_labels[words][label] += 1
+                    if label not in TARGET_LABELS:
+                        continue
+                    for fragment in ranges.split(';'):
+                        start, end = fragment.split()
+                        covered[int(start):int(end)] = True
+            for match in WORD_PATTERN.finditer(text):
+                word = match.group().lower()
+                total[word] += 1
+                in_entity[word] += bool(covered[match.start()])
+        self.phrases = {}
+        for words, counts in phrase_labels.items():
+            targets = [(label, count) for label, count in counts.most_common() if label in TARGET_LABELS]
+            if not targets:
+                continue
+            label, count = targets[0]
+            self.phrases[words] = (label, count / sum(counts.values()))
+        self.word_rate = {word: in_entity[word] / total[word] for word in total}
+        return self
+
+    def tag(self, text, offset=0):
+        """
+        Tags one sentence.
+        Returns:
+            (list, float): [(label, start, end)] spans with offsets shifted by
+            `offset`, and the sentence confidence in [0, 1].
+        """
+        matches = list(WORD_PATTERN.finditer(text))
+        words = [m.group().lower() for m in matches]
+        spans = []
+        confidence = 1.0
+        i = 0
+        while i < len(words):
+            for n in range(min(MAX_PHRASE_WORDS, len(words) - i), 0, -1):
+                hit = self.phrases.get(tuple(words[i:i + n]))
+                if hit is not None:
+                    label, purity = hit
+                    spans.append((label, offset + matches[i].start(), offset + matches[i + n - 1].end()))
+                    confidence = min(confidence, purity)
+                    i += n
+                    break
+            else:
+                confidence = min(confidence, 1.0 - self.word_rate.get(words[i], self.unknown_word_rate))
+                i += 1
+        return spans, confidence
+
+
+def split_sentences(text):
+    """Returns (start, sentence) pairs covering the non-empty sentences of a post."""
+    return [(m.start(), m.group()) for m in SENTENCE_PATTERN.finditer(text) if m.group().strip()]
+
+
+def transformer_spans(ner_pipeline, sentence, offset):
+    """Runs the transformer on one sentence; returns mapped (label, start, end) spans in post offsets."""
+    spans = []
+    for entity in postprocess_ner_results(ner_pipeline(sentence), sentence):
+        for label in get_mapped_labels(entity['entity_group']) or []:
+            spans.append((label, offset + entity['start'], offset + entity['end']))
+    return spans
+
+
+def cascade_post(text, tagger, ner_pipeline, threshold, stats):
+    """Runs the cascade over one post, updating the per-tier `stats` counters."""
+    rows = []
+    for offset, sentence in split_sentences(text):
+        spans, confidence = tagger.tag(sentence, offset)
+        if confidence >= threshold:
+            rows.extend(spans)
+            stats['lexicon_sentences'] += 1
+            stats['lexicon_chars'] += len(sentence)
+        else:
+            start = time.perf_counter()
+            rows.extend(transformer_spans(ner_pipeline, sentence, offset))
+            stats['transformer_seconds'] += time.perf_counter() - start
+            stats['transformer_sentences'] += 1
+            stats['transformer_chars'] += len(sentence)
+    return SpanTable.from_rows(rows).to_rows(text=text)
+
+
+def print_routing(stats):
+    sentences = stats['lexicon_sentences'] + stats['transformer_sentences']
+    chars = stats['lexicon_chars'] + stats['transformer_chars']
+    for tier in ('lexicon', 'transformer'):
+        print(f"{tier:<12} {stats[tier + '_sentences']:>6} sentences "
+              f"({stats[tier + '_sentences'] / max(sentences, 1):.1%}), "
+              f"{stats[tier + '_chars'] / max(chars, 1):.1%} of text")
+    print(f"Transformer time: {stats['transformer_seconds']:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lexicon-first cascade in front of the transformer NER model.')
+    parser.add_argument('command', choices=['run', 'sweep'])
+    parser.add_argument('--threshold', type=float, default=0.9, help='Minimum lexicon confidence to skip the transformer')
+    parser.add_argument('--thresholds', default='0,0.5,0.7,0.8,0.9,0.95,1.01', help='Thresholds for sweep')
+    parser.add_argument('--unknown-word-rate', type=float, default=0.2)
+    parser.add_argument('--out-dir', default=DEFAULT_OUT_DIR)
+    args = parser.parse_args()
+
+    corpus = open_corpus()
+    eval_docs = [f.replace('.txt', '') for f in read_sampled_files() if f.replace('.txt', '') in corpus]
+    held_out = set(eval_docs)
+    tagger = LexiconTagger(args.unknown_word_rate).fit([d for d in corpus.doc_ids if d not in held_out], corpus)
+    print(f'Lexicon: {len(tagger.phrases)} phrases, {len(tagger.word_rate)} words')
+    ner_pipeline = load_ner_pipeline()
+
+    if args.command == 'run':
+        os.makedirs(args.out_dir, exist_ok=True)
+        stats = Counter()
+        for doc_id in eval_docs:
+            text = corpus.text(doc_id)
+            write_predicted_spans(doc_id, cascade_post(text, tagger, ner_pipeline, args.threshold, stats), args.out_dir)
+        print(f'\n--- Routing at threshold {args.threshold} ---')
+        print_routing(stats)
+        return
+
+    # sweep: tag and run the transformer on every sentence once, then replay each threshold
+    sentences = {}
+    for doc_id in eval_docs:
+        text = corpus.text(doc_id)
+        sentences[doc_id] = [(len(sentence), *tagger.tag(sentence, offset),
+                              transformer_spans(ner_pipeline, sentence, offset))
+                             for offset, sentence in split_sentences(text)]
+
+    print(f"\n{'threshold':>9} {'to model':>9} {'text':>7}  " + '  '.join(f'{m} F1' for m in MODES))
+    for threshold in (float(t) for t in args.thresholds.split(',')):
+        pred_dir = os.path.join(args.out_dir, 'sweep', f'{threshold:g}')
+        os.makedirs(pred_dir, exist_ok=True)
+        routed = total = routed_chars = total_chars = 0
+        for doc_id, doc_sentences in sentences.items():
+            rows = []
+            for length, lexicon_spans, confidence, model_spans in doc_sentences:
+                use_model = confidence < threshold
+                rows.extend(model_spans if use_model else lexicon_spans)
+                routed += use_model
+                routed_chars += length if use_model else 0
+                total += 1
+                total_chars += length
+            write_predicted_spans(doc_id, SpanTable.from_rows(rows).to_rows(text=corpus.text(doc_id)), pred_dir)
+        metrics = score_predictions(eval_docs, pred_dir)
+        f1s = '  '.join(f"{metrics[mode]['macro_doc'][2]:.3f}".rjust(len(mode) + 3) for mode in MODES)
+        print(f'{threshold:>9g} {routed / max(total, 1):>9.1%} {routed_chars / max(total_chars, 1):>7.1%}  {f1s}')
+
+
+if __name__ == '__main__':
+    main()
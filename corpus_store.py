@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import mmap
+import hashlib
+
+import numpy as np
+
+# Packed, memory-mapped version of cadec/text.
+#
+# Instead of reopening one .txt file per post, all posts are concatenated into a
+# single UTF-8 buffer that is memory-mapped read-only:
+#   corpus.bin   - the concatenated posts
+#   offsets.npy  - int64 table, one row per post: byte_start, byte_end, char_start, char_end
+#   doc_ids.txt  - one doc id per line (file name without '.txt'), in the same order
+#   version.txt  - hash of the packed contents, used as the corpus version
+#   stamps.json  - (file name, size, mtime) of every source file at packing time
+#
+# Opening the corpus only maps the buffer and loads the small offsets table, so
+# text is only decoded when asked for. Spans are kept as (doc, start, end)
+# columns by spans.SpanTable, which slices their text only when writing rows.
+# open_corpus() stats the source directory and repacks when a file was added,
+# removed or modified since, so the version (and the caches keyed on it) follow
+# edits to cadec/text.
+
+DEFAULT_TEXT_DIR = 'cadec/text'
+DEFAULT_CORPUS_DIR = 'cadec/packed'
+STAMPS_FILE = 'stamps.json'
+
+
+def source_stamps(text_dir=DEFAULT_TEXT_DIR):
+    """
+    Returns [file name, size, mtime in ns] for every .txt file of `text_dir`, sorted
+    by name. Only stats the files, so comparing stamps is cheap next to hashing them.
+    """
+    stamps = []
+    for filename in sorted(f for f in os.listdir(text_dir) if f.endswith('.txt')):
+        stat = os.stat(os.path.join(text_dir, filename))
+        stamps.append([filename, stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+def is_stale(corpus_dir=DEFAULT_CORPUS_DIR, text_dir=DEFAULT_TEXT_DIR):
+    """
+    Returns True if the packed corpus is missing or was packed from a different
+    state of `text_dir` (files added, removed, resized or touched).
+    """
+    stamps_path = os.path.join(corpus_dir, STAMPS_FILE)
+    if not os.path.exists(os.path.join(corpus_dir, 'version.txt')) or not os.path.exists(stamps_path):
+        return True
+    if not os.path.isdir(text_dir):
+        # Only the packed corpus was shipped, nothing to compare against
+        return False
+    with open(stamps_path, 'r', encoding='utf-8') as f:
+        return json.load(f) != source_stamps(text_dir)
+
+
+def build_corpus(text_dir=DEFAULT_TEXT_DIR, out_dir=DEFAULT_CORPUS_DIR):
+    """
+    Packs every .txt file of `text_dir` into a memory-mappable corpus in `out_dir`.
+    Offsets are relative to the raw file contents, the same offsets used by the .ann files.
+    Returns:
+        str: The corpus version (sha1 of doc ids and contents).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(out_dir, STAMPS_FILE)):
+        os.remove(os.path.join(out_dir, STAMPS_FILE))
+    stamps = source_stamps(text_dir)
+    filenames = [filename for filename, _, _ in stamps]
+    offsets = np.zeros((len(filenames), 4), dtype=np.int64)
+    digest = hashlib.sha1()
+    byte_pos = char_pos = 0
+    with open(os.path.join(out_dir, 'corpus.bin'), 'wb') as out:
+        for i, filename in enumerate(filenames):
+            with open(os.path.join(text_dir, filename), 'r', encoding='utf-8') as f:
+                text = f.read()
+            data = text.encode('utf-8')
+            out.write(data)
+            digest.update(filename.encode('utf-8') + b'\0' + data)
+            offsets[i] = (byte_pos, byte_pos + len(data), char_pos, char_pos + len(text))
+            byte_pos += len(data)
+            char_pos += len(text)
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(out_dir, 'doc_ids.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(filename[:-len('.txt')] for filename in filenames) + '\n')
+    version = digest.hexdigest()
+    with open(os.path.join(out_dir, 'version.txt'), 'w', encoding='utf-8') as f:
+        f.write(version + '\n')
+    # Written last: a build interrupted before this point is rebuilt on next open
+    with open(os.path.join(out_dir, STAMPS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(stamps, f)
+    return version
+
+
+class Corpus:
+    """
+    Read-only view over a packed corpus built by `build_corpus`.
+    Args:
+        corpus_dir (str): Directory containing corpus.bin, offsets.npy and doc_ids.txt.
+    """
+
+    def __init__(self, corpus_dir=DEFAULT_CORPUS_DIR):
+        self.corpus_dir = corpus_dir
+        with open(os.path.join(corpus_dir, 'doc_ids.txt'), 'r', encoding='utf-8') as f:
+            self.doc_ids = [line.rstrip('\n') for line in f if line.strip()]
+        with open(os.path.join(corpus_dir, 'version.txt'), 'r', encoding='utf-8') as f:
+            self.version = f.read().strip()
+        self.offsets = np.load(os.path.join(corpus_dir, 'offsets.npy'), mmap_mode='r')
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self._file = open(os.path.join(corpus_dir, 'corpus.bin'), 'rb')
+        # mmap cannot map an empty file
+        if os.fstat(self._file.fileno()).st_size:
+            self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b''
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_index
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self._file.close()
+
+    def _row(self, doc_id):
+        return self.offsets[self.doc_index[doc_id]]
+
+    def raw(self, doc_id):
+        """Returns the UTF-8 bytes of a post as a zero-copy memoryview."""
+        byte_start, byte_end, _, _ = self._row(doc_id)
+        return memoryview(self.buffer)[byte_start:byte_end]
+
+    def text(self, doc_id):
+        """Returns the full text of a post."""
+        return str(self.raw(doc_id), 'utf-8')
+
+    def slice(self, doc_id, start, end):
+        """Returns the text between character offsets `start` and `end` of a post."""
+        byte_start, byte_end, char_start, char_end = self._row(doc_id)
+        if byte_end - byte_start == char_end - char_start:
+            # Pure ASCII post: character offsets are byte offsets, decode only the slice
+            return str(self.buffer[byte_start + start:byte_start + min(end, byte_end - byte_start)], 'utf-8')
+        return self.text(doc_id)[start:end]
+
+
+def open_corpus(corpus_dir=DEFAULT_CORPUS_DIR, text_dir=DEFAULT_TEXT_DIR):
+    """
+    Opens the packed corpus, (re)building it from `text_dir` first if it does not
+    exist yet or `text_dir` changed since it was packed.
+    Returns:
+        Corpus: The opened corpus.
+    """
+    if is_stale(corpus_dir, text_dir):
+        print(f'Packing {text_dir} into {corpus_dir} ...')
+        build_corpus(text_dir, corpus_dir)
+    return Corpus(corpus_dir)
+
+
+def read_post(doc_id, corpus=None, text_dir=DEFAULT_TEXT_DIR):
+    """
+    Returns the text of a post from the packed corpus if one is given and
+    contains it, falling back to reading cadec/text/<doc_id>.txt.
+    """
+    if corpus is not None and doc_id in corpus:
+        return corpus.text(doc_id)
+    with open(os.path.join(text_dir, doc_id + '.txt'), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+if __name__ == '__main__':
+    # Usage: python corpus_store.py [text_dir] [corpus_dir]
+    text_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TEXT_DIR
+    corpus_dir = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CORPUS_DIR
+    version = build_corpus(text_dir, corpus_dir)
+    corpus = Corpus(corpus_dir)
+    print(f'Packed {len(corpus)} posts ({len(corpus.buffer)} bytes) into {corpus_dir}, version {version[:12]}')
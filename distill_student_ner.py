@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoTokenizer, AutoModelForTokenClassification
+
+from batch_generate_predicted_spans import MODEL_NAME as TEACHER_NAME, entity_map, read_sampled_files, write_predicted_spans
+from bio_decoding import TARGET_LABELS
+from corpus_store import open_corpus
+from incremental_eval import MODES, score_predictions
+from spans import SpanTable
+from tokenization_store import open_token_store
+
+# Distils d4data/biomedical-ner-all (the teacher) into a much smaller student
+# token classifier that predicts our four target labels directly.
+#
+#   teacher  - runs the teacher over every post once and stores its soft labels,
+#              projected onto the target BIO tags with the same entity_map as the
+#              batch script (Sign_symptom -> Symptom/ADR share the probability)
+#   train    - builds the student from the teacher's embeddings and first layers,
+#              and trains it on the soft labels plus the cadec/original gold tags
+#   evaluate - times teacher and student on the step5 sample (CPU) and scores both
+#              against cadec/original with the step5 metrics
+#
+# The student shares the teacher's tokenizer, so both read the same token store.
+# The held-out step5 sample is never used for training.
+
+TAGS = ['O'] + [f'{prefix}-{label}' for label in TARGET_LABELS for prefix in ('B', 'I')]
+TAG_INDEX = {tag: i for i, tag in enumerate(TAGS)}
+IGNORE_INDEX = -100
+DEFAULT_OUT_DIR = 'student_ner'
+
+
+def projection_matrix(id2label):
+    """
+    Returns a (teacher labels, TAGS) matrix that maps teacher BIO probabilities to
+    target BIO probabilities. A teacher label mapped to several target labels
+    spreads its probability evenly over them; unmapped labels go to 'O'.
+    """
+    projection = np.zeros((len(id2label), len(TAGS)), dtype=np.float32)
+    for i, label in id2label.items():
+        prefix, _, group = label.partition('-')
+        mapped = entity_map.get(group) if prefix in ('B', 'I') else None
+        if not mapped:
+            projection[int(i), TAG_INDEX['O']] = 1.0
+            continue
+        for mapped_label in mapped:
+            projection[int(i), TAG_INDEX[f'{prefix}-{mapped_label}']] += 1.0 / len(mapped)
+    return projection
+
+
+def read_gold_fragments(ann_file):
+    """Reads (label, start, end) for every fragment of the target-label entities of a .ann file."""
+    fragments = []
+    with open(ann_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) < 3 or not parts[0].startswith('T'):
+                continue
+            label, _, ranges = parts[1].partition(' ')
+            if label not in TARGET_LABELS:
+                continue
+            for fragment in ranges.split(';'):
+                start, end = fragment.split()
+                fragments.append((label, int(start), int(end)))
+    return fragments
+
+
+def gold_tag_ids(offsets, length, fragments):
+    """BIO tag ids of one token row from gold fragments; special and padding tokens are ignored."""
+    tags = np.full(len(offsets), IGNORE_INDEX, dtype=np.int64)
+    starts, ends = offsets[:length, 0], offsets[:length, 1]
+    real = ends > starts
+    tags[:length][real] = TAG_INDEX['O']
+    for label, start, end in fragments:
+        inside = np.flatnonzero(real & (starts >= start) & (ends <= end))
+        if len(inside):
+            tags[inside[0]] = TAG_INDEX[f'B-{label}']
+            tags[inside[1:]] = TAG_INDEX[f'I-{label}']
+    return tags
+
+
+def decode_bio(tag_names, offsets, length):
+    """
+    Greedy BIO decoding of one token row into (group, start, end) character spans.
+    An I- tag that does not continue a span of the same group starts a new one.
+    """
+    spans = []
+    current = None
+    for t in range(length):
+        start, end = int(offsets[t, 0]), int(offsets[t, 1])
+        if end <= start:
+            continue  # special token
+        prefix, _, group = tag_names[t].partition('-')
+        if not group:
+            current = None
+            continue
+        if prefix == 'I' and current is not None and current[0] == group:
+            current[2] = end
+        else:
+            current = [group, start, end]
+            spans.append(current)
+    return spans
+
+
+def to_tensor(array):
+    return torch.from_numpy(np.asarray(array, dtype=np.int64))
+
+
+def run_teacher(store, out_dir, batch_size=16):
+    """Stores the teacher's soft labels, projected onto TAGS, for every token row (float16)."""
+    teacher = AutoModelForTokenClassification.from_pretrained(TEACHER_NAME).eval()
+    projection = torch.from_numpy(projection_matrix(teacher.config.id2label))
+    shape = store.input_ids.shape
+    soft = np.lib.format.open_memmap(os.path.join(out_dir, 'teacher_soft.npy'), mode='w+',
+                                     dtype=np.float16, shape=shape + (len(TAGS),))
+    with torch.inference_mode():
+        for rows, input_ids, attention_mask, _ in store.batches(batch_size):
+            probs = teacher(input_ids=to_tensor(input_ids), attention_mask=to_tensor(attention_mask)).logits.softmax(-1)
+            soft[rows, :probs.shape[1]] = (probs @ projection).numpy()
+    soft.flush()
+
+
+def build_student(num_layers=2):
+    """
+    Builds the student: the teacher architecture cut down to `num_layers`
+    transformer layers with a TAGS-sized classifier, initialized from the
+    teacher's embeddings and first layers.
+    """
+    teacher = AutoModelForTokenClassification.from_pretrained(TEACHER_NAME)
+    config = AutoConfig.from_pretrained(TEACHER_NAME, num_labels=len(TAGS),
+                                        id2label=dict(enumerate(TAGS)), label2id=TAG_INDEX)
+    config.num_hidden_layers = num_layers
+    student = AutoModelForTokenClassification.from_config(config)
+    student_state = student.state_dict()
+    initial = {key: value for key, value in teacher.state_dict().items()
+               if key in student_state and value.shape == student_state[key].shape}
+    student.load_state_dict(initial, strict=False)
+    return student
+
+
+def train_student(student, store, soft, gold, train_rows, epochs=3, batch_size=16, lr=5e-5,
+                  alpha=0.5, temperature=2.0):
+    """
+    Trains the student on a mix of the distillation loss (KL to the teacher's
+    temperature-softened soft labels) and cross-entropy on the gold tags.
+    """
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+    rng = np.random.default_rng(0)
+    student.train()
+    for epoch in range(epochs):
+        order = rng.permutation(train_rows)
+        total = 0.0
+        for i in range(0, len(order), batch_size):
+            batch = np.sort(order[i:i + batch_size])
+            width = int(store.lengths[batch].max())
+            logits = student(input_ids=to_tensor(store.input_ids[batch, :width]),
+                             attention_mask=to_tensor(store.attention_mask[batch, :width])).logits
+            target_gold = torch.from_numpy(gold[batch, :width])
+            valid = target_gold != IGNORE_INDEX
+            if not valid.any():
+                continue
+            target_soft = torch.from_numpy(np.asarray(soft[batch, :width], dtype=np.float32))[valid]
+            teacher_probs = F.softmax(torch.log(target_soft.clamp_min(1e-6)) / temperature, dim=-1)
+            kd_loss = F.kl_div(F.log_softmax(logits[valid] / temperature, dim=-1), teacher_probs,
+                               reduction='batchmean') * temperature ** 2
+            ce_loss = F.cross_entropy(logits[valid], target_gold[valid])
+            loss = alpha * kd_loss + (1 - alpha) * ce_loss
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(batch)
+        print(f'Epoch {epoch + 1}/{epochs}: loss {total / max(len(order), 1):.4f}')
+    student.eval()
+    return student
+
+
+def predict_tags(model, store, doc_ids, batch_size=16):
+    """Runs a token classifier over the rows of `doc_ids`; returns ({row: argmax tag ids}, seconds spent)."""
+    tags = {}
+    elapsed = 0.0
+    with torch.inference_mode():
+        for rows, input_ids, attention_mask, _ in store.batches(batch_size, doc_ids):
+            start = time.perf_counter()
+            logits = model(input_ids=to_tensor(input_ids), attention_mask=to_tensor(attention_mask)).logits
+            elapsed += time.perf_counter() - start
+            for row, row_tags in zip(rows, logits.argmax(-1).numpy()):
+                tags[int(row)] = row_tags
+    return tags, elapsed
+
+
+def write_doc_predictions(store, corpus, doc_ids, tags, tag_names, out_dir, label_map=None):
+    """
+    Decodes per-row tag ids into the standard [label, start, end, text] JSON files,
+    one per post. The windows of a long post are merged first (TokenStore.doc_tokens),
+    so the tokens they share are decoded once.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for doc_id in doc_ids:
+        rows = []
+        token_rows, positions = store.doc_tokens(doc_id)
+        names = [tag_names[int(tags[row][position])] for row, position in zip(token_rows, positions)]
+        offsets = store.offset_mapping[token_rows, positions]
+        for group, start, end in decode_bio(names, offsets, len(names)):
+            for label in ((label_map.get(group) or []) if label_map is not None else [group]):
+                rows.append((label, start, end))
+        write_predicted_spans(doc_id, SpanTable.from_rows(rows).to_rows(text=corpus.text(doc_id)), out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distil the biomedical NER teacher into a small CPU student.')
+    parser.add_argument('steps', nargs='*', default=['teacher', 'train', 'evaluate'],
+                        choices=['teacher', 'train', 'evaluate'])
+    parser.add_argument('--out-dir', default=DEFAULT_OUT_DIR)
+    parser.add_argument('--layers', type=int, default=2, help='Transformer layers in the student')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--lr', type=float, default=5e-5)
+    parser.add_argument('--alpha', type=float, default=0.5, help='Weight of the distillation loss vs gold')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.out_dir, exist_ok=True)
+    corpus = open_corpus()
+    store = open_token_store(TEACHER_NAME, corpus)
+    eval_docs = [f.replace('.txt', '') for f in read_sampled_files() if f.replace('.txt', '') in store]
+    model_dir = os.path.join(args.out_dir, 'model')
+
+    if 'teacher' in args.steps:
+        print('Running the teacher over the corpus...')
+        run_teacher(store, args.out_dir, args.batch_size)
+
+    if 'train' in args.steps:
+        soft = np.load(os.path.join(args.out_dir, 'teacher_soft.npy'), mmap_mode='r')
+        gold = np.full(store.input_ids.shape, IGNORE_INDEX, dtype=np.int64)
+        for doc_id in store.doc_ids:
+            ann_file = os.path.join('cadec/original', doc_id + '.ann')
+            fragments = read_gold_fragments(ann_file) if os.path.exists(ann_file) else []
+            for row in store.rows(doc_id):
+                gold[row] = gold_tag_ids(store.offset_mapping[row], store.lengths[row], fragments)
+        held_out = set(eval_docs)
+        train_rows = np.array([row for doc_id in store.doc_ids if doc_id not in held_out
+                               for row in store.rows(doc_id)], dtype=np.int64)
+        print(f'Training a {args.layers}-layer student on {len(train_rows)} rows...')
+        student = build_student(args.layers)
+        train_student(student, store, soft, gold, train_rows, args.epochs, args.batch_size, args.lr,
+                      args.alpha, args.temperature)
+        student.save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(TEACHER_NAME).save_pretrained(model_dir)
+        print(f'Student saved to {model_dir}')
+
+    if 'evaluate' in args.steps:
+        teacher = AutoModelForTokenClassification.from_pretrained(TEACHER_NAME).eval()
+        student = AutoModelForTokenClassification.from_pretrained(model_dir).eval()
+        teacher_names = [teacher.config.id2label[i] for i in range(len(teacher.config.id2label))]
+        report = {}
+        for name, model, tag_names, label_map in (('teacher', teacher, teacher_names, entity_map),
+                                                   ('student', student, TAGS, None)):
+            tags, elapsed = predict_tags(model, store, eval_docs, args.batch_size)
+            pred_dir = os.path.join(args.out_dir, f'{name}_predictions')
+            write_doc_predictions(store, corpus, eval_docs, tags, tag_names, pred_dir, label_map)
+            metrics = score_predictions(eval_docs, pred_dir)
+            report[name] = {
+                'parameters': sum(p.numel() for p in model.parameters()),
+                'docs_per_sec': len(eval_docs) / elapsed if elapsed else 0.0,
+                'ms_per_doc': 1000 * elapsed / max(len(eval_docs), 1),
+                'f1': {mode: {'macro_doc': metrics[mode]['macro_doc'][2], 'micro': metrics[mode]['micro'][2]}
+                       for mode in MODES},
+            }
+        with open(os.path.join(args.out_dir, 'report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+        print(f"\n{'':<8} {'params':>12} {'docs/s':>8} {'ms/doc':>8}  " + '  '.join(f'{m} F1' for m in MODES))
+        for name, r in report.items():
+            f1s = '  '.join(f"{r['f1'][m]['macro_doc']:.3f}".rjust(len(m) + 3) for m in MODES)
+            print(f"{name:<8} {r['parameters']:>12,} {r['docs_per_sec']:>8.1f} {r['ms_per_doc']:>8.1f}  {f1s}")
+        speedup = report['teacher']['ms_per_doc'] / max(report['student']['ms_per_doc'], 1e-9)
+        print(f'Student speed-up on CPU: {speedup:.1f}x (macro F1 over {len(eval_docs)} held-out posts)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import os
+import json
+import fcntl
+import atexit
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+
+# On-disk cache of sentence embeddings, shared across step6 runs (and across
+# linker processes running at the same time).
+#
+# Layout of <cache_dir>/<model id>/:
+#   vectors.f32  - float32 matrix, one row per cached text, memory-mapped and
+#                  grown by appending rows until max_entries is reached
+#   keys.npy     - uint64 key of every row (first 8 bytes of the sha1 key)
+#   clock.npy    - int64 last-used generation of every row, for LRU eviction
+#   meta.json    - model id and vector dimension
+#   lock         - file lock taken around every read-modify-write of the arrays
+#
+# Keys are sha1(model id + normalized text), so switching encoder models never
+# returns stale vectors. Lookups are a searchsorted over the key array, with no
+# JSON to parse. A lookup that only hits writes nothing: the rows it used are
+# remembered and their clock is bumped once, by flush() at the end of the run.
+# Once the cache is full, the least recently used rows (np.argpartition over the
+# clocks) are reused for new entries.
+
+DEFAULT_CACHE_DIR = '.embedding_cache'
+
+
+def normalize_text(text):
+    """Lowercases and collapses whitespace, the form the encoder sees and the cache is keyed on."""
+    return ' '.join(text.lower().split())
+
+
+def cache_key(model_id, text):
+    """Returns the 64-bit key of an already normalized text for a given encoder."""
+    return int.from_bytes(hashlib.sha1(f'{model_id}\0{text}'.encode('utf-8')).digest()[:8], 'little')
+
+
+class EmbeddingCache:
+    """
+    Persistent, size-capped embedding cache with LRU eviction.
+    Args:
+        model_id (str): Encoder model id, e.g. 'all-MiniLM-L6-v2'.
+        cache_dir (str): Root directory of the cache.
+        max_entries (int): Maximum number of cached vectors.
+    """
+
+    def __init__(self, model_id, cache_dir=DEFAULT_CACHE_DIR, max_entries=200000):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.directory = os.path.join(cache_dir, model_id.replace('/', '__'))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.keys_path = os.path.join(self.directory, 'keys.npy')
+        self.clock_path = os.path.join(self.directory, 'clock.npy')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.lock_path = os.path.join(self.directory, 'lock')
+        self.hits = 0
+        self.misses = 0
+        # Keys used since the last flush, whose clock is bumped by flush()
+        self._used = set()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        """Returns (dim, keys, clock); dim is None and the arrays are empty for a new cache."""
+        if not os.path.exists(self.meta_path):
+            return None, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            dim = json.load(f)['dim']
+        return dim, np.load(self.keys_path), np.load(self.clock_path)
+
+    def _save_array(self, path, array):
+        # Write to a temporary file and rename, so readers never see a partial array
+        tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+    def _save(self, dim, keys, clock):
+        self._save_array(self.keys_path, keys)
+        self._save_array(self.clock_path, clock)
+        if not os.path.exists(self.meta_path):
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'model_id': self.model_id, 'dim': dim}, f)
+
+    def _open_vectors(self, dim, rows, mode='r'):
+        if rows == 0:
+            return None
+        return np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(rows, dim))
+
+    @staticmethod
+    def _find(keys, query):
+        """Returns the row of every query key in `keys`, -1 where it is not cached."""
+        if not len(keys):
+            return np.full(len(query), -1, dtype=np.int64)
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, query), len(keys) - 1)
+        return np.where(sorted_keys[pos] == query, order[pos], -1)
+
+    def _allocate_rows(self, dim, keys, clock, count):
+        """
+        Returns (rows, keys, clock) with `count` free rows, appending to the matrix
+        or evicting the least recently used entries.
+        """
+        grow = min(count, self.max_entries - len(keys))
+        rows = np.arange(len(keys), len(keys) + max(grow, 0))
+        if grow > 0:
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate((len(keys) + grow) * dim * 4)
+            keys = np.concatenate([keys, np.zeros(grow, dtype=np.uint64)])
+            clock = np.concatenate([clock, np.zeros(grow, dtype=np.int64)])
+        evict = count - len(rows)
+        if evict > 0:
+            # Only the `evict` oldest rows are needed, not a full sort; new rows are excluded
+            candidates = clock.copy()
+            candidates[rows] = np.iinfo(np.int64).max
+            oldest = np.argpartition(candidates, evict - 1)[:evict]
+            rows = np.concatenate([rows, oldest])
+        return rows, keys, clock
+
+    def encode(self, texts, model, batch_size=64):
+        """
+        Returns embeddings for `texts` as a float32 array, encoding only the texts
+        that are not cached yet and storing them for later runs.
+        Args:
+            texts (list of str): Texts to embed.
+            model: A SentenceTransformer (anything with a compatible encode method).
+        Returns:
+            np.ndarray: Array of shape (len(texts), dim).
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        normalized = [normalize_text(text) for text in texts]
+        keys = [cache_key(self.model_id, text) for text in normalized]
+        unique_keys = np.array(sorted(set(keys)), dtype=np.uint64)
+
+        # 1. Look up what is already cached
+        with self._locked():
+            dim, cached_keys, _ = self._load()
+            rows = self._find(cached_keys, unique_keys)
+            vectors = self._open_vectors(dim, len(cached_keys))
+            found = rows >= 0
+            cached = dict(zip(unique_keys[found].tolist(), np.array(vectors[rows[found]]))) if found.any() else {}
+
+        # 2. Encode the misses outside the lock, so other processes are not blocked
+        missing = {}
+        for key, text in zip(keys, normalized):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        encoded = {}
+        if missing:
+            embeddings = model.encode(list(missing.values()), batch_size=batch_size, convert_to_numpy=True)
+            encoded = dict(zip(missing, np.asarray(embeddings, dtype=np.float32)))
+        hit_count = sum(1 for key in keys if key in cached)
+        self.hits += hit_count
+        self.misses += len(keys) - hit_count
+        self._used.update(unique_keys.tolist())
+
+        # 3. Store new vectors (pure hits skip this and write nothing)
+        if encoded:
+            self._store(encoded)
+
+        return np.stack([cached[key] if key in cached else encoded[key] for key in keys])
+
+    def _store(self, encoded):
+        with self._locked():
+            dim, keys, clock = self._load()
+            new_keys = np.array(list(encoded), dtype=np.uint64)
+            # Another process may have stored some of them meanwhile
+            new_keys = new_keys[self._find(keys, new_keys) < 0][:self.max_entries]
+            if not len(new_keys):
+                return
+            if dim is None:
+                dim = int(encoded[int(new_keys[0])].shape[0])
+            rows, keys, clock = self._allocate_rows(dim, keys, clock, len(new_keys))
+            vectors = self._open_vectors(dim, len(keys), mode='r+')
+            vectors[rows] = np.stack([encoded[int(key)] for key in new_keys])
+            vectors.flush()
+            keys[rows] = new_keys
+            clock[rows] = clock.max() + 1
+            self._save(dim, keys, clock)
+
+    def flush(self):
+        """
+        Bumps the LRU clock of every entry used since the last flush, in one write.
+        Called automatically at exit.
+        """
+        if not self._used:
+            return
+        used = np.array(sorted(self._used), dtype=np.uint64)
+        self._used = set()
+        with self._locked():
+            dim, keys, clock = self._load()
+            rows = self._find(keys, used)
+            rows = rows[rows >= 0]
+            if len(rows):
+                clock[rows] = clock.max() + 1
+                self._save_array(self.clock_path, clock)
@@ -0,0 +1,217 @@
+import os
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from batch_generate_predicted_spans import MODEL_NAME, entity_map, read_sampled_files, write_predicted_spans
+from corpus_store import open_corpus
+from bio_decoding import TARGET_LABELS, O, B, I, label_projection, decode_tags, tags_to_spans
+from distill_student_ner import to_tensor
+from incremental_eval import MODES, score_predictions
+from model_artifact import load_ner_model
+from spans import SpanTable
+from tokenization_store import WORD_TOKENIZER, open_token_store
+
+# Ensemble of token-classification models.
+#
+# Members whose tokenizers are identical (same fingerprint) read the same token
+# store, so each distinct tokenizer runs over the corpus only once. Every member
+# runs in its own thread (PyTorch releases the GIL inside its kernels), so the
+# ensemble takes about as long as its slowest member. The CPU cores are split
+# between the members running at once, instead of every member starting a full
+# intra-op pool and oversubscribing the cores.
+#
+# Members can have different tokenizers and label sets, so their outputs are
+# brought onto a common grid: the regex-word tokens of the corpus, with for
+# every target label an O/B/I distribution. A model label mapped to several
+# target labels by entity_map (Sign_symptom -> Symptom, ADR) counts fully for
+# each of them, as in the batch script. The word grid is then combined:
+#   vote  - each member decodes its own spans; (span, label) pairs predicted by
+#           at least --min-votes members are kept
+#   score - the members' O/B/I distributions are averaged (optionally weighted)
+#           and decoded once
+# Tags are decoded by argmax or by BIO-constrained Viterbi (bio_decoding.py).
+
+DEFAULT_OUT_DIR = 'ensemble_predictions'
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of everything that decides how a tokenizer splits text (the full fast-tokenizer config)."""
+    if getattr(tokenizer, 'is_fast', False):
+        description = tokenizer.backend_tokenizer.to_str()
+    else:
+        description = type(tokenizer).__name__ + repr(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+class EnsembleMember:
+    """
+    One model of the ensemble.
+    Args:
+        model_name (str): Hugging Face model name or local directory.
+        traced (bool): Run the TorchScript graph of the model's artifact, if it has one.
+    """
+
+    def __init__(self, model_name, traced=False):
+        self.name = model_name
+        # From the model's artifact when one has been built
+        self.model, self.tokenizer = load_ner_model(model_name, traced=traced)
+        self.fingerprint = tokenizer_fingerprint(self.tokenizer)
+        self.projection = torch.from_numpy(label_projection(self.model.config.id2label, entity_map))
+        self.store = None
+        self.seconds = 0.0
+
+    def word_probs(self, doc_ids, word_store, batch_size=16):
+        """
+        Runs the model over the token rows of `doc_ids` and moves the per-label
+        O/B/I probabilities of each word's first token onto the word grid. Tokens
+        in the overlap of two windows are taken once (TokenStore.doc_tokens).
+        Returns:
+            dict: doc_id -> float32 array (words, len(TARGET_LABELS), 3).
+        """
+        start = time.perf_counter()
+        probs = {}
+        for doc_id in doc_ids:
+            words = word_store.lengths[word_store.rows(doc_id).start]
+            doc_probs = np.zeros((words, len(TARGET_LABELS), 3), dtype=np.float32)
+            doc_probs[..., O] = 1.0
+            probs[doc_id] = doc_probs
+        row_probs = {}
+        with torch.inference_mode():
+            for rows, input_ids, attention_mask, _ in self.store.batches(batch_size, doc_ids):
+                logits = self.model(input_ids=to_tensor(input_ids), attention_mask=to_tensor(attention_mask)).logits
+                tag_probs = torch.einsum('btk,klc->btlc', logits.softmax(-1), self.projection).numpy()
+                row_probs.update(zip(rows.tolist(), tag_probs))
+        for doc_id in doc_ids:
+            # One copy of each token, from the window where it is farthest from an edge
+            rows, positions = self.store.doc_tokens(doc_id)
+            token_probs = np.array([row_probs[row][position] for row, position in zip(rows.tolist(), positions)])
+            _place_on_words(probs[doc_id], token_probs.reshape(len(rows), len(TARGET_LABELS), 3),
+                            self.store.offset_mapping[rows, positions], _word_offsets(word_store, doc_id))
+        self.seconds = time.perf_counter() - start
+        return probs
+
+
+def _word_offsets(word_store, doc_id):
+    row = word_store.rows(doc_id).start
+    return word_store.offset_mapping[row, :word_store.lengths[row]]
+
+
+def _place_on_words(doc_probs, row_probs, row_offsets, word_offsets):
+    """Copies the probabilities of the token holding each word's first character into `doc_probs`."""
+    real = row_offsets[:, 1] > row_offsets[:, 0]
+    token_starts, token_ends = row_offsets[real, 0], row_offsets[real, 1]
+    row_probs = row_probs[real]
+    if not len(token_starts) or not len(word_offsets):
+        return
+    word_starts = word_offsets[:, 0]
+    token = np.searchsorted(token_ends, word_starts, side='right')
+    covered = token < len(token_starts)
+    covered[covered] = token_starts[token[covered]] <= word_starts[covered]
+    inside = row_probs[token[covered]]
+    inside[..., O] = np.clip(1.0 - inside[..., B] - inside[..., I], 0.0, 1.0)
+    doc_probs[covered] = inside
+
+
+def decode_words(probs, method='argmax'):
+    """(words, len(TARGET_LABELS), 3) O/B/I probabilities -> (words, len(TARGET_LABELS)) tag ids."""
+    if method == 'argmax':
+        return probs.argmax(-1)
+    log_probs = np.log(np.clip(probs, 1e-6, 1.0))[None]
+    return decode_tags(log_probs, np.ones(log_probs.shape[:2], dtype=bool), method)[0]
+
+
+def combine_vote(member_probs, word_offsets, min_votes, method='argmax'):
+    """Keeps the (span, label) pairs decoded by at least `min_votes` members."""
+    keys = [SpanTable.from_rows(tags_to_spans(decode_words(probs, method), word_offsets)).pair_keys()
+            for probs in member_probs]
+    keys = np.sort(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    if not len(keys):
+        return SpanTable.empty()
+    boundaries = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1], [True])))
+    votes = np.diff(boundaries)
+    return SpanTable.from_pair_keys(keys[boundaries[:-1]][votes >= min_votes])
+
+
+def combine_score(member_probs, word_offsets, weights=None, method='argmax'):
+    """Averages the members' O/B/I distributions and decodes the result."""
+    average = np.average(np.stack(member_probs), axis=0, weights=weights)
+    return SpanTable.from_rows(tags_to_spans(decode_words(average, method), word_offsets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several NER models as an ensemble.')
+    parser.add_argument('--models', nargs='+', default=[MODEL_NAME, os.path.join('student_ner', 'model')])
+    parser.add_argument('--combine', choices=['vote', 'score'], default='vote')
+    parser.add_argument('--min-votes', type=int, default=None, help='Votes needed to keep a span (default: majority)')
+    parser.add_argument('--weights', type=float, nargs='+', default=None, help='Member weights for --combine score')
+    parser.add_argument('--decode', choices=['argmax', 'viterbi'], default='argmax', help='How word tags are decoded')
+    parser.add_argument('--workers', type=int, default=None, help='Members run at once (default: all)')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--traced', action='store_true', help="Run the members' TorchScript graphs (artifacts built with --trace)")
+    parser.add_argument('--out-dir', default=DEFAULT_OUT_DIR)
+    args = parser.parse_args()
+    if args.weights and len(args.weights) != len(args.models):
+        parser.error('give one weight per model')
+
+    corpus = open_corpus()
+    doc_ids = [f.replace('.txt', '') for f in read_sampled_files() if f.replace('.txt', '') in corpus]
+    word_store = open_token_store(WORD_TOKENIZER, corpus)
+
+    print('Loading models...')
+    members = [EnsembleMember(name, args.traced) for name in args.models]
+    stores = {}
+    for member in members:
+        # Members with identical tokenizers share the token store of the first of them
+        if member.fingerprint not in stores:
+            stores[member.fingerprint] = open_token_store(member.name, corpus)
+        member.store = stores[member.fingerprint]
+    print(f'{len(members)} members, {len(stores)} distinct tokenizer(s)')
+
+    concurrent = max(1, min(args.workers or len(members), len(members)))
+    threads = max(1, (os.cpu_count() or 1) // concurrent)
+    torch.set_num_threads(threads)
+    print(f'{concurrent} member(s) at once, {threads} thread(s) each')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrent) as pool:
+        member_probs = list(pool.map(lambda member: member.word_probs(doc_ids, word_store, args.batch_size), members))
+    wall = time.perf_counter() - start
+
+    min_votes = args.min_votes or len(members) // 2 + 1
+    outputs = {'ensemble': args.out_dir}
+    outputs.update({f'member{i}': os.path.join(args.out_dir, 'members', str(i)) for i in range(len(members))})
+    for pred_dir in outputs.values():
+        os.makedirs(pred_dir, exist_ok=True)
+    for doc_id in doc_ids:
+        text = corpus.text(doc_id)
+        word_offsets = _word_offsets(word_store, doc_id)
+        probs = [p[doc_id] for p in member_probs]
+        if args.combine == 'vote':
+            table = combine_vote(probs, word_offsets, min_votes, args.decode)
+        else:
+            table = combine_score(probs, word_offsets, args.weights, args.decode)
+        write_predicted_spans(doc_id, table.to_rows(text=text), outputs['ensemble'])
+        for i, member_doc_probs in enumerate(probs):
+            member_table = SpanTable.from_rows(tags_to_spans(decode_words(member_doc_probs, args.decode), word_offsets))
+            write_predicted_spans(doc_id, member_table.to_rows(text=text), outputs[f'member{i}'])
+
+    print(f"\n{'':<10} {'seconds':>8}  " + '  '.join(f'{m} F1' for m in MODES) + '  model')
+    for key, pred_dir in outputs.items():
+        metrics = score_predictions(doc_ids, pred_dir)
+        f1s = '  '.join(f"{metrics[mode]['macro_doc'][2]:.3f}".rjust(len(mode) + 3) for mode in MODES)
+        if key == 'ensemble':
+            print(f"{key:<10} {wall:>8.2f}  {f1s}  {args.combine}")
+        else:
+            member = members[int(key[len('member'):])]
+            print(f"{key:<10} {member.seconds:>8.2f}  {f1s}  {member.name}")
+    seconds = [member.seconds for member in members]
+    print(f'Ensemble wall time {wall:.2f}s; slowest member {max(seconds):.2f}s, sum of members {sum(seconds):.2f}s')
+
+
+if __name__ == '__main__':
+    main()
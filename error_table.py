@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from spans import LABELS, label_mask
+from step3_evaluate_predictions import load_predicted_spans
+from step5_relaxed_eval import read_ground_truth_spans_with_offsets
+from tokenization_store import WORD_PATTERN
+
+# Columnar error table of an evaluation run.
+#
+# Every (span, label) pair of a prediction directory and every gold pair it
+# does not match exactly becomes one row, with offsets matched within the same
+# document:
+#   exact    - prediction with a gold pair of the same label and offsets
+#   boundary - same label, overlapping offsets (a relaxed match; the gold pair
+#              of such a prediction gets a 'boundary' row of its own)
+#   label    - overlaps only gold (or predicted) pairs of other labels
+#   spurious - prediction overlapping no gold pair (false positive)
+#   missed   - gold pair overlapped by no prediction (false negative)
+# Rows carry the doc, drug, label, both offsets, the overlap ratio (characters
+# shared / characters covered) with the best counterpart, the prediction score
+# when the JSON stores one, and the span length. Tables are saved as compressed
+# .npz columns, so 'python error_table.py query' can filter and group the rows
+# of the whole corpus in milliseconds without re-scoring anything.
+
+DEFAULT_TABLE_FILE = '.eval_cache/error_table.npz'
+ERROR_TABLE_NAME = 'error_table.npz'
+MATCH_TYPES = ('exact', 'boundary', 'label', 'spurious', 'missed')
+SIDES = ('pred', 'gold')
+NO_LABEL = 255
+# Active ingredient of each CADEC drug (the prefix of a post id)
+DRUG_FAMILIES = {
+    'ARTHROTEC': 'diclofenac', 'CAMBIA': 'diclofenac', 'CATAFLAM': 'diclofenac',
+    'DICLOFENAC-POTASSIUM': 'diclofenac', 'DICLOFENAC-SODIUM': 'diclofenac', 'FLECTOR': 'diclofenac',
+    'PENNSAID': 'diclofenac', 'SOLARAZE': 'diclofenac', 'VOLTAREN': 'diclofenac',
+    'VOLTAREN-XR': 'diclofenac', 'ZIPSOR': 'diclofenac', 'LIPITOR': 'atorvastatin',
+}
+
+# Stored columns and their dtypes
+COLUMNS = {
+    'doc': np.int32, 'label': np.uint8, 'side': np.uint8, 'match': np.uint8, 'other_label': np.uint8,
+    'pred_start': np.int32, 'pred_end': np.int32, 'gold_start': np.int32, 'gold_end': np.int32,
+    'overlap': np.float32, 'score': np.float32, 'chars': np.int32, 'words': np.int16, 'text': str,
+}
+# Columns given by name in queries, and the lists of names their codes index
+CATEGORIES = {'label': LABELS, 'side': SIDES, 'match': MATCH_TYPES}
+
+
+def drug_of(doc_id):
+    return doc_id.split('.')[0]
+
+
+def _prediction_scores(pred_file):
+    """(label, start, end) -> score of predictions written as dicts with a 'score' key."""
+    with open(pred_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    scores = {}
+    for item in data if isinstance(data, list) else []:
+        if isinstance(item, dict) and 'score' in item:
+            scores[(item['label'], item.get('start', 0), item.get('end', 0))] = float(item['score'])
+    return scores
+
+
+def _pairs(rows, scores=None):
+    """Deduplicated (label index, start, end, text, score) pairs of rows with offsets and a known label."""
+    pairs = {}
+    for row in rows:
+        label, start, end, text = row[0], row[1], row[2], row[-1]
+        mask = label_mask(label)
+        if start is None or not mask:
+            continue
+        score = scores.get((label, start, end), np.nan) if scores else np.nan
+        pairs.setdefault((mask.bit_length() - 1, int(start), int(end)), (text or '', score))
+    return [(label, start, end, text, score) for (label, start, end), (text, score) in sorted(pairs.items())]
+
+
+def _best(candidates, ratios):
+    """Index of the candidate with the highest ratio in each row of a boolean matrix, -1 where there is none."""
+    scored = np.where(candidates, ratios, -1.0)
+    return np.where(candidates.any(axis=1), scored.argmax(axis=1), -1) if scored.shape[1] else np.full(len(scored), -1)
+
+
+def document_errors(ann_file, pred_file, doc=0):
+    """
+    Error rows of one document.
+    Returns:
+        dict: column name -> array, one entry per row (see COLUMNS).
+    """
+    pred = _pairs(load_predicted_spans(pred_file), _prediction_scores(pred_file))
+    gold = _pairs(read_ground_truth_spans_with_offsets(ann_file))
+    p_label, p_start, p_end = (np.array([p[i] for p in pred], dtype=np.int64).reshape(len(pred)) for i in range(3))
+    g_label, g_start, g_end = (np.array([g[i] for g in gold], dtype=np.int64).reshape(len(gold)) for i in range(3))
+
+    shared = np.maximum(0, np.minimum(p_end[:, None], g_end[None]) - np.maximum(p_start[:, None], g_start[None]))
+    covered = (p_end - p_start)[:, None] + (g_end - g_start)[None] - shared
+    ratios = np.where(covered > 0, shared / np.maximum(covered, 1), 0.0)
+    overlapping = shared > 0
+    same_label = p_label[:, None] == g_label[None]
+    exact = same_label & (p_start[:, None] == g_start[None]) & (p_end[:, None] == g_end[None])
+
+    columns = {name: [] for name in COLUMNS}
+
+    def add(side, match, label, other_label, pred_offsets, gold_offsets, overlap, score, text):
+        for name, value in (('doc', doc), ('side', SIDES.index(side)), ('match', MATCH_TYPES.index(match)),
+                            ('label', label), ('other_label', NO_LABEL if other_label is None else other_label),
+                            ('pred_start', pred_offsets[0]), ('pred_end', pred_offsets[1]),
+                            ('gold_start', gold_offsets[0]), ('gold_end', gold_offsets[1]),
+                            ('overlap', overlap), ('score', score), ('text', text)):
+            columns[name].append(value)
+        own = pred_offsets if side == 'pred' else gold_offsets
+        columns['chars'].append(own[1] - own[0])
+        columns['words'].append(len(WORD_PATTERN.findall(text)))
+
+    none = (-1, -1)
+    # Predictions: the counterpart is the exact gold pair, else the best-overlapping
+    # gold pair of the same label, else the best-overlapping gold pair of any label
+    exact_gold, same_gold, any_gold = (_best(m, ratios) for m in (exact, same_label & overlapping, overlapping))
+    for i, (label, start, end, text, score) in enumerate(pred):
+        match, j = next(((m, j) for m, j in (('exact', exact_gold[i]), ('boundary', same_gold[i]),
+                                             ('label', any_gold[i])) if j >= 0), ('spurious', -1))
+        gold_pair = gold[j] if j >= 0 else None
+        add('pred', match, label, gold_pair[0] if gold_pair and match == 'label' else None, (start, end),
+            gold_pair[1:3] if gold_pair else none, float(ratios[i, j]) if j >= 0 else 0.0, score, text)
+    # Gold pairs without an exact match
+    exact_pred, same_pred, any_pred = (_best(m.T, ratios.T) for m in (exact, same_label & overlapping, overlapping))
+    for j, (label, start, end, text, _) in enumerate(gold):
+        if exact_pred[j] >= 0:
+            continue
+        match, i = next(((m, i) for m, i in (('boundary', same_pred[j]), ('label', any_pred[j])) if i >= 0),
+                        ('missed', -1))
+        pred_pair = pred[i] if i >= 0 else None
+        add('gold', match, label, pred_pair[0] if pred_pair and match == 'label' else None,
+            pred_pair[1:3] if pred_pair else none, (start, end), float(ratios[i, j]) if i >= 0 else 0.0,
+            pred_pair[4] if pred_pair else np.nan, text)
+    return columns
+
+
+class ErrorTable:
+    """
+    Columnar error rows of an evaluation run.
+    Args:
+        columns (dict): Column name -> array (see COLUMNS).
+        doc_names (list of str): Maps the 'doc' column to doc ids.
+        doc_stamps (list): Per document, size and mtime of its gold and prediction
+            files when its rows were built; unchanged documents are reused on rebuild.
+        meta (dict): Where the predictions came from.
+    """
+
+    def __init__(self, columns, doc_names, doc_stamps=None, meta=None):
+        self.columns = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.doc_names = list(doc_names)
+        self.doc_stamps = list(doc_stamps) if doc_stamps is not None else [None] * len(self.doc_names)
+        self.meta = meta or {}
+
+    def __len__(self):
+        return len(self.columns['doc'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, doc_names=np.array(self.doc_names, dtype=str),
+                            meta=np.array(json.dumps({'doc_stamps': self.doc_stamps, **self.meta})),
+                            **self.columns)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            doc_stamps = meta.pop('doc_stamps')
+            return cls({name: data[name] for name in COLUMNS}, data['doc_names'].tolist(), doc_stamps, meta)
+
+    def doc_rows(self):
+        """doc index -> slice of its rows (rows are grouped by doc)."""
+        doc = self.columns['doc']
+        bounds = np.searchsorted(doc, np.arange(len(self.doc_names) + 1))
+        return {i: slice(int(bounds[i]), int(bounds[i + 1])) for i in range(len(self.doc_names))}
+
+    # ----- queries -----
+
+    def values(self, name):
+        """
+        A column as (codes, names): categorical columns ('label', 'drug', 'family',
+        'match', ...) as integer codes plus the names they index, numeric columns with names None.
+        """
+        if name in ('drug', 'family'):
+            doc_values = [drug_of(d) for d in self.doc_names]
+            if name == 'family':
+                doc_values = [DRUG_FAMILIES.get(drug, 'other') for drug in doc_values]
+            names = sorted(set(doc_values))
+            doc_codes = np.array([names.index(v) for v in doc_values], dtype=np.int64)
+            return doc_codes[self.columns['doc']], names
+        if name == 'doc':
+            return self.columns['doc'], self.doc_names
+        if name == 'other_label':
+            # Rows without a counterpart of another label are named '-'
+            values = self.columns[name]
+            return np.where(values == NO_LABEL, len(LABELS), values), list(LABELS) + ['-']
+        if name in CATEGORIES:
+            return self.columns[name], list(CATEGORIES[name])
+        if name not in self.columns:
+            raise KeyError(f'Unknown column {name!r}')
+        return self.columns[name], None
+
+    def select(self, conditions):
+        """
+        Boolean row mask for conditions such as {'label': 'ADR,Drug', 'words': '2-3',
+        'overlap': '<0.5', 'match': 'spurious'}. Categorical values are
+        comma-separated names; numeric values are N, A-B (inclusive), <N, <=N, >N or >=N.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, condition in conditions.items():
+            values, names = self.values(name)
+            if names is not None:
+                wanted = [names.index(v) if v in names else -1 for v in condition.split(',')]
+                mask &= np.isin(values, wanted)
+            else:
+                mask &= _numeric_condition(values, condition)
+        return mask
+
+    def group(self, by, mask=None):
+        """
+        Rows per combination of the `by` columns (within `mask`).
+        Returns:
+            list: (names of the group, rows, mean overlap) tuples, most rows first.
+        """
+        mask = np.ones(len(self), dtype=bool) if mask is None else mask
+        codes, sizes, decoders = np.zeros(int(mask.sum()), dtype=np.int64), [], []
+        for name in by:
+            values, names = self.values(name)
+            values = values[mask]
+            if names is None:
+                # Numeric columns are grouped by value
+                names = np.sort(np.unique(values)).tolist()
+                values = np.searchsorted(names, values)
+            codes = codes * len(names) + values.astype(np.int64)
+            sizes.append(len(names))
+            decoders.append(names)
+        counts = np.bincount(codes, minlength=int(np.prod(sizes)) if sizes else 1)
+        overlap_sums = np.bincount(codes, weights=self.columns['overlap'][mask], minlength=len(counts))
+        groups = []
+        for code in np.flatnonzero(counts):
+            key, rest = [], int(code)
+            for size, names in zip(reversed(sizes), reversed(decoders)):
+                key.append(names[rest % size])
+                rest //= size
+            groups.append((tuple(reversed(key)), int(counts[code]), float(overlap_sums[code] / counts[code])))
+        return sorted(groups, key=lambda group: (-group[1], group[0]))
+
+
+def _numeric_condition(values, condition):
+    for operator, compare in (('<=', np.less_equal), ('>=', np.greater_equal), ('<', np.less), ('>', np.greater)):
+        if condition.startswith(operator):
+            return compare(values, float(condition[len(operator):]))
+    low, separator, high = condition.partition('-')
+    if separator and low:
+        return (values >= float(low)) & (values <= float(high))
+    return values == float(condition)
+
+
+def _stamps(ann_file, pred_file):
+    return [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in (ann_file, pred_file)]
+
+
+def build_error_table(doc_ids, pred_dir='.', gold_dir='cadec/original', previous=None):
+    """
+    Builds the error table of a prediction directory. Documents whose gold and
+    prediction files are unchanged since `previous` (an ErrorTable) was built
+    keep their rows; documents with a missing file are skipped.
+    Returns:
+        (ErrorTable, int): The table and the number of documents (re)built.
+    """
+    reusable = {}
+    if previous is not None and previous.meta.get('pred_dir') == pred_dir and previous.meta.get('gold_dir') == gold_dir:
+        doc_rows = previous.doc_rows()
+        reusable = {name: (i, previous.doc_stamps[i]) for i, name in enumerate(previous.doc_names)}
+
+    parts, doc_names, doc_stamps, built = [], [], [], 0
+    for doc_id in doc_ids:
+        ann_file = os.path.join(gold_dir, doc_id + '.ann')
+        pred_file = os.path.join(pred_dir, doc_id + '_predicted_spans.json')
+        if not (os.path.exists(ann_file) and os.path.exists(pred_file)):
+            continue
+        doc, stamps = len(doc_names), _stamps(ann_file, pred_file)
+        if doc_id in reusable and reusable[doc_id][1] == stamps:
+            rows = doc_rows[reusable[doc_id][0]]
+            columns = {name: previous.columns[name][rows] for name in COLUMNS}
+            columns['doc'] = np.full(rows.stop - rows.start, doc, dtype=np.int32)
+        else:
+            columns = document_errors(ann_file, pred_file, doc)
+            built += 1
+        parts.append(columns)
+        doc_names.append(doc_id)
+        doc_stamps.append(stamps)
+
+    columns = {name: np.concatenate([np.asarray(part[name], dtype=dtype) for part in parts]) if parts
+               else np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    meta = {'pred_dir': pred_dir, 'gold_dir': gold_dir, 'built': time.strftime('%Y-%m-%d %H:%M:%S')}
+    return ErrorTable(columns, doc_names, doc_stamps, meta), built
+
+
+def default_table_path(pred_dir):
+    """Where the error table of a prediction directory is written: inside it, or under .eval_cache/ for '.'."""
+    return DEFAULT_TABLE_FILE if os.path.abspath(pred_dir) == os.path.abspath('.') else os.path.join(pred_dir, ERROR_TABLE_NAME)
+
+
+def update_error_table(path, doc_ids, pred_dir='.', gold_dir='cadec/original'):
+    """Rebuilds the table at `path` for `doc_ids`, reusing the rows of unchanged documents; returns it."""
+    previous = ErrorTable.load(path) if os.path.exists(path) else None
+    table, _ = build_error_table(doc_ids, pred_dir, gold_dir, previous)
+    table.save(path)
+    return table
+
+
+def print_groups(table, by, mask, texts=0):
+    total = int(mask.sum())
+    print(f"{'  '.join(f'{name:<12}' for name in by)}  {'rows':>7} {'share':>7} {'overlap':>8}")
+    for key, rows, overlap in table.group(by, mask):
+        print(f"{'  '.join(f'{str(value):<12}' for value in key)}  {rows:>7} {rows / total:>7.1%} {overlap:>8.2f}")
+    if texts:
+        # Most frequent lowercased texts of the selected rows
+        text_values, counts = np.unique(np.char.lower(table.columns['text'][mask]), return_counts=True)
+        order = np.argsort(-counts, kind='stable')[:texts]
+        print(f'\nTop texts: ' + ', '.join(f'{str(text_values[i])!r} ({counts[i]})' for i in order))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query the columnar error table of a prediction run.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Build the error table of a prediction directory')
+    build.add_argument('--pred-dir', default='.')
+    build.add_argument('--files', default='step5_sampled_files.txt', help='List of .txt posts to include')
+    build.add_argument('--all', action='store_true', help='Include every post with a prediction file')
+    build.add_argument('--out', default=None, help=f'Default: {DEFAULT_TABLE_FILE}, or <pred-dir>/{ERROR_TABLE_NAME}')
+    query = subparsers.add_parser('query', help='Filter and group the rows of an error table')
+    query.add_argument('--table', default=DEFAULT_TABLE_FILE, help=f'Table file, or a directory holding {ERROR_TABLE_NAME}')
+    query.add_argument('--where', nargs='*', default=[], metavar='COLUMN=VALUE',
+                       help="e.g. label=ADR match=spurious,missed drug=LIPITOR words=1-2 overlap='<0.5'")
+    query.add_argument('--by', default='label,match', help='Comma-separated columns to group by')
+    query.add_argument('--texts', type=int, default=0, help='Also list the N most frequent texts')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.all:
+            doc_ids = sorted(f[:-len('_predicted_spans.json')] for f in os.listdir(args.pred_dir)
+                             if f.endswith('_predicted_spans.json'))
+        else:
+            with open(args.files, 'r') as f:
+                doc_ids = [line.strip().replace('.txt', '') for line in f if line.strip()]
+        out = args.out or default_table_path(args.pred_dir)
+        start = time.perf_counter()
+        previous = ErrorTable.load(out) if os.path.exists(out) else None
+        table, built = build_error_table(doc_ids, args.pred_dir, previous=previous)
+        table.save(out)
+        print(f'{len(table)} rows for {len(table.doc_names)} posts ({built} rebuilt) in '
+              f'{time.perf_counter() - start:.2f}s -> {out}')
+        return
+
+    path = os.path.join(args.table, ERROR_TABLE_NAME) if os.path.isdir(args.table) else args.table
+    start = time.perf_counter()
+    table = ErrorTable.load(path)
+    loaded = time.perf_counter()
+    conditions = dict(condition.split('=', 1) for condition in args.where)
+    by = [name for name in args.by.split(',') if name]
+    mask = table.select(conditions)
+    print(f"{path}: {int(mask.sum())} of {len(table)} rows ({table.meta.get('pred_dir')}, built {table.meta.get('built')})\n")
+    print_groups(table, by, mask, args.texts)
+    print(f'\nLoaded in {(loaded - start) * 1000:.1f} ms, queried in {(time.perf_counter() - loaded) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
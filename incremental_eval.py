@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+
+from error_table import default_table_path, update_error_table
+from spans import LABELS, SpanTable, label_mask, pair_label_index
+from step3_evaluate_predictions import read_ground_truth_spans, load_predicted_spans, normalize_span
+from step5_relaxed_eval import read_ground_truth_spans_with_offsets
+from tokenization_store import WORD_PATTERN
+
+# Incremental version of the step5 evaluations.
+#
+# For every document, TP/FP/FN counts are stored per matching mode and label,
+# together with hashes of the gold .ann file and the prediction JSON. On the
+# next run only documents whose gold or prediction changed are rescored; the
+# corpus-level micro/macro metrics are then recomputed from the stored counts.
+#
+# Matching modes (same rules as the step5 scripts):
+#   strict  - normalized (label, text) pairs, as in step5.py
+#   relaxed - same label and overlapping offsets, as in step5_relaxed_eval.py
+#   token   - (label, lowercased \w+ token) pairs, as in step5_token_and_word_relaxed_eval.py
+
+MODES = ('strict', 'relaxed', 'token')
+DEFAULT_CACHE_FILE = '.eval_cache/incremental_eval.json'
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _label_index(label):
+    mask = label_mask(label)
+    return mask.bit_length() - 1 if mask else None
+
+
+def _count_pairs(pred_pairs, gt_pairs):
+    """Per-label [tp, fp, fn] counts of two sets of (label, item) pairs."""
+    counts = np.zeros((len(LABELS), 3), dtype=np.int64)
+    for pairs, column in ((pred_pairs & gt_pairs, 0), (pred_pairs - gt_pairs, 1), (gt_pairs - pred_pairs, 2)):
+        for label, _ in pairs:
+            index = _label_index(label)
+            if index is not None:
+                counts[index, column] += 1
+    return counts
+
+
+def score_document(ann_file, pred_file):
+    """
+    Scores one document in every matching mode.
+    Returns:
+        dict: mode -> int array of shape (len(LABELS), 3) holding tp, fp, fn per label.
+    """
+    predicted_spans = load_predicted_spans(pred_file)
+    gt_offset_spans = read_ground_truth_spans_with_offsets(ann_file)
+    counts = {}
+
+    # strict: normalized (label, text) pairs
+    gt_norm = set(normalize_span(s) for s in read_ground_truth_spans(ann_file))
+    pred_norm = set(normalize_span(s) for s in predicted_spans)
+    counts['strict'] = _count_pairs(pred_norm, gt_norm)
+
+    # relaxed: same label and overlapping offsets
+    pred_keys, pred_matched, gt_keys, gt_matched = SpanTable.from_rows(predicted_spans).overlap_matches(
+        SpanTable.from_rows(gt_offset_spans))
+    relaxed = np.zeros((len(LABELS), 3), dtype=np.int64)
+    pred_labels, gt_labels = pair_label_index(pred_keys), pair_label_index(gt_keys)
+    relaxed[:, 0] = np.bincount(pred_labels[pred_matched], minlength=len(LABELS))
+    relaxed[:, 1] = np.bincount(pred_labels[~pred_matched], minlength=len(LABELS))
+    relaxed[:, 2] = np.bincount(gt_labels[~gt_matched], minlength=len(LABELS))
+    counts['relaxed'] = relaxed
+
+    # token: (label, lowercased word) pairs
+    def token_pairs(spans):
+        return set((label.lower(), token.lower()) for label, _, _, text in spans for token in WORD_PATTERN.findall(text))
+    counts['token'] = _count_pairs(token_pairs(predicted_spans), token_pairs(gt_offset_spans))
+    return counts
+
+
+def load_cache(cache_file=DEFAULT_CACHE_FILE):
+    if not os.path.exists(cache_file):
+        return {'labels': list(LABELS), 'docs': {}}
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        cache = json.load(f)
+    # Counts stored for a different label set cannot be reused
+    if cache.get('labels') != list(LABELS):
+        return {'labels': list(LABELS), 'docs': {}}
+    return cache
+
+
+def save_cache(cache, cache_file=DEFAULT_CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, separators=(',', ':'))
+    os.replace(tmp_file, cache_file)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def update_counts(doc_ids, cache, gold_dir='cadec/original', pred_dir='.', force=False):
+    """
+    Brings the cached counts of `doc_ids` up to date, rescoring only documents
+    whose gold or prediction file changed. A file whose size and mtime are
+    unchanged is not even re-hashed.
+    Returns:
+        (int, int): Number of rescored documents and of skipped (missing) ones.
+    """
+    rescored = skipped = 0
+    docs = cache['docs']
+    for doc_id in doc_ids:
+        ann_file = os.path.join(gold_dir, doc_id + '.ann')
+        pred_file = os.path.join(pred_dir, doc_id + '_predicted_spans.json')
+        if not (os.path.exists(ann_file) and os.path.exists(pred_file)):
+            docs.pop(doc_id, None)
+            skipped += 1
+            continue
+        entry = docs.get(doc_id)
+        stamps = [_stamp(ann_file), _stamp(pred_file)]
+        if not force and entry is not None and entry['stamps'] == stamps:
+            continue
+        hashes = [file_digest(ann_file), file_digest(pred_file)]
+        if force or entry is None or entry['hashes'] != hashes:
+            counts = score_document(ann_file, pred_file)
+            entry = {'counts': {mode: counts[mode].tolist() for mode in MODES}}
+            rescored += 1
+        entry['hashes'] = hashes
+        entry['stamps'] = stamps
+        docs[doc_id] = entry
+    return rescored, skipped
+
+
+def count_matrix(cache, mode, doc_ids=None):
+    """
+    Returns (doc_ids, counts) where counts has shape (n_docs, len(LABELS), 3)
+    holding tp, fp, fn per document and label for one matching mode.
+    """
+    doc_ids = [d for d in (doc_ids if doc_ids is not None else sorted(cache['docs'])) if d in cache['docs']]
+    counts = np.array([cache['docs'][d]['counts'][mode] for d in doc_ids], dtype=np.int64)
+    return doc_ids, counts.reshape(len(doc_ids), len(LABELS), 3)
+
+
+def prf(tp, fp, fn):
+    """Vectorized precision, recall and F1 (0.0 where undefined), as in the step scripts."""
+    tp, fp, fn = (np.asarray(x, dtype=np.float64) for x in (tp, fp, fn))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+
+def corpus_metrics(counts):
+    """
+    Corpus-level metrics from a (n_docs, n_labels, 3) count array.
+    Returns:
+        dict: 'micro' (pooled counts), 'macro_doc' (average of per-document scores,
+        the step5 "Macro" numbers), 'macro_label' (average over labels present)
+        and 'per_label' micro scores, each as (precision, recall, f1).
+    """
+    per_label = counts.sum(axis=0)
+    micro = prf(*per_label.sum(axis=0))
+    doc_scores = prf(*counts.sum(axis=1).T)
+    present = per_label.sum(axis=1) > 0
+    label_scores = prf(*per_label.T)
+    return {
+        'micro': tuple(float(x) for x in micro),
+        'macro_doc': tuple(float(x.mean()) if len(counts) else 0.0 for x in doc_scores),
+        'macro_label': tuple(float(x[present].mean()) if present.any() else 0.0 for x in label_scores),
+        'per_label': {label: tuple(float(x[i]) for x in label_scores) for i, label in enumerate(LABELS) if present[i]},
+    }
+
+
+def score_predictions(doc_ids, pred_dir, gold_dir='cadec/original', error_table=True):
+    """
+    Scores a directory of *_predicted_spans.json files from scratch; returns {mode: corpus_metrics(...)}.
+    Unless `error_table` is False, the error table of the run is also written
+    (to `error_table` if it is a path, else next to the predictions).
+    """
+    if error_table:
+        path = error_table if isinstance(error_table, str) else default_table_path(pred_dir)
+        update_error_table(path, doc_ids, pred_dir, gold_dir)
+    totals = {mode: [] for mode in MODES}
+    for doc_id in doc_ids:
+        counts = score_document(os.path.join(gold_dir, doc_id + '.ann'),
+                                os.path.join(pred_dir, doc_id + '_predicted_spans.json'))
+        for mode in MODES:
+            totals[mode].append(counts[mode])
+    return {mode: corpus_metrics(np.array(totals[mode])) for mode in MODES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental step5 evaluation from cached per-document counts.')
+    parser.add_argument('--files', default='step5_sampled_files.txt', help='List of .txt posts to evaluate')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_FILE, help='Where per-document counts are stored')
+    parser.add_argument('--full', action='store_true', help='Rescore every document')
+    parser.add_argument('--error-table', default=default_table_path('.'),
+                        help="Where the error table is written (query it with 'python error_table.py query')")
+    args = parser.parse_args()
+
+    with open(args.files, 'r') as f:
+        doc_ids = [line.strip().replace('.txt', '') for line in f if line.strip()]
+
+    start = time.perf_counter()
+    cache = load_cache(args.cache)
+    rescored, skipped = update_counts(doc_ids, cache, force=args.full)
+    save_cache(cache, args.cache)
+    elapsed = time.perf_counter() - start
+
+    evaluated = [d for d in doc_ids if d in cache['docs']]
+    print(f"Evaluated {len(evaluated)} posts ({rescored} rescored, {len(evaluated) - rescored} from cache) "
+          f"in {elapsed * 1000:.1f} ms. Skipped {skipped} due to missing files.")
+    error_table = update_error_table(args.error_table, evaluated)
+    print(f"Error table: {len(error_table)} rows -> {args.error_table}")
+    for mode in MODES:
+        _, counts = count_matrix(cache, mode, evaluated)
+        metrics = corpus_metrics(counts)
+        print(f"\n[{mode.upper()}]")
+        for name in ('micro', 'macro_doc', 'macro_label'):
+            p, r, f1 = metrics[name]
+            print(f"{name:<12} Precision={p:.3f}, Recall={r:.3f}, F1={f1:.3f}")
+        for label, (p, r, f1) in metrics['per_label'].items():
+            print(f"  {label:<10} Precision={p:.3f}, Recall={r:.3f}, F1={f1:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+import os
+import re
+import time
+import zlib
+import argparse
+import importlib.util
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from step1_entity_enumeration import parse_ann_line
+
+# Accuracy of SNOMED-CT linking against the gold codes of cadec/sct.
+#
+# Every ADR of cadec/original is aligned by its offsets with the cadec/sct line
+# covering the same fragments, whose code(s) are the gold answer (ADRs without
+# a coded sct line are left out). The candidates are all concepts annotated
+# anywhere in cadec/sct, so each mention is ranked against the whole concept
+# vocabulary rather than only the codes of its own post, as step6 does.
+#
+# Scorers fill mention x concept similarity matrices, one block of mentions at a time:
+#   ngram     - cosine of hashed character trigram counts (NumPy only)
+#   fuzzy     - fuzz.token_set_ratio, as in step6; computed with rapidfuzz's
+#               multi-threaded cdist when rapidfuzz is installed, else pair by
+#               pair with fuzzywuzzy (slow on the whole corpus)
+#   embedding - cosine of step6's sentence embeddings, through the embedding cache
+#   combined  - weighted sum of other scorers (by default fuzzy and embedding)
+# By default every scorer whose library is installed runs: fuzzy needs rapidfuzz
+# (fuzzywuzzy takes minutes on the whole corpus, so it only runs when asked for
+# with --scorers), embedding needs sentence_transformers, and combined needs both.
+# Each mention gets the rank of its best-ranked gold concept (ties are broken by
+# concept order, like an argmax), from which top-k accuracy and MRR are reported
+# per drug and overall, along with the seconds each scorer took.
+
+ANN_ROOT = 'cadec'
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+SCORERS = ('ngram', 'fuzzy', 'embedding', 'combined')
+# Library each default scorer needs
+SCORER_REQUIREMENTS = {'fuzzy': 'rapidfuzz', 'embedding': 'sentence_transformers'}
+NGRAM_DIM = 4096
+SCT_CONCEPT_PATTERN = re.compile(r'(\d{6,18})\s*\|([^|]*)\|')
+
+
+def read_sct_concepts(prefix):
+    """(code, term) pairs of the code part of a cadec/sct line, e.g. '76948002 | Severe pain |+ 21522001 | Abdominal pain |'."""
+    return [(code, term.strip()) for code, term in SCT_CONCEPT_PATTERN.findall(prefix + '|')]
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.readlines()
+
+
+def load_linking_data(doc_ids, ann_root=ANN_ROOT):
+    """
+    Aligns the ADRs of `doc_ids` with their gold SNOMED-CT codes.
+    Returns:
+        (list, list, dict): Mentions as (doc_id, text, gold codes) for ADRs with
+        a coded sct line; the concept vocabulary as (code, term) pairs (the most
+        frequent term of each code, over all of cadec/sct); and counts of
+        'adrs', 'aligned' and 'concept_less' ADRs.
+    """
+    terms = defaultdict(Counter)
+    sct_dir = os.path.join(ann_root, 'sct')
+    gold = {}
+    wanted = set(doc_ids)
+    for filename in sorted(os.listdir(sct_dir)):
+        if not filename.endswith('.ann'):
+            continue
+        doc_id = filename[:-len('.ann')]
+        for line in _read_lines(os.path.join(sct_dir, filename)):
+            parsed = parse_ann_line(line)
+            if parsed is None:
+                continue
+            prefix, fragments, _ = parsed
+            concepts = read_sct_concepts(prefix)
+            for code, term in concepts:
+                terms[code][term] += 1
+            if doc_id in wanted and concepts:
+                gold[(doc_id, tuple(fragments))] = sorted({code for code, _ in concepts})
+
+    mentions, counts = [], Counter()
+    for doc_id in doc_ids:
+        ann_file = os.path.join(ann_root, 'original', doc_id + '.ann')
+        if not os.path.exists(ann_file):
+            continue
+        for line in _read_lines(ann_file):
+            parsed = parse_ann_line(line)
+            if parsed is None or parsed[0] != 'ADR':
+                continue
+            _, fragments, text = parsed
+            counts['adrs'] += 1
+            codes = gold.get((doc_id, tuple(fragments)))
+            if codes is None:
+                counts['concept_less'] += 1
+                continue
+            counts['aligned'] += 1
+            mentions.append((doc_id, text, codes))
+    concepts = [(code, term_counts.most_common(1)[0][0]) for code, term_counts in sorted(terms.items())]
+    return mentions, concepts, counts
+
+
+# ----- scorers -----
+
+def _normalize(text):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+
+def ngram_vectors(texts, dim=NGRAM_DIM):
+    """L2-normalized hashed character trigram counts of the normalized texts, as a (texts, dim) float32 matrix."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    rows, columns = [], []
+    for i, text in enumerate(texts):
+        padded = f' {_normalize(text)} '
+        hashes = [zlib.crc32(padded[j:j + 3].encode('utf-8')) % dim for j in range(len(padded) - 2)]
+        rows.extend([i] * len(hashes))
+        columns.extend(hashes)
+    np.add.at(vectors, (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)), 1.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class NgramScorer:
+    name = 'ngram'
+
+    def __init__(self, terms):
+        self.term_vectors = ngram_vectors(terms)
+
+    def score(self, texts):
+        return ngram_vectors(texts) @ self.term_vectors.T
+
+
+class FuzzyScorer:
+    """token_set_ratio / 100, with rapidfuzz when available."""
+    name = 'fuzzy'
+
+    def __init__(self, terms):
+        self.terms = terms
+        try:
+            from rapidfuzz import fuzz, process, utils
+            self._cdist = lambda texts: process.cdist(texts, terms, scorer=fuzz.token_set_ratio,
+                                                      processor=utils.default_process, dtype=np.float32, workers=-1)
+            self.backend = 'rapidfuzz'
+        except ImportError:
+            from fuzzywuzzy import fuzz
+            self._cdist = lambda texts: np.array([[fuzz.token_set_ratio(text, term) for term in terms]
+                                                  for text in texts], dtype=np.float32)
+            self.backend = 'fuzzywuzzy'
+
+    def score(self, texts):
+        return self._cdist(texts) / 100.0
+
+
+class EmbeddingScorer:
+    """Cosine similarity of step6's sentence embeddings; vectors are read from and added to the embedding cache."""
+    name = 'embedding'
+
+    def __init__(self, terms, model_name=EMBEDDING_MODEL):
+        from autotune import get_profile, apply_threads, load_model
+        from embedding_cache import EmbeddingCache
+        profile = get_profile('encoder', model_name)
+        apply_threads(profile)
+        self.model, _ = load_model('encoder', model_name, profile['backend'])
+        self.batch_size = profile['batch_size']
+        self.cache = EmbeddingCache(model_name)
+        self.term_vectors = self._encode(terms)
+
+    def _encode(self, texts):
+        vectors = np.asarray(self.cache.encode(list(texts), self.model, batch_size=self.batch_size), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def score(self, texts):
+        return self._encode(texts) @ self.term_vectors.T
+
+
+def make_scorer(name, terms):
+    return {'ngram': NgramScorer, 'fuzzy': FuzzyScorer, 'embedding': EmbeddingScorer}[name](terms)
+
+
+# ----- ranking -----
+
+def gold_ranks(scores, gold_mask):
+    """
+    Rank (1 = best) of the best-ranked gold concept of each mention.
+    Args:
+        scores (np.ndarray): (mentions, concepts) similarities.
+        gold_mask (np.ndarray): (mentions, concepts) bool, True for gold concepts.
+    Ties are broken by concept order, so rank 1 is what an argmax would return.
+    """
+    best_gold = np.where(gold_mask, scores, -np.inf).max(axis=1)
+    greater = (scores > best_gold[:, None]).sum(axis=1)
+    tied = scores == best_gold[:, None]
+    first_gold = np.argmax(tied & gold_mask, axis=1)
+    tied_before = (tied & ~gold_mask & (np.arange(scores.shape[1]) < first_gold[:, None])).sum(axis=1)
+    return 1 + greater + tied_before
+
+
+def evaluate_linking(mentions, concepts, scorers, combine=None, block_size=512):
+    """
+    Ranks every mention against every concept with each scorer, in blocks of
+    distinct mention texts.
+    Args:
+        mentions (list): (doc_id, text, gold codes) from load_linking_data.
+        concepts (list): (code, term) candidates.
+        scorers (list): Scorer objects (make_scorer).
+        combine (dict): Optional scorer name -> weight for the 'combined' scorer.
+    Returns:
+        (dict, dict): scorer name -> int array of ranks (one per mention), and
+        scorer name -> seconds spent scoring.
+    """
+    code_index = {code: i for i, (code, _) in enumerate(concepts)}
+    texts = sorted({text for _, text, _ in mentions})
+    text_index = {text: i for i, text in enumerate(texts)}
+    mention_text = np.array([text_index[text] for _, text, _ in mentions], dtype=np.int64)
+    order = np.argsort(mention_text, kind='stable')
+    bounds = np.searchsorted(mention_text[order], np.arange(0, len(texts) + block_size, block_size))
+
+    names = [scorer.name for scorer in scorers] + (['combined'] if combine else [])
+    ranks = {name: np.zeros(len(mentions), dtype=np.int64) for name in names}
+    seconds = Counter()
+    for block, start in enumerate(range(0, len(texts), block_size)):
+        block_texts = texts[start:start + block_size]
+        block_mentions = order[bounds[block]:bounds[block + 1]]
+        rows = mention_text[block_mentions] - start
+        gold_mask = np.zeros((len(block_mentions), len(concepts)), dtype=bool)
+        for i, mention in enumerate(block_mentions):
+            gold_mask[i, [code_index[code] for code in mentions[mention][2]]] = True
+
+        block_scores = {}
+        for scorer in scorers:
+            scorer_start = time.perf_counter()
+            block_scores[scorer.name] = scorer.score(block_texts)
+            seconds[scorer.name] += time.perf_counter() - scorer_start
+        if combine:
+            scorer_start = time.perf_counter()
+            block_scores['combined'] = sum(weight * block_scores[name] for name, weight in combine.items())
+            seconds['combined'] += time.perf_counter() - scorer_start
+        for name in names:
+            ranks[name][block_mentions] = gold_ranks(block_scores[name][rows], gold_mask)
+    if combine:
+        # The combined scorer costs its components plus the weighted sum
+        seconds['combined'] += sum(seconds[name] for name in combine)
+    return ranks, dict(seconds)
+
+
+def linking_metrics(ranks, ks=(1, 5)):
+    """top-k accuracies and MRR of an array of gold ranks."""
+    if not len(ranks):
+        return {**{f'top{k}': 0.0 for k in ks}, 'mrr': 0.0}
+    return {**{f'top{k}': float((ranks <= k).mean()) for k in ks}, 'mrr': float((1.0 / ranks).mean())}
+
+
+def print_report(mentions, ranks, seconds, ks=(1, 5)):
+    names = list(ranks)
+    print(f"{'scorer':<10}" + ''.join(f'{f"top{k}":>8}' for k in ks) + f"{'MRR':>8}{'seconds':>9}")
+    for name in names:
+        metrics = linking_metrics(ranks[name], ks)
+        print(f'{name:<10}' + ''.join(f"{metrics[f'top{k}']:>8.3f}" for k in ks) + f"{metrics['mrr']:>8.3f}"
+              f'{seconds.get(name, 0.0):>9.2f}')
+
+    drugs = np.array([doc_id.split('.')[0] for doc_id, _, _ in mentions])
+    print(f"\nPer drug (top{ks[0]} / MRR):")
+    print(f"  {'drug':<22}{'ADRs':>6}" + ''.join(f'{name:>16}' for name in names))
+    for drug, count in Counter(drugs.tolist()).most_common():
+        in_drug = drugs == drug
+        cells = []
+        for name in names:
+            metrics = linking_metrics(ranks[name][in_drug], ks)
+            cells.append(f"{metrics[f'top{ks[0]}']:.3f} / {metrics['mrr']:.3f}".rjust(16))
+        print(f'  {drug:<22}{count:>6}' + ''.join(cells))
+
+
+def default_scorers():
+    """The scorers whose libraries are installed; combined only when fuzzy and embedding both are."""
+    missing = {name for name, module in SCORER_REQUIREMENTS.items() if importlib.util.find_spec(module) is None}
+    names = [name for name in SCORERS if name not in missing and not (name == 'combined' and missing)]
+    for name in sorted(missing):
+        print(f'Not running {name} by default: {SCORER_REQUIREMENTS[name]} is not installed')
+    if missing:
+        print('Not running combined by default: it needs ' + ' and '.join(sorted(SCORER_REQUIREMENTS)))
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score SNOMED-CT linkers against the gold codes of cadec/sct.')
+    parser.add_argument('--files', default=None, help='List of .txt posts to evaluate (default: the whole corpus)')
+    parser.add_argument('--scorers', default=None,
+                        help=f"Comma-separated, from {', '.join(SCORERS)} (default: those whose libraries are installed)")
+    parser.add_argument('--combine', default='fuzzy=0.5,embedding=0.5',
+                        help='Weights of the scorers summed by the combined scorer')
+    parser.add_argument('--block-size', type=int, default=512, help='Distinct mention texts scored at once')
+    parser.add_argument('--top-k', default='1,5', help='Comma-separated k of the top-k accuracies')
+    args = parser.parse_args()
+
+    if args.files:
+        with open(args.files, 'r') as f:
+            doc_ids = [line.strip().replace('.txt', '') for line in f if line.strip()]
+    else:
+        doc_ids = sorted(f[:-len('.ann')] for f in os.listdir(os.path.join(ANN_ROOT, 'original')) if f.endswith('.ann'))
+
+    start = time.perf_counter()
+    mentions, concepts, counts = load_linking_data(doc_ids)
+    print(f"{counts['adrs']} ADRs in {len(doc_ids)} posts: {counts['aligned']} with gold SNOMED-CT codes, "
+          f"{counts['concept_less']} without (left out). {len(concepts)} candidate concepts. "
+          f"Loaded in {time.perf_counter() - start:.2f}s")
+
+    names = [name for name in args.scorers.split(',') if name] if args.scorers else default_scorers()
+    combine = None
+    if 'combined' in names:
+        combine = {name: float(weight) for name, weight in (item.split('=') for item in args.combine.split(','))}
+        names = [name for name in names if name != 'combined']
+        names += [name for name in combine if name not in names]
+    terms = [term for _, term in concepts]
+    scorers = []
+    for name in names:
+        try:
+            scorer = make_scorer(name, terms)
+        except ImportError as error:
+            print(f'Skipping {name}: {error}')
+            if combine and name in combine:
+                print('Skipping combined: it needs ' + name)
+                combine = None
+            continue
+        if name == 'fuzzy' and scorer.backend != 'rapidfuzz':
+            print('rapidfuzz is not installed; fuzzy scores are computed pair by pair with fuzzywuzzy (slow)')
+        scorers.append(scorer)
+
+    ranks, seconds = evaluate_linking(mentions, concepts, scorers, combine, args.block_size)
+    print()
+    print_report(mentions, ranks, seconds, tuple(int(k) for k in args.top_k.split(',')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Self-contained model artifacts for fast, offline cold starts.
+#
+# 'python model_artifact.py build-artifact ner' (or 'encoder') packages a model
+# into artifacts/<task>/<model id>/:
+#   model.safetensors, config.json - weights and config (save_pretrained with
+#                                    safetensors, so loading memory-maps the weights)
+#   tokenizer files                - the tokenizer, saved next to the model
+#   traced.pt                      - optional TorchScript graph (--trace, ner), traced
+#                                    at the maximum length and checked against the
+#                                    eager model on other shapes before it is saved
+#   manifest.json                  - source model, revision, library versions
+# The encoder is saved with SentenceTransformer.save in the same directory layout.
+#
+# load_ner_model / load_encoder are the loaders used by the entry points: when
+# an artifact exists for the model (or the model name is an artifact directory),
+# they load it with local_files_only, so no hub lookup, network access or
+# random weight initialization happens. Otherwise they say so and fall back to
+# the hub as before. The traced graph is only used when a caller asks for it.
+# 'bench' times both cold starts in fresh processes.
+
+DEFAULT_ARTIFACT_DIR = 'artifacts'
+MANIFEST_FILE = 'manifest.json'
+TRACED_FILE = 'traced.pt'
+DEFAULT_MODELS = {'ner': 'd4data/biomedical-ner-all', 'encoder': 'all-MiniLM-L6-v2'}
+
+
+def artifact_path(task, model_name, artifact_dir=DEFAULT_ARTIFACT_DIR):
+    return os.path.join(artifact_dir, task, model_name.replace('/', '__'))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def find_artifact(task, model_name, artifact_dir=DEFAULT_ARTIFACT_DIR):
+    """
+    Returns the artifact directory of (task, model): `model_name` itself if it
+    is an artifact, else the built artifact under `artifact_dir` (unless it is
+    None), else None.
+    """
+    paths = [model_name] + ([artifact_path(task, model_name, artifact_dir)] if artifact_dir is not None else [])
+    for path in paths:
+        if os.path.exists(os.path.join(path, MANIFEST_FILE)) and read_manifest(path)['task'] == task:
+            return path
+    return None
+
+
+def build_artifact(task, model_name, artifact_dir=DEFAULT_ARTIFACT_DIR, trace=False):
+    """
+    Packages a model (from the hub or a local directory) into an artifact directory.
+    Returns:
+        str: The artifact directory.
+    """
+    import torch
+    import transformers
+
+    path = artifact_path(task, model_name, artifact_dir)
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    manifest = {'task': task, 'model': model_name, 'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'torch': torch.__version__, 'transformers': transformers.__version__, 'traced': False}
+    if task == 'ner':
+        from transformers import AutoTokenizer, AutoModelForTokenClassification
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForTokenClassification.from_pretrained(model_name).eval()
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_path)
+        manifest['revision'] = getattr(model.config, '_commit_hash', None)
+        if trace:
+            torch.jit.save(trace_model(model_name, model, tokenizer), os.path.join(tmp_path, TRACED_FILE))
+            manifest['traced'] = True
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device='cpu')
+        model.save(tmp_path, safe_serialization=True)
+        manifest['revision'] = None
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Replace a previous artifact only once the new one is complete
+    if os.path.exists(path):
+        import shutil
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def trace_model(model_name, model, tokenizer, max_length=512, atol=1e-4):
+    """
+    Traces a token classifier at the maximum input length and checks that the
+    graph matches the eager `model` on batches of other shapes, so a trace that
+    baked in the example's shape is never saved.
+    Returns:
+        torch.jit.ScriptModule: The traced graph.
+    """
+    import torch
+    from transformers import AutoModelForTokenClassification
+
+    max_length = min(max_length, tokenizer.model_max_length)
+    sentence = 'Example post about muscle pain after taking Lipitor.'
+    # torchscript=True makes the model return tuples, which tracing needs
+    traced_model = AutoModelForTokenClassification.from_pretrained(model_name, torchscript=True).eval()
+    example = tokenizer([sentence], padding='max_length', max_length=max_length, return_tensors='pt')
+    checks = [tokenizer([sentence, sentence * 3], padding=True, return_tensors='pt'),
+              tokenizer([sentence * 100] * 2, truncation=True, max_length=max_length, return_tensors='pt'),
+              example]
+    with torch.inference_mode():
+        graph = torch.jit.trace(traced_model, (example['input_ids'], example['attention_mask']), strict=False)
+        for check in checks:
+            expected = model(input_ids=check['input_ids'], attention_mask=check['attention_mask']).logits
+            actual = graph(check['input_ids'], check['attention_mask'])[0]
+            if actual.shape != expected.shape or not torch.allclose(actual, expected, atol=atol):
+                raise ValueError(f'traced graph of {model_name} does not match the eager model on input shape '
+                                 f'{tuple(check["input_ids"].shape)}; build the artifact without --trace')
+    return graph
+
+
+class TracedTokenClassifier:
+    """
+    Runs the TorchScript graph of an artifact like a token-classification model:
+    `model(input_ids=..., attention_mask=...).logits`, with `model.config` for the labels.
+    """
+
+    def __init__(self, graph, config):
+        self.graph = graph
+        self.config = config
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask):
+        return _Logits(self.graph(input_ids, attention_mask)[0])
+
+
+class _Logits:
+    __slots__ = ('logits',)
+
+    def __init__(self, logits):
+        self.logits = logits
+
+
+def _warn_no_artifact(task, model_name, artifact_dir):
+    # Loading from the hub needs the network (or a warm hub cache), so say so instead of silently falling back
+    if artifact_dir is not None:
+        print(f"No artifact for {model_name} under {artifact_dir}/, loading it from the hub "
+              f"(build one with 'python model_artifact.py build-artifact {task} --model {model_name}')",
+              file=sys.stderr)
+
+
+def load_ner_model(model_name, traced=False, artifact_dir=DEFAULT_ARTIFACT_DIR):
+    """
+    Loads a token-classification model and its tokenizer, from its artifact when
+    one exists. With `traced`, the artifact's TorchScript graph is returned
+    (as a TracedTokenClassifier) if it has one; pipelines need the eager model.
+    Returns:
+        (model, tokenizer)
+    """
+    from transformers import AutoTokenizer, AutoModelForTokenClassification
+    path = find_artifact('ner', model_name, artifact_dir)
+    if path is None:
+        _warn_no_artifact('ner', model_name, artifact_dir)
+        return AutoModelForTokenClassification.from_pretrained(model_name).eval(), AutoTokenizer.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+    if traced and read_manifest(path)['traced']:
+        import torch
+        from transformers import AutoConfig
+        graph = torch.jit.load(os.path.join(path, TRACED_FILE))
+        return TracedTokenClassifier(graph, AutoConfig.from_pretrained(path, local_files_only=True)), tokenizer
+    model = AutoModelForTokenClassification.from_pretrained(path, local_files_only=True, low_cpu_mem_usage=True)
+    return model.eval(), tokenizer
+
+
+def load_encoder(model_name, artifact_dir=DEFAULT_ARTIFACT_DIR):
+    """Loads a sentence encoder on the CPU, from its artifact when one exists."""
+    from sentence_transformers import SentenceTransformer
+    path = find_artifact('encoder', model_name, artifact_dir)
+    if path is None:
+        _warn_no_artifact('encoder', model_name, artifact_dir)
+        return SentenceTransformer(model_name, device='cpu')
+    return SentenceTransformer(path, device='cpu', local_files_only=True)
+
+
+def model_revision(model_name, artifact_dir=DEFAULT_ARTIFACT_DIR):
+    """Hub revision of a NER model: the one recorded in its artifact, else the one of the cached hub config."""
+    path = find_artifact('ner', model_name, artifact_dir)
+    if path is not None:
+        return read_manifest(path).get('revision')
+    from transformers import AutoConfig
+    return getattr(AutoConfig.from_pretrained(model_name), '_commit_hash', None)
+
+
+def _time_load(task, model_name, use_artifact):
+    """Loads a model as an entry point would and returns the seconds taken, imports included."""
+    start = time.perf_counter()
+    artifact_dir = DEFAULT_ARTIFACT_DIR if use_artifact else None
+    if task == 'ner':
+        load_ner_model(model_name, artifact_dir=artifact_dir)
+    else:
+        load_encoder(model_name, artifact_dir=artifact_dir)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build self-contained model artifacts and time cold starts.')
+    parser.add_argument('command', choices=['build-artifact', 'bench', 'load'])
+    parser.add_argument('task', choices=sorted(DEFAULT_MODELS))
+    parser.add_argument('--model', default=None, help='Defaults to the model of the batch script (ner) or step6 (encoder)')
+    parser.add_argument('--trace', action='store_true', help='Also save a TorchScript graph (ner)')
+    parser.add_argument('--repeat', type=int, default=3, help='Cold starts per variant for bench')
+    parser.add_argument('--no-artifact', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    model_name = args.model or DEFAULT_MODELS[args.task]
+
+    if args.command == 'build-artifact':
+        start = time.perf_counter()
+        path = build_artifact(args.task, model_name, trace=args.trace)
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, f)))
+        print(f'Built {path} ({size / 2 ** 20:.1f} MB) in {time.perf_counter() - start:.1f}s')
+        return
+    if args.command == 'load':
+        # One cold start, run by 'bench' in a fresh interpreter
+        print(json.dumps({'seconds': _time_load(args.task, model_name, not args.no_artifact)}))
+        return
+
+    if find_artifact(args.task, model_name) is None:
+        parser.error(f"no artifact for {model_name}; run 'python model_artifact.py build-artifact {args.task}' first")
+    for label, extra in (('hub', ['--no-artifact']), ('artifact', [])):
+        seconds = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, __file__, 'load', args.task, '--model', model_name] + extra,
+                                    check=True, capture_output=True, text=True).stdout
+            seconds.append(json.loads(output.strip().splitlines()[-1])['seconds'])
+        print(f"{label:<9} cold start: best {min(seconds):.2f}s, mean {sum(seconds) / len(seconds):.2f}s "
+              f"over {len(seconds)} runs")
+
+
+if __name__ == '__main__':
+    main()
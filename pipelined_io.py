@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Overlapping I/O with inference.
+#
+#   prefetch()       - reads upcoming items in a thread pool while the caller
+#                      works on the current ones; at most `depth` reads are in
+#                      flight, so memory stays bounded
+#   BackgroundWriter - a writer thread fed through a bounded queue, so
+#                      serializing and flushing outputs happens off the critical path
+#
+# Both keep input order and record how long the caller had to wait on them,
+# which shows whether the model is ever held up by I/O.
+
+
+class IOStats:
+    """Seconds the consumer waited on reads or writes, and seconds spent in I/O threads."""
+
+    def __init__(self):
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + seconds)
+
+
+def prefetch(items, load, workers=4, depth=16, stats=None):
+    """
+    Yields (item, load(item)) in input order, loading up to `depth` items ahead
+    in `workers` threads. With depth=0 every item is loaded inline when needed.
+    """
+    stats = stats or IOStats()
+
+    def timed_load(item):
+        start = time.perf_counter()
+        value = load(item)
+        stats.add('read_seconds', time.perf_counter() - start)
+        return value
+
+    if depth <= 0:
+        for item in items:
+            start = time.perf_counter()
+            value = timed_load(item)
+            stats.add('read_wait', time.perf_counter() - start)
+            yield item, value
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(timed_load, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            start = time.perf_counter()
+            value = future.result()
+            stats.add('read_wait', time.perf_counter() - start)
+            # Keep the window full: start the next read before handing this item over
+            for next_item in items:
+                pending.append((next_item, pool.submit(timed_load, next_item)))
+                break
+            yield item, value
+
+
+def write_json(path, data):
+    """Writes compact JSON through a temporary file, so readers never see a half-written file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class BackgroundWriter:
+    """
+    Runs write calls in a background thread, in submission order.
+    Args:
+        max_pending (int): Queue bound; `submit` blocks when this many writes are waiting.
+        background (bool): If False, writes run inline in `submit` (for comparison).
+        stats (IOStats): Where waiting and writing time are recorded.
+    Use as a context manager; leaving the block waits for all writes and
+    re-raises the first write error.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_pending=64, background=True, stats=None):
+        self.stats = stats or IOStats()
+        self.background = background
+        self.written = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, name='background-writer', daemon=True)
+            self._thread.start()
+
+    def _write(self, function, args):
+        start = time.perf_counter()
+        function(*args)
+        self.stats.add('write_seconds', time.perf_counter() - start)
+        self.written += 1
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is self._STOP:
+                return
+            if self._error is None:
+                try:
+                    self._write(*task)
+                except Exception as error:
+                    self._error = error
+
+    def submit(self, function, *args):
+        """Queues `function(*args)`, e.g. submit(write_json, path, data)."""
+        if self._error is not None:
+            raise self._error
+        start = time.perf_counter()
+        if self.background:
+            self._queue.put((function, args))
+            self.stats.add('write_wait', time.perf_counter() - start)
+        else:
+            self._write(function, args)
+            self.stats.add('write_wait', time.perf_counter() - start)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
@@ -0,0 +1,292 @@
+import os
+import json
+import glob
+import time
+import hashlib
+import argparse
+from collections import Counter
+
+import numpy as np
+
+from spans import LABEL_BITS, LABELS, SpanTable, mask_labels
+from step3_evaluate_predictions import load_predicted_spans
+from incremental_eval import MODES, score_document, corpus_metrics
+
+# Registry of prediction runs.
+#
+# batch_generate_predicted_spans.py overwrites the *_predicted_spans.json files
+# on every run. snapshot_run() stores a copy of a run under runs/<run_id>/:
+#   spans.npz  - the predicted spans as SpanTable columns (doc, start, end, labels),
+#                the doc ids, and per-document tp/fp/fn counts for every matching mode
+#   meta.json  - model, revision, label map, thresholds, timings, metrics, ...
+#
+# diff_runs() compares two snapshots with sorted-array joins on the packed
+# (doc, start, end) span keys: spans only in the new run are 'added', spans only
+# in the old run are 'removed', and spans in both with different label bitmasks
+# are 'relabeled'.
+
+DEFAULT_REGISTRY_DIR = 'runs'
+
+
+def read_prediction_dir(pred_dir='.', doc_ids=None):
+    """
+    Reads *_predicted_spans.json files into one SpanTable.
+    Args:
+        pred_dir (str): Directory holding the prediction files.
+        doc_ids (list of str): Docs to read; defaults to every prediction file in `pred_dir`.
+    """
+    if doc_ids is None:
+        suffix = '_predicted_spans.json'
+        doc_ids = sorted(os.path.basename(path)[:-len(suffix)] for path in glob.glob(os.path.join(pred_dir, '*' + suffix)))
+    tables = []
+    for doc_id in doc_ids:
+        pred_file = os.path.join(pred_dir, doc_id + '_predicted_spans.json')
+        if os.path.exists(pred_file):
+            tables.append(SpanTable.from_rows(load_predicted_spans(pred_file), doc_names=[doc_id]))
+    return SpanTable.concat(tables)
+
+
+def snapshot_run(pred_dir='.', doc_ids=None, meta=None, registry_dir=DEFAULT_REGISTRY_DIR, gold_dir='cadec/original'):
+    """
+    Stores the current predictions of `pred_dir` as a new run.
+    Args:
+        meta (dict): Extra run metadata (model, revision, label_map, thresholds, timings, ...).
+    Returns:
+        str: The new run id.
+    """
+    table = read_prediction_dir(pred_dir, doc_ids).sort()
+    names = table.doc_names
+
+    # Per-document counts, so metrics (and bootstrap_stats) can be recomputed on any doc subset later
+    scored = np.zeros(len(names), dtype=bool)
+    counts = {mode: np.zeros((len(names), len(LABELS), 3), dtype=np.int32) for mode in MODES}
+    for i, doc_id in enumerate(names):
+        ann_file = os.path.join(gold_dir, doc_id + '.ann')
+        if not os.path.exists(ann_file):
+            continue
+        doc_counts = score_document(ann_file, os.path.join(pred_dir, doc_id + '_predicted_spans.json'))
+        for mode in MODES:
+            counts[mode][i] = doc_counts[mode]
+        scored[i] = True
+
+    digest = hashlib.sha1(table.keys().tobytes() + table.labels.tobytes() + '\n'.join(names).encode('utf-8'))
+    run_id = time.strftime('%Y%m%d-%H%M%S') + '-' + digest.hexdigest()[:6]
+    run_dir = os.path.join(registry_dir, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    np.savez_compressed(os.path.join(run_dir, 'spans.npz'), doc=table.doc, start=table.start, end=table.end,
+                        labels=table.labels, doc_names=np.array(names, dtype=str), scored=scored,
+                        **{'counts_' + mode: counts[mode] for mode in MODES})
+
+    run_meta = dict(meta or {})
+    run_meta.update({
+        'run_id': run_id,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'pred_dir': os.path.abspath(pred_dir),
+        'docs': len(names),
+        'spans': len(table),
+        'label_counts': table.label_counts(),
+        'metrics': {mode: corpus_metrics(counts[mode][scored]) for mode in MODES},
+    })
+    with open(os.path.join(run_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(run_meta, f, indent=2)
+    return run_id
+
+
+def list_runs(registry_dir=DEFAULT_REGISTRY_DIR):
+    """Returns the metadata of every stored run, oldest first."""
+    runs = []
+    for meta_file in glob.glob(os.path.join(registry_dir, '*', 'meta.json')):
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            runs.append(json.load(f))
+    return sorted(runs, key=lambda meta: meta['run_id'])
+
+
+def resolve_run(name, registry_dir=DEFAULT_REGISTRY_DIR):
+    """
+    Resolves 'latest', 'previous', or a unique run id prefix to a run id.
+    Raises:
+        ValueError: If no run, or more than one run, matches.
+    """
+    run_ids = [meta['run_id'] for meta in list_runs(registry_dir)]
+    if name in ('latest', 'previous'):
+        index = -1 if name == 'latest' else -2
+        if len(run_ids) < -index:
+            raise ValueError(f'Not enough runs in {registry_dir} for {name!r}')
+        return run_ids[index]
+    matches = [run_id for run_id in run_ids if run_id.startswith(name)]
+    if len(matches) != 1:
+        raise ValueError(f'{name!r} matches {len(matches)} runs in {registry_dir}')
+    return matches[0]
+
+
+def load_run(run_id, registry_dir=DEFAULT_REGISTRY_DIR):
+    """
+    Loads a stored run.
+    Returns:
+        (dict, SpanTable, dict): The metadata, the spans, and {mode: counts} where
+        counts is (n_docs, n_labels, 3) with rows of unscored docs (no gold file) dropped,
+        plus 'doc_ids' listing the scored docs.
+    """
+    run_dir = os.path.join(registry_dir, run_id)
+    with open(os.path.join(run_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    data = np.load(os.path.join(run_dir, 'spans.npz'))
+    names = data['doc_names'].tolist()
+    table = SpanTable(data['doc'], data['start'], data['end'], data['labels'], names)
+    scored = data['scored']
+    counts = {mode: data['counts_' + mode][scored] for mode in MODES}
+    counts['doc_ids'] = [name for name, is_scored in zip(names, scored) if is_scored]
+    return meta, table, counts
+
+
+def _remap_docs(table, names):
+    """Returns the table with its doc indices rewritten into the sorted name list `names`."""
+    lookup = np.searchsorted(names, np.array(table.doc_names, dtype=str)) if table.doc_names else np.zeros(0, np.int64)
+    return SpanTable(lookup[table.doc] if len(table) else table.doc, table.start, table.end, table.labels, list(names))
+
+
+def diff_runs(old, new):
+    """
+    Compares the spans of two runs.
+    Args:
+        old, new (SpanTable): Spans of the two runs (e.g. from `load_run`).
+    Returns:
+        dict: 'added' and 'removed' SpanTables, 'relabeled' SpanTable (holding the
+        new labels) with 'relabeled_from' (the old label bitmasks), the number of
+        'unchanged' spans, and the shared 'doc_names' all tables index into.
+    """
+    names = np.array(sorted(set(old.doc_names) | set(new.doc_names)), dtype=str)
+    old, new = _remap_docs(old, names).sort(), _remap_docs(new, names).sort()
+    old_keys, new_keys = old.keys(), new.keys()
+
+    # Sorted-array join: position of each old key among the new keys
+    position = np.searchsorted(new_keys, old_keys)
+    clipped = np.minimum(position, max(len(new_keys) - 1, 0))
+    in_new = (position < len(new_keys)) & (new_keys[clipped] == old_keys) if len(new_keys) else np.zeros(len(old_keys), bool)
+    in_old = np.zeros(len(new_keys), dtype=bool)
+    in_old[position[in_new]] = True
+
+    old_shared, new_shared = np.flatnonzero(in_new), position[in_new]
+    changed = old.labels[old_shared] != new.labels[new_shared]
+    relabeled = new._take(new_shared[changed])
+    return {
+        'doc_names': names.tolist(),
+        'added': new._take(~in_old),
+        'removed': old._take(~in_new),
+        'relabeled': relabeled,
+        'relabeled_from': old.labels[old_shared[changed]],
+        'unchanged': int((~changed).sum()),
+    }
+
+
+def metric_deltas(counts_old, counts_new):
+    """
+    Corpus metrics of two runs on the docs scored in both.
+    Returns:
+        dict: mode -> (metrics of old run, metrics of new run), as from incremental_eval.corpus_metrics.
+    """
+    shared = sorted(set(counts_old['doc_ids']) & set(counts_new['doc_ids']))
+    old_index = {doc_id: i for i, doc_id in enumerate(counts_old['doc_ids'])}
+    new_index = {doc_id: i for i, doc_id in enumerate(counts_new['doc_ids'])}
+    old_rows = [old_index[doc_id] for doc_id in shared]
+    new_rows = [new_index[doc_id] for doc_id in shared]
+    return {mode: (corpus_metrics(counts_old[mode][old_rows]), corpus_metrics(counts_new[mode][new_rows]))
+            for mode in MODES}
+
+
+def _labels_text(mask):
+    return '|'.join(mask_labels(int(mask))) or '-'
+
+
+def print_diff(diff, deltas=None, top_docs=10, show_spans=False, corpus=None):
+    names = diff['doc_names']
+    added, removed, relabeled = diff['added'], diff['removed'], diff['relabeled']
+    print(f"Added {len(added)}, removed {len(removed)}, relabeled {len(relabeled)}, unchanged {diff['unchanged']} spans")
+
+    print(f"\n{'label':<10} {'added':>7} {'removed':>8} {'gained':>7} {'lost':>6}")
+    old_labels, new_labels = diff['relabeled_from'], relabeled.labels
+    added_counts, removed_counts = added.label_counts(), removed.label_counts()
+    for label in LABELS:
+        # gained/lost: relabeled spans that got or dropped this label, counted per span so
+        # that an A -> B and a B -> A relabeling do not cancel out
+        bit = LABEL_BITS[label]
+        gained = int(np.count_nonzero(new_labels & ~old_labels & bit))
+        lost = int(np.count_nonzero(old_labels & ~new_labels & bit))
+        print(f"{label:<10} {added_counts[label]:>7} {removed_counts[label]:>8} {gained:>7} {lost:>6}")
+
+    if len(relabeled):
+        transitions = Counter(zip(diff['relabeled_from'].tolist(), relabeled.labels.tolist()))
+        print('\nRelabelings:')
+        for (before, after), count in transitions.most_common():
+            print(f"  {_labels_text(before):<20} -> {_labels_text(after):<20} {count:>6}")
+
+    per_doc = np.zeros((len(names), 3), dtype=np.int64)
+    for column, table in enumerate((added, removed, relabeled)):
+        per_doc[:, column] = np.bincount(table.doc, minlength=len(names))
+    changed_docs = np.flatnonzero(per_doc.sum(axis=1))
+    order = changed_docs[np.argsort(-per_doc[changed_docs].sum(axis=1), kind='stable')]
+    print(f"\n{len(changed_docs)} of {len(names)} docs changed; top {min(top_docs, len(order))}:")
+    for i in order[:top_docs]:
+        print(f"  {names[i]:<28} +{per_doc[i, 0]:<4} -{per_doc[i, 1]:<4} ~{per_doc[i, 2]}")
+
+    if deltas:
+        print(f"\n{'metric':<20} {'old F1':>7} {'new F1':>7} {'delta':>7}")
+        for mode, (old_metrics, new_metrics) in deltas.items():
+            for name in ('micro', 'macro_doc', 'macro_label'):
+                old_f1, new_f1 = old_metrics[name][2], new_metrics[name][2]
+                print(f"{mode + ' ' + name:<20} {old_f1:>7.3f} {new_f1:>7.3f} {new_f1 - old_f1:>+7.3f}")
+
+    if show_spans:
+        def span_line(span, labels):
+            text = corpus.slice(names[span.doc], span.start, span.end) if corpus is not None else ''
+            return f"  {names[span.doc]:<28} {span.start:>5}-{span.end:<5} {labels:<28} {text}"
+        for title, table in (('Added', added), ('Removed', removed)):
+            print(f'\n{title}:')
+            for span in table:
+                print(span_line(span, _labels_text(span.mask)))
+        print('\nRelabeled:')
+        for before, span in zip(diff['relabeled_from'].tolist(), relabeled):
+            print(span_line(span, f'{_labels_text(before)} -> {_labels_text(span.mask)}'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot prediction runs and diff them.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    snapshot = subparsers.add_parser('snapshot', help='Store the current *_predicted_spans.json files as a run')
+    snapshot.add_argument('--pred-dir', default='.')
+    snapshot.add_argument('--model', default=None, help='Model that produced the predictions')
+    snapshot.add_argument('--note', default=None)
+    subparsers.add_parser('list', help='List stored runs')
+    diff = subparsers.add_parser('diff', help='Compare two runs')
+    diff.add_argument('old', nargs='?', default='previous', help="Run id (prefix), 'latest' or 'previous'")
+    diff.add_argument('new', nargs='?', default='latest')
+    diff.add_argument('--top-docs', type=int, default=10)
+    diff.add_argument('--spans', action='store_true', help='List the changed spans with their text')
+    parser.add_argument('--registry', default=DEFAULT_REGISTRY_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        run_id = snapshot_run(args.pred_dir, meta={'model': args.model, 'note': args.note}, registry_dir=args.registry)
+        print(f'Saved run {run_id}')
+    elif args.command == 'list':
+        for meta in list_runs(args.registry):
+            f1 = meta['metrics']['relaxed']['macro_doc'][2]
+            print(f"{meta['run_id']}  {meta['docs']:>5} docs {meta['spans']:>7} spans  "
+                  f"relaxed F1={f1:.3f}  {meta.get('model') or ''}  {meta.get('note') or ''}")
+    else:
+        start = time.perf_counter()
+        old_id, new_id = resolve_run(args.old, args.registry), resolve_run(args.new, args.registry)
+        _, old_table, old_counts = load_run(old_id, args.registry)
+        _, new_table, new_counts = load_run(new_id, args.registry)
+        result = diff_runs(old_table, new_table)
+        deltas = metric_deltas(old_counts, new_counts)
+        elapsed = time.perf_counter() - start
+        print(f'{old_id} -> {new_id} ({elapsed * 1000:.1f} ms)\n')
+        corpus = None
+        if args.spans:
+            from corpus_store import open_corpus
+            corpus = open_corpus()
+        print_diff(result, deltas, args.top_docs, args.spans, corpus)
+
+
+if __name__ == '__main__':
+    main()
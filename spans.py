@@ -0,0 +1,324 @@
+import numpy as np
+
+# Shared span types for all steps.
+#
+# A span is (doc, start, end) plus a bitmask of labels, so an entity that maps
+# to several categories (e.g. 'Sign_symptom' -> Symptom and ADR) is stored once
+# instead of being duplicated per label.
+#   - Span:      a small slotted object for single spans
+#   - SpanTable: struct-of-arrays (int32 doc/start/end, uint8 labels) for whole
+#                documents or corpora, with vectorized sorting, dedupe and set operations
+
+# The four target categories, plus 'Finding' which also occurs in cadec/original
+LABELS = ('ADR', 'Drug', 'Disease', 'Symptom', 'Finding')
+LABEL_BITS = {label: 1 << i for i, label in enumerate(LABELS)}
+_LABEL_BITS_LOWER = {label.lower(): bit for label, bit in LABEL_BITS.items()}
+
+# Bit widths used to pack (doc, start, end) into one int64 key, and the label
+# index into (span, label) pair keys
+_OFFSET_BITS = 21
+_OFFSET_LIMIT = 1 << _OFFSET_BITS
+_LABEL_INDEX_BITS = 3
+_LABEL_INDEX_MASK = (1 << _LABEL_INDEX_BITS) - 1
+# Docs get the bits left in a non-negative int64 pair key: 63 - 3 - 2 * 21 = 18
+_DOC_LIMIT = 1 << (63 - _LABEL_INDEX_BITS - 2 * _OFFSET_BITS)
+
+
+def label_mask(labels):
+    """Returns the bitmask of a label or an iterable of labels (case-insensitive); unknown labels are ignored."""
+    if isinstance(labels, str):
+        labels = [labels]
+    mask = 0
+    for label in labels:
+        mask |= _LABEL_BITS_LOWER.get(label.strip().lower(), 0)
+    return mask
+
+
+def mask_labels(mask):
+    """Returns the list of label names set in a bitmask, in LABELS order."""
+    return [label for label in LABELS if mask & LABEL_BITS[label]]
+
+
+class Span:
+    """A single span: character offsets in a document plus a label bitmask."""
+    __slots__ = ('doc', 'start', 'end', 'mask')
+
+    def __init__(self, doc, start, end, mask):
+        self.doc = doc
+        self.start = start
+        self.end = end
+        self.mask = mask
+
+    @property
+    def labels(self):
+        return mask_labels(self.mask)
+
+    def has_label(self, label):
+        return bool(self.mask & label_mask(label))
+
+    def text(self, source):
+        """Returns the span text from a document string or a corpus_store.Corpus."""
+        if isinstance(source, str):
+            return source[self.start:self.end]
+        return source.slice(self.doc, self.start, self.end)
+
+    def _key(self):
+        return (self.doc, self.start, self.end, self.mask)
+
+    def __eq__(self, other):
+        return isinstance(other, Span) and self._key() == other._key()
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f'Span({self.doc!r}, {self.start}, {self.end}, {"|".join(self.labels) or "-"})'
+
+
+class SpanTable:
+    """
+    Columnar table of spans.
+    Args:
+        doc, start, end (array-like of int): Document index and character offsets.
+        labels (array-like of int): Label bitmasks.
+        doc_names (list of str): Maps document indices to doc ids (e.g. 'ARTHROTEC.1').
+    """
+
+    def __init__(self, doc, start, end, labels, doc_names=None):
+        self.doc = np.asarray(doc, dtype=np.int32)
+        self.start = np.asarray(start, dtype=np.int32)
+        self.end = np.asarray(end, dtype=np.int32)
+        self.labels = np.asarray(labels, dtype=np.uint8)
+        self.doc_names = list(doc_names) if doc_names is not None else []
+
+    # ----- construction -----
+
+    @classmethod
+    def empty(cls, doc_names=None):
+        return cls([], [], [], [], doc_names)
+
+    @classmethod
+    def from_rows(cls, rows, doc=0, doc_names=None):
+        """
+        Builds a deduplicated table from (label, start, end[, text]) rows, the
+        format of the *_predicted_spans.json files and of the parsed .ann tuples.
+        Rows with the same offsets are merged into one span with several labels.
+        """
+        rows = [row for row in rows if row[1] is not None and label_mask(row[0])]
+        table = cls(np.full(len(rows), doc), [row[1] for row in rows], [row[2] for row in rows],
+                    [label_mask(row[0]) for row in rows], doc_names)
+        return table.dedupe()
+
+    @classmethod
+    def from_spans(cls, spans, doc_names=None):
+        spans = list(spans)
+        return cls([s.doc for s in spans], [s.start for s in spans], [s.end for s in spans],
+                   [s.mask for s in spans], doc_names).dedupe()
+
+    @classmethod
+    def concat(cls, tables):
+        """Concatenates tables, appending each table's doc names to one shared list."""
+        tables = list(tables)
+        doc_names, parts = [], []
+        for table in tables:
+            parts.append(table.doc + len(doc_names))
+            doc_names.extend(table.doc_names)
+        if not parts:
+            return cls.empty()
+        return cls(np.concatenate(parts), np.concatenate([t.start for t in tables]),
+                   np.concatenate([t.end for t in tables]), np.concatenate([t.labels for t in tables]),
+                   doc_names)
+
+    # ----- basic access -----
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        for doc, start, end, mask in zip(self.doc.tolist(), self.start.tolist(),
+                                         self.end.tolist(), self.labels.tolist()):
+            yield Span(doc, start, end, mask)
+
+    def _take(self, index):
+        return SpanTable(self.doc[index], self.start[index], self.end[index], self.labels[index], self.doc_names)
+
+    def keys(self):
+        """Packs (doc, start, end) into one sortable int64 key per span."""
+        # Out-of-range values would wrap into other fields and join the wrong spans
+        if len(self):
+            if int(self.end.max()) >= _OFFSET_LIMIT or int(self.start.min()) < 0:
+                raise ValueError(f'Span offsets must be in [0, {_OFFSET_LIMIT})')
+            if int(self.doc.max()) >= _DOC_LIMIT or int(self.doc.min()) < 0:
+                raise ValueError(f'Doc indices must be in [0, {_DOC_LIMIT}) to be packed into keys')
+        return ((self.doc.astype(np.int64) << (2 * _OFFSET_BITS))
+                | (self.start.astype(np.int64) << _OFFSET_BITS)
+                | self.end.astype(np.int64))
+
+    def sort(self):
+        """Returns the table sorted by (doc, start, end)."""
+        return self._take(np.argsort(self.keys(), kind='stable'))
+
+    def dedupe(self):
+        """Returns the table sorted, with spans of identical offsets merged by OR-ing their labels."""
+        if not len(self):
+            return self
+        keys = self.keys()
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        first = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        merged = np.bitwise_or.reduceat(self.labels[order], first)
+        table = self._take(order[first])
+        table.labels = merged.astype(np.uint8)
+        return table
+
+    # ----- label membership -----
+
+    def has_label(self, label):
+        """Returns a boolean array, True for spans carrying `label` (or any of several labels)."""
+        return (self.labels & label_mask(label)) != 0
+
+    def with_label(self, label):
+        """Returns only the spans carrying `label`."""
+        return self._take(self.has_label(label))
+
+    def label_counts(self):
+        """Returns {label: number of spans carrying it}."""
+        return {label: int(np.count_nonzero(self.labels & bit)) for label, bit in LABEL_BITS.items()}
+
+    # ----- set operations on (span, label) pairs -----
+
+    def pair_keys(self):
+        """
+        Expands the table into one int64 key per (span, label) pair, so that set
+        operations are label-aware: a span with labels ADR|Symptom yields two keys.
+        """
+        keys = self.keys() << _LABEL_INDEX_BITS
+        pairs = [keys[(self.labels & bit) != 0] | i for i, bit in enumerate(LABEL_BITS.values())]
+        return _sorted_unique(np.concatenate(pairs))
+
+    @classmethod
+    def from_pair_keys(cls, pair_keys, doc_names=None):
+        pair_keys = np.asarray(pair_keys, dtype=np.int64)
+        keys = pair_keys >> _LABEL_INDEX_BITS
+        bits = (np.ones_like(pair_keys) << (pair_keys & _LABEL_INDEX_MASK)).astype(np.uint8)
+        table = cls(keys >> (2 * _OFFSET_BITS), (keys >> _OFFSET_BITS) & (_OFFSET_LIMIT - 1),
+                    keys & (_OFFSET_LIMIT - 1), bits, doc_names)
+        return table.dedupe()
+
+    def intersect(self, other):
+        """Spans (with the labels) present in both tables."""
+        return SpanTable.from_pair_keys(np.intersect1d(self.pair_keys(), other.pair_keys(), assume_unique=True),
+                                        self.doc_names)
+
+    def difference(self, other):
+        """Spans (with the labels) present in this table but not in `other`."""
+        return SpanTable.from_pair_keys(np.setdiff1d(self.pair_keys(), other.pair_keys(), assume_unique=True),
+                                        self.doc_names)
+
+    def union(self, other):
+        return SpanTable.from_pair_keys(_sorted_unique(np.concatenate((self.pair_keys(), other.pair_keys()))),
+                                        self.doc_names)
+
+    def match_counts(self, gold):
+        """Returns exact-match (tp, fp, fn) counts of this table against `gold`, over (span, label) pairs."""
+        pred_keys, gold_keys = self.pair_keys(), gold.pair_keys()
+        tp = len(np.intersect1d(pred_keys, gold_keys, assume_unique=True))
+        return tp, len(pred_keys) - tp, len(gold_keys) - tp
+
+    def overlap_matches(self, gold):
+        """
+        Relaxed matching: a (span, label) pair matches if the other table has a
+        pair with the same doc and label whose offsets overlap it.
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray): pair keys of this
+            table, their matched flags, pair keys of `gold`, their matched flags.
+        """
+        pred_keys, gold_keys = self.pair_keys(), gold.pair_keys()
+        return pred_keys, _overlapping(pred_keys, gold_keys), gold_keys, _overlapping(gold_keys, pred_keys)
+
+    # ----- conversion -----
+
+    def to_rows(self, text=None, corpus=None):
+        """
+        Converts the table back to [label, start, end, text] rows, one per label,
+        the format written to the *_predicted_spans.json files.
+        Text comes from `text` (a single document) or from a corpus_store.Corpus.
+        """
+        rows = []
+        for span in self:
+            if text is not None:
+                span_text = span.text(text)
+            elif corpus is not None:
+                span_text = corpus.slice(self.doc_names[span.doc], span.start, span.end)
+            else:
+                span_text = None
+            for label in span.labels:
+                rows.append([label, span.start, span.end, span_text])
+        return rows
+
+
+def pair_label_index(pair_keys):
+    """Returns the LABELS index of each (span, label) pair key."""
+    return np.asarray(pair_keys) & _LABEL_INDEX_MASK
+
+
+def _sorted_unique(values):
+    """np.unique for int64 keys, done with a plain sort (much faster than np.unique on large arrays)."""
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if len(values) else values
+
+
+def _overlapping(keys, other_keys):
+    """
+    For each (span, label) pair key in `keys`, tells whether `other_keys` holds a
+    pair of the same doc and label with overlapping offsets.
+    Both inputs are pair keys as returned by SpanTable.pair_keys.
+    """
+    if not len(keys) or not len(other_keys):
+        return np.zeros(len(keys), dtype=bool)
+
+    def split(pair_keys):
+        offsets = pair_keys >> _LABEL_INDEX_BITS
+        group = ((offsets >> (2 * _OFFSET_BITS)) << _LABEL_INDEX_BITS) | (pair_keys & _LABEL_INDEX_MASK)
+        return group, (offsets >> _OFFSET_BITS) & (_OFFSET_LIMIT - 1), offsets & (_OFFSET_LIMIT - 1)
+
+    group, start, end = split(keys)
+    other_group, other_start, other_end = split(other_keys)
+
+    # Sort the other pairs by (group, start) and take a running max of their ends
+    # within each group; a pair overlaps something iff, among the other pairs of
+    # its group starting before its end, the largest end is after its start.
+    sort_keys = (other_group << _OFFSET_BITS) | other_start
+    order = np.argsort(sort_keys)
+    other_group, other_end, sort_keys = other_group[order], other_end[order], sort_keys[order]
+    running_end = np.maximum.accumulate((other_group << _OFFSET_BITS) | other_end)
+
+    # Index of the last other pair in the same group with start < end
+    last = np.searchsorted(sort_keys, (group << _OFFSET_BITS) | end, side='left') - 1
+    first_in_group = np.searchsorted(sort_keys, group << _OFFSET_BITS, side='left')
+    valid = last >= first_in_group
+    matched = np.zeros(len(keys), dtype=bool)
+    matched[valid] = running_end[last[valid]] > ((group[valid] << _OFFSET_BITS) | start[valid])
+    return matched
+
+
+def read_ann_spans(ann_file, doc=0, doc_names=None):
+    """
+    Reads the ADR/Drug/Disease/Symptom entities of a .ann file into a SpanTable.
+    Discontinuous spans ('66 74;76 94') are skipped, as in the step3/step5 readers.
+    """
+    rows = []
+    with open(ann_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) < 3 or line.startswith('#'):
+                continue
+            label_parts = parts[1].split(' ')
+            try:
+                rows.append((label_parts[0], int(label_parts[1]), int(label_parts[2])))
+            except (IndexError, ValueError):
+                continue
+    return SpanTable.from_rows(rows, doc=doc, doc_names=doc_names)
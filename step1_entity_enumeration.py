@@ -1,33 +1,299 @@
 import os
-from collections import defaultdict
-
-# Path to the 'original' annotation files
-directory = 'cadec/original'
-
-# Dictionary to store unique entities for each label
-distinct_entities = defaultdict(set)
-
-# Iterate through all annotation files in the directory
-for filename in os.listdir(directory):
-    if not filename.endswith('.ann'):
-        continue
-    filepath = os.path.join(directory, filename)
-    with open(filepath, 'r', encoding='utf-8') as file:
-        for line in file:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue  # Skip comments and empty lines
-            parts = line.split('\t')
-            if len(parts) < 3:
-                continue  # Skip malformed lines
-            tag, label_ranges, entity_text = parts[0], parts[1], parts[2]
-            label = label_ranges.split(' ')[0]  # Label is the first word in the second column
-            distinct_entities[label].add(entity_text)
-
-# Print the results
-for label in ['ADR', 'Drug', 'Disease', 'Symptom']:
-    entities = distinct_entities[label]
-    print(f'Label: {label}')
-    print(f'Total unique entities: {len(entities)}')
-    print(f'Example entities: {list(entities)[:10]}')
-    print('-' * 40) 
\ No newline at end of file
+import re
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# Corpus statistics over the CADEC annotations.
+#
+# Every post has three annotation files: cadec/original (labelled entities),
+# cadec/meddra (MedDRA codes) and cadec/sct (SNOMED-CT codes). Worker processes
+# scan chunks of posts, reading all three files of a post in one pass, and
+# return partial Counters that are summed into the corpus totals:
+#   surface       - (label, text) frequencies, incl. the distinct entities per label
+#   length_words  - (label, words) span length histogram; length_chars likewise in characters
+#   cooccur_posts - (label a, label b) number of posts containing both labels
+#   overlapping   - (label a, label b) overlapping entity pairs with different labels
+#   discontinuous - (source, label) entities made of several fragments ('3 10;26 30')
+#   per_drug      - (drug, label) mentions; posts counts posts per drug
+#   codes         - (source, code) frequencies; concept_less / multi_code per source
+#   adr_links     - (source, status) whether each original ADR has a code in meddra/sct
+#   malformed     - (source,) lines that could not be parsed
+#
+# The totals are cached in .stats_cache/corpus_stats.json together with the
+# size and mtime of every annotation file; an unchanged corpus is answered from
+# the cache, and --incremental only scans posts added since the cached run.
+
+ANN_ROOT = 'cadec'
+SOURCES = ('original', 'meddra', 'sct')
+LABELS = ['ADR', 'Drug', 'Disease', 'Symptom']
+CACHE_FILE = '.stats_cache/corpus_stats.json'
+RANGES_PATTERN = re.compile(r'^(.*?)\s*(\d+ \d+(?:;\d+ \d+)*)$')
+MEDDRA_CODE_PATTERN = re.compile(r'\b\d{8}\b')
+SCT_CODE_PATTERN = re.compile(r'\b\d{6,18}\b')
+
+
+def parse_ann_line(line):
+    """
+    Parses one brat line into (prefix, fragments, text): the part of the second
+    column before the offsets (label or codes), the (start, end) fragments and
+    the mention text. Returns None for comments and malformed lines.
+    """
+    parts = line.rstrip('\n').split('\t')
+    if len(parts) < 3 or not parts[0].startswith('T'):
+        return None
+    match = RANGES_PATTERN.match(parts[1].strip())
+    if match is None:
+        return None
+    fragments = [tuple(int(x) for x in fragment.split()) for fragment in match.group(2).split(';')]
+    return match.group(1).strip(), fragments, parts[2].strip()
+
+
+def _read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.readlines()
+
+
+def scan_posts(doc_ids, ann_root=ANN_ROOT):
+    """
+    Scans the three annotation files of each post.
+    Returns:
+        dict: statistic name -> Counter (see the module comment).
+    """
+    stats = defaultdict(Counter)
+    for doc_id in doc_ids:
+        drug = doc_id.split('.')[0]
+        stats['posts'][(drug,)] += 1
+
+        entities = []
+        for line in _read_lines(os.path.join(ann_root, 'original', doc_id + '.ann')):
+            if line.startswith('#') or not line.strip():
+                continue
+            parsed = parse_ann_line(line)
+            if parsed is None:
+                stats['malformed'][('original',)] += 1
+                continue
+            label, fragments, text = parsed
+            entities.append((label, fragments))
+            stats['surface'][(label, text)] += 1
+            stats['length_chars'][(label, len(text))] += 1
+            stats['length_words'][(label, len(text.split()))] += 1
+            stats['per_drug'][(drug, label)] += 1
+            stats['mentions'][('original', label)] += 1
+            if len(fragments) > 1:
+                stats['discontinuous'][('original', label)] += 1
+
+        labels = sorted({label for label, _ in entities})
+        for i, label_a in enumerate(labels):
+            for label_b in labels[i:]:
+                stats['cooccur_posts'][(label_a, label_b)] += 1
+        spans = sorted((start, end, label) for label, fragments in entities for start, end in fragments)
+        for i, (start, end, label) in enumerate(spans):
+            for other_start, other_end, other_label in spans[i + 1:]:
+                if other_start >= end:
+                    break
+                if other_label != label:
+                    stats['overlapping'][tuple(sorted((label, other_label)))] += 1
+
+        for source, pattern in (('meddra', MEDDRA_CODE_PATTERN), ('sct', SCT_CODE_PATTERN)):
+            coded_ranges = {}
+            for line in _read_lines(os.path.join(ann_root, source, doc_id + '.ann')):
+                if line.startswith('#') or not line.strip():
+                    continue
+                parsed = parse_ann_line(line)
+                if parsed is None:
+                    stats['malformed'][(source,)] += 1
+                    continue
+                prefix, fragments, _ = parsed
+                codes = pattern.findall(prefix)
+                stats['mentions'][(source, 'coded' if codes else 'concept_less')] += 1
+                if len(codes) > 1:
+                    stats['multi_code'][(source,)] += 1
+                if len(fragments) > 1:
+                    stats['discontinuous'][(source, '-')] += 1
+                for code in codes:
+                    stats['codes'][(source, code)] += 1
+                key = tuple(fragments)
+                coded_ranges[key] = coded_ranges.get(key, False) or bool(codes)
+            # Coverage: does each original ADR have a coded mention with the same offsets?
+            for label, fragments in entities:
+                if label == 'ADR':
+                    status = coded_ranges.get(tuple(fragments))
+                    stats['adr_links'][(source, 'missing' if status is None else 'coded' if status else 'concept_less')] += 1
+    return stats
+
+
+def merge_stats(partials):
+    """Sums partial statistics returned by `scan_posts`."""
+    total = defaultdict(Counter)
+    for partial in partials:
+        for name, counter in partial.items():
+            total[name].update(counter)
+    return total
+
+
+def _scan_chunk(args):
+    doc_ids, ann_root = args
+    return scan_posts(doc_ids, ann_root)
+
+
+def scan_parallel(doc_ids, ann_root=ANN_ROOT, workers=None):
+    """Scans posts in worker processes (a few chunks per worker) and merges the results."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(doc_ids) < 64:
+        return scan_posts(doc_ids, ann_root)
+    chunk_count = workers * 4
+    chunks = [(doc_ids[i::chunk_count], ann_root) for i in range(chunk_count)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return merge_stats(pool.map(_scan_chunk, chunks))
+
+
+def post_stamps(ann_root=ANN_ROOT):
+    """Returns {doc_id: [size, mtime_ns] of each source file (None if missing)} for the posts of cadec/original."""
+    stamps = {}
+    for filename in os.listdir(os.path.join(ann_root, 'original')):
+        if not filename.endswith('.ann'):
+            continue
+        doc_id = filename[:-len('.ann')]
+        stamp = []
+        for source in SOURCES:
+            try:
+                stat = os.stat(os.path.join(ann_root, source, filename))
+                stamp.append([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                stamp.append(None)
+        stamps[doc_id] = stamp
+    return stamps
+
+
+def corpus_version(stamps):
+    return hashlib.sha1(json.dumps(sorted(stamps.items())).encode('utf-8')).hexdigest()
+
+
+def _to_json(stats):
+    return {name: [[*key, count] for key, count in counter.items()] for name, counter in stats.items()}
+
+
+def _from_json(data):
+    return defaultdict(Counter, {name: Counter({tuple(row[:-1]): row[-1] for row in rows}) for name, rows in data.items()})
+
+
+def compute_stats(ann_root=ANN_ROOT, workers=None, cache_file=CACHE_FILE, incremental=False, force=False):
+    """
+    Returns (stats, how) where `how` says whether the statistics came from the
+    cache, an incremental scan of new posts, or a full scan.
+    """
+    stamps = post_stamps(ann_root)
+    version = corpus_version(stamps)
+    cache = None
+    if os.path.exists(cache_file) and not force:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get('version') == version:
+            return _from_json(cache['stats']), 'cache'
+
+    how = 'full scan'
+    if incremental and cache is not None and all(stamps.get(d) == s for d, s in cache['posts'].items()):
+        # Only additions can be merged in; changed or removed posts need a full scan
+        new_posts = sorted(set(stamps) - set(cache['posts']))
+        stats = merge_stats([_from_json(cache['stats']), scan_parallel(new_posts, ann_root, workers)])
+        how = f'incremental scan of {len(new_posts)} new posts'
+    else:
+        if incremental:
+            print('Cached posts changed or were removed; falling back to a full scan.')
+        stats = scan_parallel(sorted(stamps), ann_root, workers)
+
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'posts': stamps, 'stats': _to_json(stats)}, f, separators=(',', ':'))
+    os.replace(tmp_file, cache_file)
+    return stats, how
+
+
+def _ranked(counter, n=None):
+    """Like Counter.most_common, but ties are broken by key, so merge order does not change the report."""
+    return sorted(counter.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+def print_report(stats, examples=10, top_drugs=10):
+    # Distinct entities per label (the original step 1 output)
+    distinct_entities = defaultdict(list)
+    for (label, text), count in _ranked(stats['surface']):
+        distinct_entities[label].append(text)
+    for label in LABELS:
+        entities = distinct_entities[label]
+        print(f'Label: {label}')
+        print(f'Total unique entities: {len(entities)}')
+        print(f'Example entities: {entities[:examples]}')
+        print('-' * 40)
+
+    print('\nMentions (discontinuous):')
+    for (source, label), count in sorted(stats['mentions'].items()):
+        discontinuous = stats['discontinuous'][(source, label if source == 'original' else '-')]
+        extra = f' ({discontinuous} discontinuous)' if source == 'original' else ''
+        print(f'  {source:<9} {label:<13} {count:>7}{extra}')
+    for source in ('meddra', 'sct'):
+        print(f"  {source:<9} {'discontinuous':<13} {stats['discontinuous'][(source, '-')]:>7}")
+
+    print('\nSpan length in words:')
+    bins = [(1, 1), (2, 2), (3, 3), (4, 4), (5, 7), (8, float('inf'))]
+    print(f"  {'label':<8}" + ''.join(f'{name:>7}' for name in ('1', '2', '3', '4', '5-7', '8+')) + f"{'mean':>7}")
+    for label in LABELS:
+        lengths = {n: c for (l, n), c in stats['length_words'].items() if l == label}
+        total = sum(lengths.values())
+        mean = sum(n * c for n, c in lengths.items()) / total if total else 0.0
+        print(f'  {label:<8}' + ''.join(f'{sum(c for n, c in lengths.items() if lo <= n <= hi):>7}' for lo, hi in bins)
+              + f'{mean:>7.2f}')
+
+    print('\nLabel co-occurrence (posts with both labels):')
+    print(f"  {'':<8}" + ''.join(f'{label:>9}' for label in LABELS))
+    for label_a in LABELS:
+        print(f'  {label_a:<8}' + ''.join(f"{stats['cooccur_posts'][tuple(sorted((label_a, label_b)))]:>9}"
+                                          for label_b in LABELS))
+    if stats['overlapping']:
+        print('  Overlapping entities with different labels: ' +
+              ', '.join(f'{a}/{b}={c}' for (a, b), c in _ranked(stats['overlapping'])))
+
+    print(f'\nPer drug (top {top_drugs} by posts):')
+    print(f"  {'drug':<22}{'posts':>6}" + ''.join(f'{label:>9}' for label in LABELS))
+    for (drug,), posts in _ranked(stats['posts'], top_drugs):
+        print(f'  {drug:<22}{posts:>6}' + ''.join(f"{stats['per_drug'][(drug, label)]:>9}" for label in LABELS))
+
+    print('\nCode coverage:')
+    for source in ('meddra', 'sct'):
+        distinct = sum(1 for (s, _) in stats['codes'] if s == source)
+        adr = {status: stats['adr_links'][(source, status)] for status in ('coded', 'concept_less', 'missing')}
+        total_adr = sum(adr.values())
+        print(f"  {source:<7} {distinct} distinct codes, {stats['mentions'][(source, 'coded')]} coded and "
+              f"{stats['mentions'][(source, 'concept_less')]} concept-less mentions, "
+              f"{stats['multi_code'][(source,)]} with several codes, {stats['malformed'][(source,)]} malformed lines")
+        if total_adr:
+            print(f"          original ADRs: {adr['coded'] / total_adr:.1%} coded, "
+                  f"{adr['concept_less'] / total_adr:.1%} concept-less, {adr['missing'] / total_adr:.1%} missing")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Entity enumeration and corpus statistics over the CADEC annotations.')
+    parser.add_argument('--ann-root', default=ANN_ROOT, help='Directory holding original/, meddra/ and sct/')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default=CACHE_FILE)
+    parser.add_argument('--incremental', action='store_true', help='Only scan posts added since the cached run')
+    parser.add_argument('--force', action='store_true', help='Ignore the cache')
+    parser.add_argument('--examples', type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats, how = compute_stats(args.ann_root, args.workers, args.cache, args.incremental, args.force)
+    elapsed = time.perf_counter() - start
+    print(f"{sum(stats['posts'].values())} posts ({how}) in {elapsed:.2f}s\n")
+    print_report(stats, args.examples)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 import os
 from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
-from collections import namedtuple
 import json
+from spans import Span, SpanTable, label_mask
+from tokenization_store import open_token_store
 
 # --------- CONFIGURATION ---------
 # You can change this to any file in cadec/text/
@@ -36,8 +37,15 @@ entity_map = {
     # Add more mappings if needed
 }
 
-# Build BIO tags for each word
-tokens = tokenizer.tokenize(tokenizer.decode(tokenizer.encode(text)))
+# Build BIO tags for each word, reusing the corpus tokenization stored by tokenization_store.py
+token_store = open_token_store(MODEL_NAME)
+doc_id = os.path.basename(EXAMPLE_TEXT_FILE).replace('.txt', '')
+if doc_id in token_store and len(token_store.rows(doc_id)) == 1:
+    input_ids, attention_mask, _ = token_store.encoding(doc_id)
+    tokens = tokenizer.convert_ids_to_tokens(input_ids[0][attention_mask[0] == 1].tolist())
+else:
+    # Post missing from the store or split over several windows: tokenize it here
+    tokens = tokenizer.tokenize(tokenizer.decode(tokenizer.encode(text)))
 labels = ['O'] * len(tokens)
 
 # Map NER results to BIO tags, using only mapped categories
@@ -64,8 +72,11 @@ for token, label in zip(tokens, labels):
     print(f'{token}\t{label}')
 
 # --------- b) CONVERT BIO TO SPAN FORMAT ---------
-# Helper structure for spans
-Span = namedtuple('Span', ['label', 'start', 'end', 'text'])
+# Spans use the shared Span type: (doc, start, end, label bitmask), here with token
+# offsets in our single document (doc 0)
+
+def span_text(span):
+    return tokenizer.convert_tokens_to_string(tokens[span.start:span.end])
 
 spans = []
 current_label = None
@@ -75,8 +86,7 @@ for i, label in enumerate(labels):
         if current_label is not None:
             # End previous span
             end_idx = i
-            span_text = tokenizer.convert_tokens_to_string(tokens[start_idx:end_idx])
-            spans.append(Span(current_label, start_idx, end_idx, span_text))
+            spans.append(Span(0, start_idx, end_idx, label_mask(current_label)))
         current_label = label[2:]
         start_idx = i
     elif label.startswith('I-'):
@@ -84,24 +94,23 @@ for i, label in enumerate(labels):
     else:  # 'O'
         if current_label is not None:
             end_idx = i
-            span_text = tokenizer.convert_tokens_to_string(tokens[start_idx:end_idx])
-            spans.append(Span(current_label, start_idx, end_idx, span_text))
+            spans.append(Span(0, start_idx, end_idx, label_mask(current_label)))
             current_label = None
             start_idx = None
 # Handle last span
 if current_label is not None:
     end_idx = len(tokens)
-    span_text = tokenizer.convert_tokens_to_string(tokens[start_idx:end_idx])
-    spans.append(Span(current_label, start_idx, end_idx, span_text))
+    spans.append(Span(0, start_idx, end_idx, label_mask(current_label)))
 
 # Print span-format output
 print('\nSpan-format output:')
 for span in spans:
-    print(f'Label: {span.label}, Tokens: {span.start}-{span.end}, Text: "{span.text}"')
+    print(f'Label: {"|".join(span.labels)}, Tokens: {span.start}-{span.end}, Text: "{span_text(span)}"')
 
 # --------- SAVE SPANS TO JSON FOR STEP 3 ---------
 # Save as list of [label, start, end, text]
-predicted_spans = [[span.label, span.start, span.end, span.text] for span in spans]
+predicted_spans = [[label, span.start, span.end, span_text(span)]
+                   for span in SpanTable.from_spans(spans) for label in span.labels]
 output_json = os.path.basename(EXAMPLE_TEXT_FILE).replace('.txt', '_predicted_spans.json')
 with open(output_json, 'w', encoding='utf-8') as f:
     json.dump(predicted_spans, f, ensure_ascii=False, indent=2)
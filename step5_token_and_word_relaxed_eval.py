@@ -2,6 +2,8 @@ import os
 import json
 import re
 from step3_evaluate_predictions import load_predicted_spans
+from corpus_store import open_corpus
+from tokenization_store import open_token_store, WORD_TOKENIZER
 
 def read_ground_truth_spans_with_offsets(ann_file):
     spans = []
@@ -28,24 +30,36 @@ def tokenize(text):
     # Simple whitespace and punctuation tokenizer
     return re.findall(r"\w+", text)
 
-def token_level_pairs(spans):
+# Words of every post are precomputed once per corpus version (same \w+ rule as tokenize)
+corpus = open_corpus()
+word_store = open_token_store(WORD_TOKENIZER, corpus)
+
+def tokenize_span(span, doc_id=None):
+    # Look the span's words up in the word store when possible, instead of re-running the regex
+    label, start, end, text = span
+    if doc_id is not None and doc_id in word_store and start is not None:
+        return [corpus.slice(doc_id, s, e) for s, e in word_store.span_tokens(doc_id, start, end)]
+    return tokenize(text)
+
+def token_level_pairs(spans, doc_id=None):
     pairs = set()
-    for label, start, end, text in spans:
-        tokens = tokenize(text)
+    for span in spans:
+        label = span[0]
+        tokens = tokenize_span(span, doc_id)
         for token in tokens:
             pairs.add((label.lower(), token.lower()))
     return pairs
 
-def word_presence_match(pred_spans, gt_spans):
+def word_presence_match(pred_spans, gt_spans, doc_id=None):
     # For each predicted entity, if any word in its span is present in any gold span of the same label, count as match
     gt_by_label = {}
-    for label, start, end, text in gt_spans:
-        gt_by_label.setdefault(label.lower(), []).append(set(tokenize(text)))
+    for span in gt_spans:
+        gt_by_label.setdefault(span[0].lower(), []).append(set(tokenize_span(span, doc_id)))
     pred_matched = set()
     gt_matched = set()
-    for pi, (plabel, pstart, pend, ptext) in enumerate(pred_spans):
-        plabel = plabel.lower()
-        ptokens = set(tokenize(ptext))
+    for pi, span in enumerate(pred_spans):
+        plabel = span[0].lower()
+        ptokens = set(tokenize_span(span, doc_id))
         for gi, gt_tokens in enumerate(gt_by_label.get(plabel, [])):
             if ptokens & gt_tokens:
                 pred_matched.add(pi)
@@ -69,8 +83,8 @@ for txt_file in sampled_txt_files:
     predicted_spans = load_predicted_spans(pred_file)
     pred_spans = [(label, start, end, text) for (label, start, end, text) in predicted_spans]
     # Token-level F1
-    gt_token_pairs = token_level_pairs(gt_spans)
-    pred_token_pairs = token_level_pairs(pred_spans)
+    gt_token_pairs = token_level_pairs(gt_spans, base)
+    pred_token_pairs = token_level_pairs(pred_spans, base)
     tp = len(gt_token_pairs & pred_token_pairs)
     fp = len(pred_token_pairs - gt_token_pairs)
     fn = len(gt_token_pairs - pred_token_pairs)
@@ -79,7 +93,7 @@ for txt_file in sampled_txt_files:
     f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0.0
     results_token.append({'file': txt_file, 'precision': precision, 'recall': recall, 'f1': f1})
     # Word-presence F1
-    tp_w, fp_w, fn_w = word_presence_match(pred_spans, gt_spans)
+    tp_w, fp_w, fn_w = word_presence_match(pred_spans, gt_spans, base)
     precision_w = tp_w / (tp_w + fp_w) if (tp_w + fp_w) > 0 else 0.0
     recall_w = tp_w / (tp_w + fn_w) if (tp_w + fn_w) > 0 else 0.0
     f1_w = 2 * precision_w * recall_w / (precision_w + recall_w) if (precision_w + recall_w) > 0 else 0.0
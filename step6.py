@@ -1,9 +1,16 @@
 import os
 import re
 import json
+from collections import Counter, defaultdict
 from pprint import pprint
+import numpy as np
 from fuzzywuzzy import fuzz
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import util
+from embedding_cache import EmbeddingCache, normalize_text
+from autotune import get_profile, apply_threads, apply_backend
+from model_artifact import load_encoder
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
 
 def parse_original_ann(ann_file):
     """
@@ -42,7 +49,7 @@ def parse_sct_ann(ann_file):
     The format is: TT<ID> <SNOMED_CODE> | <SNOMED_TEXT> | <START> <END> <ORIGINAL_TEXT>
     """
     annotations = []
-    with open(ann_file, 'r', encoding='utf-8') as f:
+    with open(ann_file, 'r', encoding='utf-8', errors='replace') as f:
         for line in f:
             line = line.strip()
             if not line.startswith('TT'):
@@ -59,6 +66,11 @@ def parse_sct_ann(ann_file):
                 snomed_code = info_components[0].strip()
                 snomed_text = info_components[1].strip()
 
+                # The span offsets are the last component, e.g. "9 19" or "66 74;76 94"
+                spans = info_components[-1].strip().split()
+                start = int(spans[0])
+                end = int(spans[1].split(';')[0])
+
                 # The label is not explicitly defined in the same way as original,
                 # but we can infer it or just use a generic one if needed.
                 # For now, we mainly need the code and text for matching.
@@ -66,7 +78,10 @@ def parse_sct_ann(ann_file):
                     'id': id_part,
                     'label': 'SCT_Entity', # Using a generic label
                     'snomed_code': snomed_code,
-                    'snomed_text': snomed_text
+                    'snomed_text': snomed_text,
+                    'start': start,
+                    'end': end,
+                    'text': parts[2] if len(parts) > 2 else ''
                 })
             except (IndexError, ValueError) as e:
                 # print(f"Skipping malformed line in {ann_file}: {line} - Error: {e}")
@@ -118,9 +133,12 @@ def match_with_fuzzywuzzy(adr_text, sct_annotations):
             
     return best_match, max_score
 
-def match_with_embeddings(adr_text, sct_annotations, model):
+def match_with_embeddings(adr_text, sct_annotations, model, cache=None, batch_size=64, vectors=None):
     """
     Finds the best SNOMED-CT match for an ADR text using sentence embeddings.
+    If an EmbeddingCache is given, texts encoded in earlier runs are not re-encoded.
+    If `vectors` (normalized text -> embedding, see encode_texts) is given, nothing
+    is encoded and the vectors are looked up instead.
     """
     best_match = None
     max_score = -1
@@ -129,12 +147,21 @@ def match_with_embeddings(adr_text, sct_annotations, model):
     if not sct_candidates:
         return None, 0
 
-    # Encode the ADR text
-    adr_embedding = model.encode(adr_text, convert_to_tensor=True)
-    
-    # Encode all SCT texts
     sct_texts = [sct['snomed_text'] for sct in sct_candidates]
-    sct_embeddings = model.encode(sct_texts, convert_to_tensor=True)
+    if vectors is not None:
+        # Encoded beforehand, together with the texts of every other mention
+        adr_embedding = vectors[normalize_text(adr_text)][None]
+        sct_embeddings = np.stack([vectors[normalize_text(text)] for text in sct_texts])
+    elif cache is not None:
+        # Encode the ADR text and all SCT texts in one go, reusing cached vectors
+        embeddings = cache.encode([adr_text] + sct_texts, model, batch_size=batch_size)
+        adr_embedding, sct_embeddings = embeddings[:1], embeddings[1:]
+    else:
+        # Encode the ADR text
+        adr_embedding = model.encode(adr_text, convert_to_tensor=True)
+
+        # Encode all SCT texts
+        sct_embeddings = model.encode(sct_texts, batch_size=batch_size, convert_to_tensor=True)
     
     # Compute cosine similarities
     cosine_scores = util.cos_sim(adr_embedding, sct_embeddings)
@@ -146,11 +173,126 @@ def match_with_embeddings(adr_text, sct_annotations, model):
     
     return best_match, max_score
 
+def encode_texts(texts, model, cache, batch_size=64):
+    """
+    Encodes the distinct texts of a whole run with a single cache lookup and a
+    single encoder call for the misses.
+    Returns:
+        dict: normalized text -> embedding, the `vectors` of match_with_embeddings.
+    """
+    distinct = sorted({normalize_text(text) for text in texts})
+    return dict(zip(distinct, cache.encode(distinct, model, batch_size=batch_size)))
+
+def normalize_surface_form(text):
+    """
+    Normalizes an entity mention for index lookups: lowercases it, replaces
+    punctuation with spaces and collapses whitespace, so that 'Muscle  pain.'
+    and 'muscle pain' share the same key.
+    """
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+def build_surface_form_index(sct_dir='cadec/sct'):
+    """
+    Learns a surface form -> SNOMED-CT code index from all the .ann files in 'sct'.
+    Each mention text is counted against the code it was annotated with, and the
+    most frequent code wins. Two tables are built: one keyed by the exact mention
+    text and one keyed by its normalized form.
+    Returns:
+        dict: {'exact': {...}, 'normalized': {...}}, each mapping a key to
+        {'snomed_code', 'snomed_text', 'count'}.
+    """
+    counts = {'exact': defaultdict(Counter), 'normalized': defaultdict(Counter)}
+    for filename in sorted(os.listdir(sct_dir)):
+        if not filename.endswith('.ann'):
+            continue
+        for sct_ann in parse_sct_ann(os.path.join(sct_dir, filename)):
+            if not sct_ann.get('snomed_code') or not sct_ann['text']:
+                continue
+            concept = (sct_ann['snomed_code'], sct_ann['snomed_text'])
+            counts['exact'][sct_ann['text']][concept] += 1
+            counts['normalized'][normalize_surface_form(sct_ann['text'])][concept] += 1
+
+    index = {}
+    for table, table_counts in counts.items():
+        index[table] = {}
+        for key, concept_counts in table_counts.items():
+            (snomed_code, snomed_text), count = concept_counts.most_common(1)[0]
+            index[table][key] = {'snomed_code': snomed_code, 'snomed_text': snomed_text, 'count': count}
+    return index
+
+def fuzzy_shortlist(adr_text, sct_annotations, size=5):
+    """
+    Returns the top `size` SNOMED-CT candidates for an ADR text by fuzzy score,
+    as a list of (sct_annotation, score) sorted best first. Candidates sharing
+    a code are only kept once.
+    """
+    scored = {}
+    for sct_ann in sct_annotations:
+        if not sct_ann.get('snomed_code'):
+            continue
+        score = fuzz.token_set_ratio(adr_text, sct_ann['snomed_text'])
+        if sct_ann['snomed_code'] not in scored or score > scored[sct_ann['snomed_code']][1]:
+            scored[sct_ann['snomed_code']] = (sct_ann, score)
+    return sorted(scored.values(), key=lambda item: item[1], reverse=True)[:size]
+
+def resolve_lexical(adr_text, index, sct_annotations, shortlist_size=5, fuzzy_accept=90):
+    """
+    Runs the encoder-free tiers of link_adr.
+    Returns:
+        (match, shortlist): the match dict if a tier resolved the mention, else None
+        and the fuzzy shortlist to re-rank with embeddings.
+    """
+    for tier, key in (('exact', adr_text), ('normalized', normalize_surface_form(adr_text))):
+        hit = index[tier].get(key)
+        if hit is not None:
+            return {'tier': tier, 'snomed_code': hit['snomed_code'],
+                    'snomed_text': hit['snomed_text'], 'score': 100}, []
+
+    shortlist = fuzzy_shortlist(adr_text, sct_annotations, size=shortlist_size)
+    if not shortlist:
+        return {'tier': 'none', 'snomed_code': 'N/A', 'snomed_text': 'N/A', 'score': 0}, []
+
+    best_match, score = shortlist[0]
+    if score >= fuzzy_accept:
+        return {'tier': 'fuzzy', 'snomed_code': best_match['snomed_code'],
+                'snomed_text': best_match['snomed_text'], 'score': score}, shortlist
+    return None, shortlist
+
+def link_adr(adr_text, index, sct_annotations, model, shortlist_size=5, fuzzy_accept=90, cache=None, batch_size=64,
+             vectors=None):
+    """
+    Links an ADR text to a SNOMED-CT code with a cascade of increasingly
+    expensive tiers, stopping at the first one that resolves it:
+        1. 'exact':      the mention text is in the surface form index
+        2. 'normalized': its normalized form is in the surface form index
+        3. 'fuzzy':      the best fuzzy candidate scores at least `fuzzy_accept`
+        4. 'embedding':  the fuzzy shortlist is re-ranked with sentence embeddings
+    Only the last tier runs the encoder, and only over the shortlist.
+    Returns:
+        dict: 'tier', 'snomed_code', 'snomed_text' and 'score' of the match.
+    """
+    match, shortlist = resolve_lexical(adr_text, index, sct_annotations, shortlist_size, fuzzy_accept)
+    if match is not None:
+        return match
+    best_match, score = match_with_embeddings(adr_text, [sct_ann for sct_ann, _ in shortlist], model, cache=cache,
+                                              batch_size=batch_size, vectors=vectors)
+    return {'tier': 'embedding', 'snomed_code': best_match['snomed_code'],
+            'snomed_text': best_match['snomed_text'], 'score': score}
+
 def main():
+    # Encoder settings (threads, batch size, backend) come from the autotune profile of this host, if any
+    profile = get_profile('encoder', MODEL_NAME)
+    apply_threads(profile)
+
     # Load a pre-trained model
     print("Loading sentence transformer model...")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    print("Model loaded.")
+    # From the prebuilt artifact when there is one (python model_artifact.py build-artifact encoder)
+    model = apply_backend(load_encoder(MODEL_NAME), profile['backend'])
+    print(f"Model loaded ({'autotuned' if profile['tuned'] else 'default'} settings: batch_size={profile['batch_size']}).")
+
+    # Embeddings persist across runs, so repeated ADR/SNOMED texts are encoded only once
+    cache = EmbeddingCache(MODEL_NAME)
 
     # Load the list of sampled files
     with open('step5_sampled_files.txt', 'r') as f:
@@ -159,10 +301,32 @@ def main():
     # Build the main data structure
     data = build_combined_data(sampled_files)
 
+    # Learn the surface form -> SNOMED-CT index from the sct annotations
+    print("Building surface form index...")
+    index = build_surface_form_index()
+    print(f"Indexed {len(index['exact'])} surface forms ({len(index['normalized'])} normalized).")
+
+    # Pass 1: the encoder-free tiers, collecting the mentions left for embeddings
+    print("\n--- Starting Annotation Matching ---")
+    pending = {}
+    for filename, content in data.items():
+        for j, adr_ann in enumerate(ann for ann in content['original'] if ann['label'] == 'ADR'):
+            match, shortlist = resolve_lexical(adr_ann['text'], index, content['sct'])
+            pending[filename, j] = (adr_ann, match, shortlist)
+
+    # Encode every text the embedding tier needs in one call for the whole run
+    texts = []
+    for adr_ann, match, shortlist in pending.values():
+        if match is None:
+            texts.append(adr_ann['text'])
+            texts.extend(sct_ann['snomed_text'] for sct_ann, _ in shortlist)
+    vectors = encode_texts(texts, model, cache, batch_size=profile['batch_size'])
+    print(f"Encoded {len(vectors)} distinct texts for the embedding tier.")
+
     results = []
+    tier_counts = Counter()
     
-    print("\n--- Starting Annotation Matching ---")
-    # Process all files, but we can break early for demonstration
+    # Pass 2: re-rank the remaining shortlists and report per file
     for i, (filename, content) in enumerate(data.items()):
         original_adrs = [ann for ann in content['original'] if ann['label'] == 'ADR']
         if not original_adrs:
@@ -170,35 +334,41 @@ def main():
 
         print(f"\n--- Processing File: {filename} ({i+1}/{len(data)}) ---")
         
-        for adr_ann in original_adrs:
-            # Method a) Fuzzy String Matching
-            fuzzy_match, fuzzy_score = match_with_fuzzywuzzy(adr_ann['text'], content['sct'])
-
-            # Method b) Embedding Similarity
-            embedding_match, embedding_score = match_with_embeddings(adr_ann['text'], content['sct'], model)
+        for j in range(len(original_adrs)):
+            adr_ann, match, shortlist = pending[filename, j]
+            if match is None:
+                best_match, score = match_with_embeddings(adr_ann['text'], [sct_ann for sct_ann, _ in shortlist],
+                                                          model, vectors=vectors)
+                match = {'tier': 'embedding', 'snomed_code': best_match['snomed_code'],
+                         'snomed_text': best_match['snomed_text'], 'score': score}
+            tier_counts[match['tier']] += 1
 
             results.append({
                 'file': filename,
                 'original_text': adr_ann['text'],
-                'fuzzy_match_text': fuzzy_match['snomed_text'] if fuzzy_match else 'N/A',
-                'fuzzy_match_code': fuzzy_match['snomed_code'] if fuzzy_match else 'N/A',
-                'fuzzy_score': fuzzy_score,
-                'embedding_match_text': embedding_match['snomed_text'] if embedding_match else 'N/A',
-                'embedding_match_code': embedding_match['snomed_code'] if embedding_match else 'N/A',
-                'embedding_score': embedding_score,
+                'tier': match['tier'],
+                'match_text': match['snomed_text'],
+                'match_code': match['snomed_code'],
+                'score': match['score'],
             })
         
         # Display results for this file immediately
         for res in results:
             if res['file'] == filename:
                 print(f"\nOriginal ADR: '{res['original_text']}'")
-                print(f"  A) Fuzzy Match: '{res['fuzzy_match_text']}' (Code: {res['fuzzy_match_code']}) - Score: {res['fuzzy_score']:.2f}")
-                print(f"  B) Embedding Match: '{res['embedding_match_text']}' (Code: {res['embedding_match_code']}) - Score: {res['embedding_score']:.2f}")
+                print(f"  Match: '{res['match_text']}' (Code: {res['match_code']}) - Tier: {res['tier']} - Score: {res['score']:.2f}")
         
         # To keep the output manageable, let's just process one file for now.
         # Remove or comment out the 'break' to run on all sampled files.
         # break
 
+    print("\n--- Resolution Tiers ---")
+    for tier in ['exact', 'normalized', 'fuzzy', 'embedding', 'none']:
+        share = tier_counts[tier] / len(results) if results else 0.0
+        print(f"{tier:<11} {tier_counts[tier]:>5} ({share:.1%})")
+    cache.flush()
+    print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses")
+
     print("\n--- Comparison Complete ---")
 
 if __name__ == '__main__':
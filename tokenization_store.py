@@ -0,0 +1,220 @@
+import os
+import re
+import sys
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from corpus_store import open_corpus
+
+# Tokenize the corpus once per (tokenizer, corpus version) and keep the result
+# as memory-mapped arrays, instead of re-tokenizing every post on every run.
+#
+# Layout of <store_dir>/<tokenizer>-<corpus version>/:
+#   input_ids.npy       - int32 (rows, max_len), padded with the tokenizer's pad id
+#   attention_mask.npy  - int8  (rows, max_len)
+#   offset_mapping.npy  - int32 (rows, max_len, 2), character offsets into the post
+#   row_doc.npy         - int32 (rows,), index into doc_ids.txt; long posts use several rows
+#   doc_ids.txt, meta.json
+#
+# The special tokenizer name 'regex-word' stores the \w+ words used by the
+# token-level evaluation (offsets only, no input ids).
+
+DEFAULT_STORE_DIR = 'cadec/tokenized'
+WORD_TOKENIZER = 'regex-word'
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def store_path(tokenizer_name, corpus_version, store_dir=DEFAULT_STORE_DIR):
+    return os.path.join(store_dir, f"{tokenizer_name.replace('/', '__')}-{corpus_version[:12]}")
+
+
+def _tokenize_words(texts):
+    rows = []
+    for text in texts:
+        offsets = [match.span() for match in WORD_PATTERN.finditer(text)]
+        rows.append({'input_ids': [0] * len(offsets), 'offset_mapping': offsets})
+    return rows, list(range(len(texts)))
+
+
+def _tokenize_batch(tokenizer, texts, max_length, stride):
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, stride=stride,
+                        return_overflowing_tokens=True, return_offsets_mapping=True)
+    rows = [{'input_ids': ids, 'offset_mapping': offsets}
+            for ids, offsets in zip(encoded['input_ids'], encoded['offset_mapping'])]
+    return rows, list(encoded['overflow_to_sample_mapping'])
+
+
+def build_token_store(corpus, tokenizer_name, store_dir=DEFAULT_STORE_DIR, max_length=512, stride=64,
+                      batch_size=64, workers=4):
+    """
+    Tokenizes every post of a packed corpus and saves the arrays described above.
+    Posts longer than `max_length` tokens are split into overlapping windows (`stride`
+    tokens of overlap), one row each.
+    Args:
+        corpus (corpus_store.Corpus): The packed corpus.
+        tokenizer_name (str): Hugging Face tokenizer name, or 'regex-word'.
+    Returns:
+        str: Path of the written store.
+    """
+    path = store_path(tokenizer_name, corpus.version, store_dir)
+    os.makedirs(path, exist_ok=True)
+    doc_ids = list(corpus.doc_ids)
+    batches = [doc_ids[i:i + batch_size] for i in range(0, len(doc_ids), batch_size)]
+
+    pad_id = 0
+    if tokenizer_name == WORD_TOKENIZER:
+        tokenize = _tokenize_words
+    else:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+        pad_id = tokenizer.pad_token_id or 0
+        tokenize = lambda texts: _tokenize_batch(tokenizer, texts, max_length, stride)
+
+    # Fast (Rust) tokenizers release the GIL, so batches are tokenized in parallel threads
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda batch: tokenize([corpus.text(doc_id) for doc_id in batch]), batches))
+
+    rows, row_doc = [], []
+    for batch_index, (batch_rows, sample_mapping) in enumerate(results):
+        rows.extend(batch_rows)
+        row_doc.extend(batch_index * batch_size + sample for sample in sample_mapping)
+
+    width = max((len(row['input_ids']) for row in rows), default=0)
+    input_ids = np.full((len(rows), width), pad_id, dtype=np.int32)
+    attention_mask = np.zeros((len(rows), width), dtype=np.int8)
+    offset_mapping = np.zeros((len(rows), width, 2), dtype=np.int32)
+    for i, row in enumerate(rows):
+        length = len(row['input_ids'])
+        input_ids[i, :length] = row['input_ids']
+        attention_mask[i, :length] = 1
+        if length:
+            offset_mapping[i, :length] = row['offset_mapping']
+
+    np.save(os.path.join(path, 'input_ids.npy'), input_ids)
+    np.save(os.path.join(path, 'attention_mask.npy'), attention_mask)
+    np.save(os.path.join(path, 'offset_mapping.npy'), offset_mapping)
+    np.save(os.path.join(path, 'row_doc.npy'), np.asarray(row_doc, dtype=np.int32))
+    with open(os.path.join(path, 'doc_ids.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(doc_ids) + '\n')
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'tokenizer': tokenizer_name, 'corpus_version': corpus.version, 'max_length': max_length,
+                   'stride': stride, 'pad_id': pad_id, 'rows': len(rows)}, f, indent=2)
+    return path
+
+
+class TokenStore:
+    """
+    Read-only, memory-mapped view over a store written by `build_token_store`.
+    Args:
+        path (str): Store directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, 'doc_ids.txt'), 'r', encoding='utf-8') as f:
+            self.doc_ids = [line.rstrip('\n') for line in f if line.strip()]
+        self.input_ids = np.load(os.path.join(path, 'input_ids.npy'), mmap_mode='r')
+        self.attention_mask = np.load(os.path.join(path, 'attention_mask.npy'), mmap_mode='r')
+        self.offset_mapping = np.load(os.path.join(path, 'offset_mapping.npy'), mmap_mode='r')
+        self.row_doc = np.load(os.path.join(path, 'row_doc.npy'))
+        self.lengths = np.asarray(self.attention_mask.sum(axis=1), dtype=np.int32)
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        # Rows of a doc are contiguous, so each doc maps to a [first, last) row range
+        self.doc_rows = np.searchsorted(self.row_doc, np.arange(len(self.doc_ids) + 1))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_index
+
+    def rows(self, doc_id):
+        """Returns the range of rows holding a post."""
+        i = self.doc_index[doc_id]
+        return range(self.doc_rows[i], self.doc_rows[i + 1])
+
+    def encoding(self, doc_id):
+        """Returns (input_ids, attention_mask, offset_mapping) of a post, trimmed to its longest row."""
+        rows = self.rows(doc_id)
+        width = int(self.lengths[rows.start:rows.stop].max()) if len(rows) else 0
+        return (self.input_ids[rows.start:rows.stop, :width],
+                self.attention_mask[rows.start:rows.stop, :width],
+                self.offset_mapping[rows.start:rows.stop, :width])
+
+    def doc_tokens(self, doc_id):
+        """
+        Returns (rows, positions) index arrays selecting every real token of a post
+        once, in text order. A post split into overlapping windows has the tokens
+        of each overlap in two rows; each token is taken from the window where it
+        lies farthest from a window edge, i.e. where the model saw most context.
+        """
+        doc_rows = self.rows(doc_id)
+        rows, positions, starts, depth = [], [], [], []
+        for k, row in enumerate(doc_rows):
+            offsets = self.offset_mapping[row, :self.lengths[row]]
+            real = np.flatnonzero(offsets[:, 1] > offsets[:, 0])
+            rank = np.arange(len(real))
+            # The start of the first window and the end of the last one are the ends of the post, not edges
+            left = rank if k > 0 else np.full(len(real), len(real))
+            right = len(real) - 1 - rank if k < len(doc_rows) - 1 else np.full(len(real), len(real))
+            rows.append(np.full(len(real), row, dtype=np.int64))
+            positions.append(real)
+            starts.append(offsets[real, 0])
+            depth.append(np.minimum(left, right))
+        if len(rows) <= 1:
+            return (rows[0], positions[0]) if rows else (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        rows, positions, starts, depth = (np.concatenate(parts) for parts in (rows, positions, starts, depth))
+        # Sort by start offset, deepest copy first, and keep the first copy of each token
+        order = np.lexsort((-depth, starts))
+        first = np.concatenate(([True], starts[order][1:] != starts[order][:-1]))
+        return rows[order[first]], positions[order[first]]
+
+    def batches(self, batch_size=32, doc_ids=None):
+        """
+        Yields (row_indices, input_ids, attention_mask, offset_mapping) batches,
+        each trimmed to the longest row in the batch, ready to feed to a model.
+        """
+        if doc_ids is None:
+            row_indices = np.arange(len(self.row_doc))
+        else:
+            row_indices = np.array([row for doc_id in doc_ids for row in self.rows(doc_id)], dtype=np.int64)
+        for i in range(0, len(row_indices), batch_size):
+            batch = row_indices[i:i + batch_size]
+            width = int(self.lengths[batch].max()) if len(batch) else 0
+            yield batch, self.input_ids[batch, :width], self.attention_mask[batch, :width], self.offset_mapping[batch, :width]
+
+    def span_tokens(self, doc_id, start, end):
+        """
+        Returns the (start, end) offsets of the tokens of a post within [start, end),
+        clipped to the span; for the 'regex-word' store this matches running the
+        \\w+ regex over the span text.
+        """
+        row = self.doc_rows[self.doc_index[doc_id]]
+        offsets = self.offset_mapping[row, :self.lengths[row]]
+        first = np.searchsorted(offsets[:, 1], start, side='right')
+        last = np.searchsorted(offsets[:, 0], end, side='left')
+        return [(max(int(s), start), min(int(e), end)) for s, e in offsets[first:last]]
+
+
+def open_token_store(tokenizer_name, corpus=None, store_dir=DEFAULT_STORE_DIR, **build_kwargs):
+    """
+    Opens the token store of a tokenizer for the current corpus version,
+    tokenizing the corpus first if no store exists for it yet.
+    """
+    corpus = corpus if corpus is not None else open_corpus()
+    path = store_path(tokenizer_name, corpus.version, store_dir)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        print(f'Tokenizing {len(corpus)} posts with {tokenizer_name} ...')
+        build_token_store(corpus, tokenizer_name, store_dir, **build_kwargs)
+    return TokenStore(path)
+
+
+if __name__ == '__main__':
+    # Usage: python tokenization_store.py [tokenizer_name ...]
+    tokenizer_names = sys.argv[1:] or ['d4data/biomedical-ner-all', WORD_TOKENIZER]
+    corpus = open_corpus()
+    for tokenizer_name in tokenizer_names:
+        path = build_token_store(corpus, tokenizer_name)
+        store = TokenStore(path)
+        print(f'{tokenizer_name}: {len(store.row_doc)} rows for {len(store.doc_ids)} posts -> {path}')